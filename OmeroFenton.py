@@ -4,18 +4,34 @@
 import sys
 import logging
 import ast
-import json
-import queue
 import re
 import string
 from slackclient import SlackClient
 import time
 
 from configurator import configure
+from configurator import diff_config
 from configurator import getcfgkey
+from configurator import parse_bool
+from configurator import ConfigWatcher
+from logevent import LogEvent
+import checkpoint
+import dedup
 import diskmonitor
+import discovery
+import emailsender
+import messageindex
+import metrics
+import outputqueue
+import ratelimit
+import slackoutput
 import taillog
+import tailwatcher
+import workers
 import aggregator
+import asyncruntime
+import backfill
+import collector
 import signal
 import threading
 
@@ -35,15 +51,51 @@ class OmeroFenton(object):
     # Based on
     # https://github.com/slackhq/python-rtmbot/blob/master/rtmbot/core.py
 
-    def __init__(self, botname, token, channel, config=None):
+    def __init__(self, botname, token, channel, config=None,
+                 max_attachments=20, queue_capacity=None, dedup_ttl=0):
         self.botname = botname
         self.channel = channel
         self.config = config
-
-        self.started = time.strftime('%Y-%m-%d %H:%M:%S %Z')
+        # The current configuration, updated when it's reloaded
+        self.maincfg = {}
+        self.logcfgs = {}
+        # (logtype, name): the reporter, disk monitor or aggregator created
+        # for each configuration section
+        self.sections = {}
+
+        self.start_time = time.time()
+        self.started = time.strftime(
+            '%Y-%m-%d %H:%M:%S %Z', time.localtime(self.start_time))
         self.reporters = []
         self.aggregators = []
-        self._log_output = queue.Queue()
+        self.tailwatcher = None
+        self.checkpoints = None
+        # workers.WorkerPool if log files are tailed by worker processes
+        self.workers = None
+        # collector.Collector if events are received from agents
+        self.collector = None
+        # diskmonitor.DiskSampler, shared by all disk monitors
+        self.disks = None
+        # name: checkpoint, reporters resume from these, e.g. after a backfill
+        self.resume_states = {}
+        # Optional messageindex.MessageIndex, searchable from Slack
+        self.index = None
+        # configurator.ConfigWatcher, reloads the configuration
+        self.config_watcher = None
+        # Optional metrics.MetricsServer
+        self.metrics = None
+        # Seconds to wait for emails to be sent when closing
+        self.email_timeout = 10
+        # asyncruntime.AsyncRuntime, if None each component runs in a thread
+        self.runtime = None
+        self.dedup = None
+        # Rate limits shared between groups of files, and across all files
+        self.rate_limit_groups = {}
+        self.global_rate_limiter = None
+        if dedup_ttl:
+            self.dedup = dedup.Deduplicator(dedup_ttl)
+        self._log_output = outputqueue.OutputQueue(
+            **(queue_capacity or {}))
 
         self.slack_client = SlackClient(token)
         self.slack_call('api.test')
@@ -55,6 +107,10 @@ class OmeroFenton(object):
                 'Real-time messaging disable, rtm_connect failed: %s',
                 self.rtm_connected)
 
+        self.output = slackoutput.SlackOutput(
+            self.slack_client, self.channel, self.botname, self._log_output,
+            max_attachments)
+
         self.last_ping = 0
         self._alive = True
 
@@ -63,13 +119,27 @@ class OmeroFenton(object):
         if not r['ok']:
             raise Exception(str(r))
 
+    def start_thread(self, target):
+        """
+        Run target in a daemon thread, unless an asyncio runtime is used in
+        which case it's run as a task when the runtime starts
+        """
+        if self.runtime:
+            return
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+
     def start(self):
+        if self.runtime:
+            self.runtime.run()
+            return
+        self.start_thread(self.output.start)
         while self._alive:
             if self.rtm_connected:
                 for msg in self.slack_client.rtm_read():
                     self.message(msg)
                 self.autoping()
-            self.output_logs()
             time.sleep(0.2)
 
     def autoping(self):
@@ -83,6 +153,33 @@ class OmeroFenton(object):
         if self._alive:
             # Graceful exit
             self._alive = False
+            if self.config_watcher:
+                self.config_watcher.stop()
+            if self.metrics:
+                self.metrics.stop()
+            self.output.stop()
+            if self.workers:
+                self.workers.stop()
+            if self.collector:
+                self.collector.stop()
+            if self.tailwatcher:
+                self.tailwatcher.stop()
+            if self.disks:
+                self.disks.stop()
+            if self.checkpoints:
+                self.checkpoints.flush()
+            if self.index:
+                # Writes the messages which are still queued
+                self.index.stop()
+            # Send pending alerts, and wait up to email_timeout seconds for
+            # them to be delivered before stopping the email senders. Any
+            # which can't be delivered are kept in the spool if there is
+            # one, otherwise they're lost
+            aggregator.get_scheduler().stop()
+            end = time.time() + self.email_timeout
+            for s in emailsender.get_senders():
+                s.join(max(end - time.time(), 0))
+                s.stop()
         else:
             logging.error('Calling sys.exit(%d)' % ret)
             sys.exit(ret)
@@ -94,7 +191,7 @@ class OmeroFenton(object):
             text = data.get("text")
             channel = data.get("channel")
             if text and channel:
-                funcs = [self.status]
+                funcs = [self.search, self.status]
                 for f in funcs:
                     reply = f(text)
                     if reply:
@@ -102,32 +199,69 @@ class OmeroFenton(object):
                             channel)
                         logging.info('Replying: %s', reply)
                         slack_channel.send_message(reply)
+                        break
 
-    def log_message(self, logmsg):
+    def log_message(self, logmsg, level=None, name=None, fp=None):
         logging.info('Queuing: %s', logmsg)
-        att = {
-            "fallback": "Log monitor alert",
-            "color": "#ff0000",
-            # "pretext": "Pretext text",
-            "title": "Log monitor alert",
-            # "title_link": "https://api.slack.com/docs/attachments",
-            # "fields": [{
-            #     "title":"key", "value":"value"
-            #     }],
-            "ts": time.time(),
-            "mrkdwn_in": ["text"],
-            "text": "```\n%s\n```" % logmsg,
-            }
-        self._log_output.put(json.dumps([att]))
-
-    def output_logs(self):
-        try:
-            log = self._log_output.get_nowait()
-            self.slack_call(
-                'chat.postMessage', channel=self.channel,
-                username=self.botname, attachments=log)
-        except queue.Empty:
-            pass
+        if self._log_output.put(logmsg, level, name, fp) and fp:
+            # Repeats are only suppressed once the first has been queued
+            self.dedup.add(fp)
+
+    def update_message(self, fp):
+        self.output.update(fp)
+
+    def search(self, body):
+        """
+        Query the message index:
+          botname search TERMS [since DURATION]
+          botname top [LEVEL ...] [since DURATION]
+        e.g. "botname search OutOfMemory since 24h"
+        """
+        if not self.index:
+            return None
+        pattern = r'(^|\s)@?%s:?\s+(search|top)\b(.*)$' % re.escape(
+            self.botname)
+        m = re.search(pattern, body, re.IGNORECASE | re.DOTALL)
+        if not m:
+            return None
+        command, args = m.group(2).lower(), m.group(3).strip()
+        since = None
+        sm = re.search(r'(^|\s)since\s+(\S+)\s*$', args, re.IGNORECASE)
+        if sm:
+            try:
+                since = messageindex.parse_duration(sm.group(2))
+            except ValueError as e:
+                return str(e)
+            args = args[:sm.start()].strip()
+        period = ' since %s' % sm.group(2) if sm else ''
+
+        def summary(msg):
+            return '\n'.join(line[:200] for line in msg.splitlines()[:2])
+
+        def ts(t):
+            return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+        start = time.time()
+        if command == 'search':
+            if not args:
+                return 'Usage: %s search TERMS [since 24h]' % self.botname
+            n, rows = self.index.search(args, since)
+            lines = ['%s %s %s:\n%s' % (ts(t), name, level, summary(msg))
+                     for (t, name, level, msg) in rows]
+            reply = '%d messages matching "%s"%s' % (n, args, period)
+        else:
+            # "top errors" means all indexed levels
+            levels = [a.upper() for a in args.split()
+                      if a.lower() not in ('error', 'errors')]
+            rows = self.index.top(since, levels)
+            lines = ['%d times, last %s %s %s:\n%s' % (
+                n, ts(t), names, level, summary(msg))
+                for (n, t, names, level, msg) in rows]
+            reply = 'Most frequent messages%s' % period
+        reply += ' (%dms)' % ((time.time() - start) * 1000)
+        if lines:
+            reply += '\n```\n%s\n```' % '\n\n'.join(lines)
+        return reply
 
     def status(self, body):
         logging.debug(body)
@@ -137,24 +271,81 @@ class OmeroFenton(object):
         if re.search(pattern, body, re.IGNORECASE):
             reply = 'OMERO Adverse Reporting of System Errors\n\n'
             reply += 'Monitoring started: %s\n' % self.started
+            reply += self._log_output.status() + '\n'
+            reply += self.output.status() + '\n'
+            if self.dedup:
+                reply += self.dedup.status() + '\n'
             for r in self.reporters:
                 reply += r.status() + '\n'
+            for a in self.aggregators:
+                reply += a.status() + '\n'
+            if self.index:
+                reply += self.index.status() + '\n'
+            for s in emailsender.get_senders():
+                reply += s.status() + '\n'
         return reply
 
+    def set_tailwatcher(self, watcher):
+        """
+        Tail all log files using a single tailwatcher instead of a thread
+        per file
+        """
+        self.tailwatcher = watcher
+        self.start_thread(watcher.start)
+
+    def set_checkpoints(self, store):
+        """
+        Resume log reporters from checkpoints and periodically save them
+        """
+        self.checkpoints = store
+        self.start_thread(store.start)
+
     def add_reporter(self, reporter):
-        self.reporters.append(reporter)
-        t = threading.Thread(target=reporter.start)
-        t.daemon = True
-        t.start()
+        if hasattr(reporter, 'add_sink'):
+            for a in self.aggregators:
+                reporter.add_sink(a)
+        # Replaced rather than modified as it may be used by other threads
+        self.reporters = self.reporters + [reporter]
+        if hasattr(reporter, 'dedup'):
+            reporter.dedup = self.dedup
+        if hasattr(reporter, 'index'):
+            reporter.index = self.index
+        if self.checkpoints and hasattr(reporter, 'checkpoint'):
+            self.checkpoints.add(reporter)
+        state = self.resume_states.pop(getattr(reporter, 'name', None), None)
+        if state and hasattr(reporter, 'resume'):
+            reporter.resume(state)
+        if self.tailwatcher and hasattr(reporter, 'poll'):
+            self.tailwatcher.add(reporter)
+        elif self.runtime:
+            self.runtime.start_component(reporter)
+        else:
+            self.start_thread(reporter.start)
+
+    def remove_reporter(self, reporter):
+        """
+        Stop and remove a reporter, e.g. after its configuration section
+        has been removed
+        """
+        self.reporters = [r for r in self.reporters if r is not reporter]
+        if self.checkpoints and hasattr(reporter, 'checkpoint'):
+            self.checkpoints.remove(reporter)
+        if self.tailwatcher and hasattr(reporter, 'poll'):
+            self.tailwatcher.remove(reporter)
+        else:
+            reporter.stop()
 
     def add_aggregator(self, reporter):
-        self.aggregators.append(reporter)
+        self.aggregators = self.aggregators + [reporter]
         for r in self.reporters:
             if hasattr(r, 'add_sink'):
                 r.add_sink(reporter)
-        t = threading.Thread(target=reporter.start)
-        t.daemon = True
-        t.start()
+
+    def remove_aggregator(self, reporter):
+        self.aggregators = [a for a in self.aggregators if a is not reporter]
+        for r in self.reporters:
+            if hasattr(r, 'remove_sink'):
+                r.remove_sink(reporter)
 
 
 def add_log_reporter(logtype, bot, logcfg, maincfg):
@@ -166,20 +357,78 @@ def add_log_reporter(logtype, bot, logcfg, maincfg):
 
     name = getcfgkey('name', logcfg)
     filename = getcfgkey('file', logcfg)
+    if discovery.is_pattern(filename):
+        d = discovery.LogDiscovery(
+            logtype, logcfg, maincfg, bot, add_log_reporter,
+            getcfgkey('rescan_interval', logcfg, maincfg, cast=float) or 60)
+        bot.add_reporter(d)
+        return d
     levels = getcfgkey('levels', logcfg, maincfg).split(',')
 
     limitn = getcfgkey('rate_limit_n', logcfg, maincfg, cast=int)
     limitt = getcfgkey('rate_limit_t', logcfg, maincfg, cast=float)
 
     r = logClass(filename, name, bot, levels, limitn, limitt)
-    loglen = getcfgkey('max_log_length', logcfg, maincfg, cast=int)
-    if loglen:
-        r.max_log_length = loglen
-
+    configure_log_reporter(r, bot, logcfg, maincfg)
     bot.add_reporter(r)
+    return r
+
 
+def configure_log_reporter(r, bot, logcfg, maincfg):
+    """
+    Set the options of a log reporter, also used to change them in place
+    when the configuration is reloaded
+    """
+    levels = getcfgkey('levels', logcfg, maincfg).split(',')
+    if levels != r.levels:
+        r.set_levels(levels)
 
-def add_disk_reporter(logtype, bot, logcfg):
+    limitn = getcfgkey('rate_limit_n', logcfg, maincfg, cast=int)
+    limitt = getcfgkey('rate_limit_t', logcfg, maincfg, cast=float)
+    r.rate_limit_n = limitn
+    r.rate_limit_t = limitt
+    limitlevels = ratelimit.parse_level_rate_limits(
+        getcfgkey('rate_limit_levels', logcfg, maincfg))
+    # Keep the current limiter's history if its limits haven't changed
+    limiter = r.rate_limiters[0]
+    if limiter.config != (limitn, limitt, limitlevels):
+        limiter = ratelimit.LevelRateLimiter(limitn, limitt, limitlevels)
+    group = getcfgkey('rate_limit_group', logcfg)
+    if group:
+        # The first file in a group defines its limits
+        limiter = bot.rate_limit_groups.setdefault(group, limiter)
+    r.rate_limiters = [limiter]
+    if bot.global_rate_limiter:
+        r.rate_limiters.append(bot.global_rate_limiter)
+    r.event_time = bool(getcfgkey(
+        'event_time', logcfg, maincfg, cast=parse_bool))
+    loglen = getcfgkey('max_log_length', logcfg, maincfg, cast=int)
+    if loglen:
+        r.max_log_length = loglen
+    pollint = getcfgkey('poll_interval', logcfg, maincfg, cast=float)
+    if pollint:
+        r.pollint = pollint
+    msglen = getcfgkey('max_message_length', logcfg, maincfg, cast=int)
+    if msglen:
+        r.max_message_length = msglen
+    read_mode = getcfgkey('read_mode', logcfg, maincfg)
+    if read_mode:
+        r.read_mode = read_mode
+    r.update_parser()
+    history = getcfgkey('rate_history_days', logcfg, maincfg, cast=float)
+    if history:
+        r.rate_minutes = int(history * 1440)
+    anomaly_levels = getcfgkey('anomaly_levels', logcfg, maincfg)
+    r.set_anomaly_detection(
+        [level.strip() for level in (anomaly_levels or '').split(',')
+         if level.strip()],
+        getcfgkey('anomaly_threshold', logcfg, maincfg, cast=float) or 4,
+        getcfgkey('anomaly_min_count', logcfg, maincfg, cast=int) or 10,
+        getcfgkey('anomaly_baseline_minutes', logcfg, maincfg,
+                  cast=int) or 60)
+
+
+def add_disk_reporter(logtype, bot, logcfg, maincfg):
     logreq = ['path', 'warn_mb', 'hysteresis_mb']
     if any(k not in logcfg for k in logreq):
         raise Exception('[%s] must contain keys: %s' % (logtype, logreq))
@@ -188,12 +437,29 @@ def add_disk_reporter(logtype, bot, logcfg):
     warnlevels = getcfgkey('warn_mb', logcfg)
     warnlevels = [int(w) for w in warnlevels.split(',')]
     hysteresis = getcfgkey('hysteresis_mb', logcfg, cast=int)
+    full_hours = getcfgkey('full_warn_hours', logcfg, cast=float)
 
-    r = diskmonitor.DiskMonitor(path, bot, warnlevels, hysteresis, 5)
-    bot.add_reporter(r)
+    if not bot.disks:
+        bot.disks = diskmonitor.DiskSampler(
+            getcfgkey('disk_interval', maincfg, cast=float) or 5,
+            getcfgkey('disk_timeout', maincfg, cast=float) or 10)
+        bot.add_reporter(bot.disks)
+    m = diskmonitor.DiskMonitor(path, bot, warnlevels, hysteresis, full_hours)
+    bot.disks.add(m)
+    return m
+
+
+def configure_disk_reporter(m, logcfg):
+    """
+    Change the warning levels of a disk monitor in place
+    """
+    m.warnlevels = sorted((int(w) for w in getcfgkey(
+        'warn_mb', logcfg).split(',')), reverse=True)
+    m.hysteresis = getcfgkey('hysteresis_mb', logcfg, cast=int)
+    m.full_warn_hours = getcfgkey('full_warn_hours', logcfg, cast=float)
 
 
-def get_email_alerter(logtype, logcfg):
+def get_email_alerter(logtype, logcfg, maincfg):
     logreq = ['name', 'smtp', 'email_from', 'email_to', 'email_subject']
     if any(k not in logcfg for k in logreq):
         raise Exception('[%s] must contain keys: %s' % (logtype, logreq))
@@ -204,34 +470,239 @@ def get_email_alerter(logtype, logcfg):
     eto = getcfgkey('email_to', logcfg)
     eto = eto.split()
     esubject = getcfgkey('email_subject', logcfg)
+    spool = getcfgkey('email_spool', logcfg, maincfg)
 
-    return aggregator.EmailAlerter(name, smtp, efrom, eto, esubject)
+    return aggregator.EmailAlerter(name, smtp, efrom, eto, esubject, spool)
 
 
-def add_email_alerter(logtype, bot, logcfg):
+def add_email_alerter(logtype, bot, logcfg, maincfg):
     logreq = ['name', 'conditions', 'delay', 'interval']
     if any(k not in logcfg for k in logreq):
         raise Exception('[%s] must contain keys: %s' % (logtype, logreq))
 
+    e = get_email_alerter(logtype, logcfg, maincfg)
+    conditions, delay, interval, max_events, event_time = (
+        get_aggregate_settings(logcfg, maincfg))
+    r = aggregator.AggregateAlerter(
+        conditions, delay, interval, max_events, event_time=event_time)
+    r.add_alerter(e)
+    bot.add_aggregator(r)
+    return r
+
+
+def get_aggregate_settings(logcfg, maincfg):
+    """
+    Returns (conditions, delay, interval, max_events, event_time)
+    """
     # name = getcfgkey('name', logcfg)
     conditions = getcfgkey('conditions', logcfg)
     conditions = ast.literal_eval(conditions)
     delay = getcfgkey('delay', logcfg, cast=int)
     interval = getcfgkey('interval', logcfg, cast=int)
+    max_events = getcfgkey('max_events', logcfg, cast=int) or 1000
+    event_time = bool(getcfgkey(
+        'event_time', logcfg, maincfg, cast=parse_bool))
+    return conditions, delay, interval, max_events, event_time
 
-    e = get_email_alerter(logtype, logcfg)
-    r = aggregator.AggregateAlerter(conditions, delay, interval)
-    r.add_alerter(e)
-    bot.add_aggregator(r)
+
+def configure_email_alerter(r, logtype, logcfg, maincfg):
+    """
+    Change the settings of an aggregator in place, held events are kept
+    """
+    r.configure(*get_aggregate_settings(logcfg, maincfg))
+    r.alerters = [get_email_alerter(logtype, logcfg, maincfg)]
+
+
+def add_section(bot, logtype, logcfg, maincfg):
+    """
+    Create the reporter, disk monitor or aggregator for a configuration
+    section
+    """
+    if logtype == 'diskmonitor':
+        r = add_disk_reporter(logtype, bot, logcfg, maincfg)
+    elif logtype in logtype_map:
+        r = add_log_reporter(logtype, bot, logcfg, maincfg)
+    elif logtype == 'emailalerts':
+        r = add_email_alerter(logtype, bot, logcfg, maincfg)
+    else:
+        raise Exception(
+            'Invalid configuration section: [%s]' % logtype)
+    bot.sections[(logtype, logcfg['name'])] = r
+
+
+def remove_section(bot, key):
+    logtype, name = key
+    r = bot.sections.pop(key)
+    if logtype == 'diskmonitor':
+        bot.disks.remove(r)
+    elif logtype == 'emailalerts':
+        bot.remove_aggregator(r)
+    else:
+        bot.remove_reporter(r)
+
+
+# [main] options which are only read at startup
+RESTART_OPTIONS = (
+    'botname', 'token', 'channel', 'runtime', 'workers', 'tail_mode',
+    'checkpoint_file', 'checkpoint_interval', 'slack_max_attachments',
+    'output_queue_capacity', 'index_file', 'metrics_address',
+    'config_watch_interval', 'collector_listen', 'collector_token')
+
+
+def reload_config(bot, maincfg, logcfgs):
+    """
+    Apply a changed configuration. Sections which have been added or
+    removed are started or stopped, other sections are updated in place so
+    tail positions, counts and rate limit history are kept. A log or disk
+    section is only restarted if its file or path has changed.
+    """
+    if bot.workers:
+        logging.error('Reloading the configuration is not supported with '
+                      'workers, restart to apply changes')
+        return
+    for key in RESTART_OPTIONS:
+        if maincfg.get(key) != bot.maincfg.get(key):
+            logging.warning('[main] %s has changed, restart to apply', key)
+
+    global_limit = getcfgkey('rate_limit_global', maincfg)
+    if not global_limit:
+        bot.global_rate_limiter = None
+    else:
+        n, t = ratelimit.parse_rate_limit(global_limit)
+        if (not bot.global_rate_limiter or
+                bot.global_rate_limiter.config != (n, t, {})):
+            bot.global_rate_limiter = ratelimit.LevelRateLimiter(n, t)
+    dedup_ttl = getcfgkey('dedup_ttl', maincfg, cast=int)
+    if bot.dedup and dedup_ttl:
+        bot.dedup.ttl = dedup_ttl
+    elif bool(bot.dedup) != bool(dedup_ttl):
+        logging.warning('[main] dedup_ttl has changed, restart to apply')
+    if bot.index:
+        bot.index.retention = (getcfgkey(
+            'index_retention_days', maincfg, cast=float) or 7) * 86400
+        bot.index.max_size_mb = getcfgkey(
+            'index_max_mb', maincfg, cast=float) or 512
+    if bot.disks:
+        bot.disks.interval = getcfgkey(
+            'disk_interval', maincfg, cast=float) or 5
+        bot.disks.timeout = getcfgkey(
+            'disk_timeout', maincfg, cast=float) or 10
+    if bot.tailwatcher:
+        bot.tailwatcher.pollint = getcfgkey(
+            'poll_interval', maincfg, cast=float) or 2
+
+    added, removed, changed = diff_config(bot.logcfgs, logcfgs)
+    old = dict(((t, c['name']), c) for t in bot.logcfgs
+               for c in bot.logcfgs[t])
+    new = dict(((t, c['name']), c) for t in logcfgs for c in logcfgs[t])
+    for key in changed:
+        logtype, name = key
+        if ((logtype in logtype_map and
+             old[key].get('file') != new[key].get('file')) or
+            (logtype == 'diskmonitor' and
+             old[key].get('path') != new[key].get('path'))):
+            removed.append(key)
+            added.append(key)
+    for key in removed:
+        logging.info('Removing [%s %s]', *key)
+        remove_section(bot, key)
+
+    # All log reporters are reconfigured since they inherit [main] options,
+    # rate limit groups are recreated from the first file in each group
+    bot.rate_limit_groups = {}
+    for key in sorted(bot.sections):
+        logtype, name = key
+        r = bot.sections[key]
+        try:
+            if isinstance(r, discovery.LogDiscovery):
+                r.logcfg = new[key]
+                r.maincfg = maincfg
+                for child in list(r.reporters.values()):
+                    configure_log_reporter(
+                        child, bot, r.child_config(child), maincfg)
+            elif logtype in logtype_map:
+                configure_log_reporter(r, bot, new[key], maincfg)
+            elif key not in changed:
+                continue
+            elif logtype == 'diskmonitor':
+                configure_disk_reporter(r, new[key])
+            elif logtype == 'emailalerts':
+                configure_email_alerter(r, logtype, new[key], maincfg)
+                # Reportable levels may have changed
+                for rep in bot.reporters:
+                    if hasattr(rep, 'level_cache'):
+                        rep.level_cache.clear()
+        except Exception:
+            logging.exception('Failed to reconfigure [%s %s]', *key)
+
+    # Aggregators last so new log reporters are included
+    for key in sorted(added, key=lambda k: (k[0] == 'emailalerts', k)):
+        logging.info('Adding [%s %s]', *key)
+        try:
+            add_section(bot, key[0], new[key], maincfg)
+        except Exception:
+            logging.exception('Failed to add [%s %s]', *key)
+
+    bot.maincfg = maincfg
+    bot.logcfgs = logcfgs
+    m = 'Configuration reloaded: %d added, %d removed, %d changed' % (
+        len(set(added) - set(removed)), len(set(removed) - set(added)),
+        len(changed))
+    logging.info(m)
+    bot.log_message(m)
 
 
-def test_email_alerter(logcfgs):
+def test_email_alerter(logcfgs, maincfg):
     logtype = 'emailalerts'
     if logtype in logcfgs:
         for cfg in logcfgs[logtype]:
-            e = get_email_alerter(logtype, cfg)
+            e = get_email_alerter(logtype, cfg, maincfg)
             t = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
-            e.alert([('Email alert test', 'test', t)])
+            e.alert([LogEvent(t, source='test', level='Email alert test')])
+            if not e.sender.join(60):
+                logging.error('Failed to send test email via %s', e.smtp)
+
+
+def run_backfill(args, maincfg, logcfgs):
+    """
+    Scan existing log files and print a summary, returns the position the
+    scan finished at in each current log file
+    """
+    sections = [(logtype, cfg) for logtype in logcfgs.keys()
+                if logtype in logtype_map for cfg in logcfgs[logtype]]
+    alerts = logcfgs.get('emailalerts', [])
+    conditions = [ast.literal_eval(getcfgkey('conditions', cfg))
+                  for cfg in alerts]
+    summary = backfill.backfill(sections, maincfg, conditions,
+                                add_log_reporter, args.backfill_processes)
+    print(summary.format(alert_names=[cfg['name'] for cfg in alerts]))
+    return summary.states
+
+
+def get_max_open_files(maincfg):
+    """
+    max_open_files, default is half the file descriptor limit
+    """
+    n = getcfgkey('max_open_files', maincfg, cast=int)
+    if n is None:
+        n = tailwatcher.default_max_open()
+    return n
+
+
+def parse_queue_capacity(value):
+    """
+    Parse a comma separated list of capacities, optionally prefixed by a
+    level: e.g. 1000,WARN:200
+    """
+    cfg = {}
+    if value:
+        for c in value.split(','):
+            if ':' in c:
+                level, n = c.split(':', 1)
+                cfg.setdefault('level_capacity', {})[level.strip()] = int(n)
+            else:
+                cfg['capacity'] = int(c)
+    return cfg
 
 
 def main():
@@ -244,8 +715,27 @@ def main():
     logging.debug(maincfg)
     logging.debug(logcfgs)
 
+    resume_states = {}
+    if args.backfill:
+        resume_states = run_backfill(args, maincfg, logcfgs)
+        if not args.follow:
+            return
+
+    if getcfgkey('collector_address', maincfg):
+        collector.agent_main(maincfg, logcfgs, add_log_reporter,
+                             add_disk_reporter, logtype_map)
+        return
+
     # Setup the bot and register plugins
-    bot = OmeroFenton(maincfg['botname'], maincfg['token'], maincfg['channel'])
+    max_attachments = getcfgkey(
+        'slack_max_attachments', maincfg, cast=int) or 20
+    queue_capacity = parse_queue_capacity(
+        getcfgkey('output_queue_capacity', maincfg))
+    bot = OmeroFenton(maincfg['botname'], maincfg['token'], maincfg['channel'],
+                      max_attachments=max_attachments,
+                      queue_capacity=queue_capacity,
+                      dedup_ttl=getcfgkey('dedup_ttl', maincfg, cast=int))
+    bot.resume_states = resume_states
 
     def shutdown_handler(signal=None, frame=None):
         logging.info('Shut-down signal received')
@@ -253,28 +743,113 @@ def main():
 
     if args.emailtest:
         logging.info("Testing email alerts")
-        test_email_alerter(logcfgs)
+        test_email_alerter(logcfgs, maincfg)
         return
 
-    signal.signal(signal.SIGINT, shutdown_handler)
+    runtime = getcfgkey('runtime', maincfg) or 'threads'
+    if runtime == 'asyncio':
+        bot.runtime = asyncruntime.AsyncRuntime(bot)
+        aggregator.set_scheduler(bot.runtime.scheduler)
+    elif runtime != 'threads':
+        raise Exception('Invalid runtime: %s' % runtime)
+    else:
+        # The asyncio runtime handles signals itself
+        signal.signal(signal.SIGINT, shutdown_handler)
+
+    index_file = getcfgkey('index_file', maincfg)
+    if index_file:
+        bot.index = messageindex.MessageIndex(
+            index_file,
+            (getcfgkey('index_retention_days', maincfg, cast=float) or 7) *
+            86400,
+            getcfgkey('index_max_mb', maincfg, cast=float) or 512)
+        # Also run in a thread with the asyncio runtime
+        t = threading.Thread(target=bot.index.start)
+        t.daemon = True
+        t.start()
 
+    global_limit = getcfgkey('rate_limit_global', maincfg)
+    if global_limit:
+        bot.global_rate_limiter = ratelimit.LevelRateLimiter(
+            *ratelimit.parse_rate_limit(global_limit))
+
+    checkpoint_file = getcfgkey('checkpoint_file', maincfg)
+    if checkpoint_file:
+        interval = getcfgkey(
+            'checkpoint_interval', maincfg, cast=float) or 10
+        bot.set_checkpoints(
+            checkpoint.CheckpointStore(checkpoint_file, interval))
+
+    tail_mode = getcfgkey('tail_mode', maincfg) or 'auto'
+    pollint = getcfgkey('poll_interval', maincfg, cast=float) or 2
+    max_open = get_max_open_files(maincfg)
+    watcher = tailwatcher.get_tailwatcher(tail_mode, pollint, max_open)
+    patterns = [cfg['file'] for logtype in logtype_map
+                for cfg in logcfgs.get(logtype, [])
+                if discovery.is_pattern(cfg['file'])]
+    if not watcher and bot.runtime:
+        # The asyncio runtime doesn't run a thread per file
+        watcher = tailwatcher.PollingTailWatcher(pollint, max_open)
+    elif not watcher and patterns:
+        logging.info('Polling log files from a single thread instead of a '
+                     'thread per file since %s may match many files',
+                     patterns[0])
+        watcher = tailwatcher.PollingTailWatcher(pollint, max_open)
+    if watcher:
+        logging.info('Tailing log files using %s', type(watcher).__name__)
+        bot.set_tailwatcher(watcher)
+
+    nworkers = getcfgkey('workers', maincfg, cast=int)
     postconfig = []
+    sharded = []
 
     for logtype in logcfgs.keys():
         for cfg in logcfgs[logtype]:
-            if logtype == 'diskmonitor':
-                add_disk_reporter(logtype, bot, cfg)
-            elif logtype in logtype_map:
-                add_log_reporter(logtype, bot, cfg, maincfg)
+            if logtype in logtype_map and nworkers:
+                sharded.append((logtype, cfg))
+            elif logtype == 'diskmonitor' or logtype in logtype_map:
+                add_section(bot, logtype, cfg, maincfg)
             else:
                 postconfig.append((logtype, cfg))
 
     for logtype, cfg in postconfig:
-        if logtype == 'emailalerts':
-            add_email_alerter(logtype, bot, cfg)
-        else:
-            raise Exception(
-                'Invalid configuration section: [%s]', logtype)
+        add_section(bot, logtype, cfg, maincfg)
+    bot.maincfg = maincfg
+    bot.logcfgs = logcfgs
+
+    def reload_cb(newmain, newlogs):
+        reload_config(bot, newmain, newlogs)
+
+    bot.config_watcher = ConfigWatcher(
+        args.config, reload_cb,
+        getcfgkey('config_watch_interval', maincfg, cast=float))
+    signal.signal(signal.SIGHUP, lambda signum, frame: (
+        bot.config_watcher.request()))
+    # Also run in a thread with the asyncio runtime
+    t = threading.Thread(target=bot.config_watcher.start)
+    t.daemon = True
+    t.start()
+
+    metrics_address = getcfgkey('metrics_address', maincfg)
+    if metrics_address:
+        bot.metrics = metrics.MetricsServer(bot, metrics_address)
+        # Also run in a thread with the asyncio runtime
+        t = threading.Thread(target=bot.metrics.start)
+        t.daemon = True
+        t.start()
+
+    if sharded:
+        # Created after the aggregators so workers can forward to them
+        bot.workers = workers.WorkerPool(
+            bot, nworkers, sharded, maincfg, add_log_reporter, args.loglevel)
+        bot.add_reporter(bot.workers)
+
+    collector_listen = getcfgkey('collector_listen', maincfg)
+    if collector_listen:
+        # Created after the aggregators so agents are sent their conditions
+        bot.collector = collector.Collector(
+            bot, collector_listen, getcfgkey('collector_token', maincfg))
+        bot.add_reporter(bot.collector)
 
     bot.start()
     logging.info("Done")
@@ -1,13 +1,103 @@
+import collections
+import emailsender
+import heapq
+import itertools
 import logging
-import queue
 import re
-import smtplib
+import threading
 import time
 
 
+class AlertScheduler(object):
+
+    def __init__(self):
+        """
+        Runs the delay and interval deadlines of all AggregateAlerters from
+        a single thread. The thread sleeps until the earliest deadline and
+        is woken when a new one is scheduled.
+        """
+        # (deadline, seq, aggregator)
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self._alive = True
+
+    def schedule(self, aggregator, deadline):
+        with self.cond:
+            heapq.heappush(self.heap, (deadline, next(self.seq), aggregator))
+            self.cond.notify()
+            if self.thread is None and self._alive:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self._alive:
+                    now = time.time()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    self.cond.wait(
+                        self.heap[0][0] - now if self.heap else None)
+                if not self._alive:
+                    return
+                deadline, seq, aggregator = heapq.heappop(self.heap)
+            try:
+                aggregator.alert()
+            except Exception:
+                logging.exception('Failed to send alert')
+
+    def stop(self, flush=True):
+        """
+        Stop the scheduler. If flush is True pending alerts are sent
+        immediately instead of waiting for their delay.
+        """
+        with self.cond:
+            self._alive = False
+            pending = [a for (d, s, a) in sorted(self.heap)]
+            self.heap = []
+            self.cond.notify()
+        if flush:
+            for aggregator in pending:
+                aggregator.alert()
+
+
+_scheduler = AlertScheduler()
+
+
+def get_scheduler():
+    return _scheduler
+
+
+def set_scheduler(scheduler):
+    """
+    Replace the default scheduler, must be called before any
+    AggregateAlerters are created
+    """
+    global _scheduler
+    _scheduler = scheduler
+
+
+def merge_events(events):
+    """
+    Put events from several log files into the order they were logged.
+    Events from each file are already in order so the files are merged
+    with a k-way heap merge instead of sorting all the events.
+    """
+    sources = collections.OrderedDict()
+    for e in events:
+        sources.setdefault(e.source, []).append(e)
+    if len(sources) < 2:
+        return events
+    return list(heapq.merge(*sources.values(), key=lambda e: e.get_time()))
+
+
 class AggregateAlerter(object):
 
-    def __init__(self, conditions, delay, interval):
+    def __init__(self, conditions, delay, interval, max_events=1000,
+                 scheduler=None, event_time=False):
         """
         conditions: A 3-tuple of regular expressions which will be matched
           against (level, name, msg). Use empty or None to ignore a field
@@ -15,107 +105,202 @@ class AggregateAlerter(object):
           seconds before alerting to gather additional reportable events
         interval: Don't send another alert until after this time interval
           in seconds has elapsed
+        max_events: Maximum number of events held for the next alert, the
+          oldest are discarded first
+        scheduler: The AlertScheduler, default is shared by all aggregators
+        event_time: Use the time events were logged instead of when they
+          were received to discard old events
 
         Events received more than interval seconds ago will be discarded
         """
-        self.conditions = conditions
+        self.set_conditions(conditions)
         self.delay = delay
         self.interval = interval
+        self.event_time = event_time
+        self.scheduler = scheduler or get_scheduler()
 
-        self.queue = queue.Queue()
+        self.events = collections.deque(maxlen=max_events)
+        self.lock = threading.Lock()
         self.alerters = []
         self.last_event = None
-        self.new_events = False
+        # An alert is waiting for its delay to expire
+        self.pending = False
+        # No new alert is scheduled before this time
+        self.quiet_until = 0
         self.n_discarded = 0
 
         logging.debug('conditions:%s delay:%d interval:%d',
                       self.conditions, self.delay, self.interval)
 
+    def set_conditions(self, conditions):
+        self.conditions = conditions
+        self.compiled = [tuple(re.compile(p, re.I) if p else None
+                               for p in c) for c in conditions]
+        # (level, name): message matcher, see get_matcher
+        self.matchers = {}
+
+    def configure(self, conditions, delay, interval, max_events,
+                  event_time=False):
+        """
+        Change the settings of a running aggregator, held events are kept
+        """
+        with self.lock:
+            if conditions != self.conditions:
+                self.set_conditions(conditions)
+            self.delay = delay
+            self.interval = interval
+            self.event_time = event_time
+            if max_events != self.events.maxlen:
+                self.events = collections.deque(self.events, maxlen=max_events)
+
     def add_alerter(self, alerter):
         self.alerters.append(alerter)
 
-    def clear_old(self):
-        now = time.time()
-        if (self.last_event and not self.queue.empty() and
+    def clear_old(self, now):
+        if (self.last_event and self.events and
                 (now - self.last_event) > self.interval):
-            tmp = self.get_all()
-            self.n_discarded += len(tmp)
-            logging.info('Discarding %d events', len(tmp))
-
-    def log_received(self, level, name, msg):
-        m = (level, name, msg)
-        if self.reportable(*m):
-            logging.debug('Reportable log_received: %s', m)
-            now = time.time()
-            self.clear_old()
-            self.queue.put(m)
-            self.last_event = now
-            self.new_events = True
+            self.n_discarded += len(self.events)
+            logging.info('Discarding %d events', len(self.events))
+            self.events.clear()
+
+    def log_received(self, event):
+        if self.reportable(event):
+            self.add_event(event)
         # else:
-        #    logging.debug('Ignoring log_received: %s', m)
+        #    logging.debug('Ignoring log_received: %s', event)
+
+    def add_event(self, event):
+        """
+        Add a reportable logevent.LogEvent and schedule an alert
+        """
+        logging.debug('Reportable log_received: %s', event)
+        now = time.time()
+        t = event.get_time(self.event_time)
+        with self.lock:
+            self.clear_old(t)
+            if len(self.events) == self.events.maxlen:
+                self.n_discarded += 1
+            self.events.append(event)
+            # Events from different files may be out of order
+            self.last_event = max(self.last_event or t, t)
+            # Events during the interval are held but don't trigger
+            # another alert
+            schedule = not self.pending and now >= self.quiet_until
+            if schedule:
+                self.pending = True
+        if schedule:
+            logging.debug('Alerting in %ds', self.delay)
+            self.scheduler.schedule(self, now + self.delay)
 
     def get_all(self):
-        msgs = []
+        with self.lock:
+            msgs = list(self.events)
+            self.events.clear()
+        return msgs
+
+    def get_matcher(self, level, name):
+        """
+        Returns the message matcher for the conditions matching level and
+        name, cached so level and name patterns are only checked once:
+          None if no conditions match so messages aren't reportable
+          True if a matching condition has no message pattern
+          otherwise a tuple of compiled message patterns
+        """
+        key = (level, name)
         try:
-            while True:
-                msgs.append(self.queue.get(block=False))
-        except queue.Empty:
+            return self.matchers[key]
+        except KeyError:
             pass
-        self.new_events = False
-        return msgs
 
-    def reportable(self, level, name, msg):
-        for (l, n, m) in self.conditions:
-            if l and not re.search(l, level, re.I):
-                continue
-            if n and not re.search(n, name, re.I):
+        matcher = []
+        for (l, n, m), (lc, nc, mc) in zip(self.conditions, self.compiled):
+            if lc and not lc.search(level):
                 continue
-            if m and not re.search(m, msg, re.I):
+            if nc and not nc.search(name):
                 continue
+            if not mc:
+                matcher = True
+                break
+            if m not in (p.pattern for p in matcher):
+                matcher.append(mc)
+
+        if matcher is not True:
+            matcher = tuple(matcher) or None
+        self.matchers[key] = matcher
+        return matcher
+
+    def reportable(self, event):
+        """
+        The body of the event is only used if a condition has a message
+        pattern
+        """
+        matcher = self.get_matcher(event.level, event.source)
+        if matcher is None:
+            return False
+        if matcher is True:
             return True
+        msg = event.body
+        for mc in matcher:
+            if mc.search(msg):
+                return True
+        return False
+
+    def wants(self, level, name):
+        """
+        Returns True if messages with this level and name may be reportable
+        """
+        return self.get_matcher(level, name) is not None
 
     def alert(self):
-        pre = None
-        if self.n_discarded:
-            pre = 'Suppressed events: %d not shown' % self.n_discarded
-            self.n_discarded = 0
-        msgs = self.get_all()
+        with self.lock:
+            pre = None
+            if self.n_discarded:
+                pre = 'Suppressed events: %d not shown' % self.n_discarded
+                self.n_discarded = 0
+            msgs = list(self.events)
+            self.events.clear()
+            self.pending = False
+            self.quiet_until = time.time() + self.interval
+        if not msgs:
+            return
+        msgs = merge_events(msgs)
         for r in self.alerters:
             logging.debug('Alerting: %s', r)
             r.alert(msgs, pre=pre)
 
-    def start(self):
-        while True:
-            if self.new_events:
-                logging.debug('Sleeping for %ds before emailing', self.delay)
-                time.sleep(self.delay)
-                logging.debug('Alerting: %s', self.alerters)
-                self.alert()
-                logging.debug('Sleeping for %ds', self.interval)
-                time.sleep(self.interval)
-                # Don't alert events that happened during the interval
-                self.new_events = False
-            else:
-                time.sleep(2)
+    def status(self):
+        m = 'Alerts %s: events %d  discarded %d  %s' % (
+            ', '.join(getattr(a, 'name', str(a)) for a in self.alerters),
+            len(self.events), self.n_discarded,
+            'pending' if self.pending else 'idle')
+        logging.debug('status: %s', m)
+        return m
 
 
 class EmailAlerter(object):
 
-    def __init__(self, name, smtp, fromaddr, toaddrs, subject):
+    def __init__(self, name, smtp, fromaddr, toaddrs, subject, spool=None):
+        """
+        Emails are sent in the background by an emailsender.EmailSender
+        shared with other alerters using the same SMTP server
+        """
         self.name = name
         self.smtp = smtp
         self.fromaddr = fromaddr
         self.toaddrs = toaddrs
         self.subject = subject
-        self.max_attempts = 3
+        self.sender = emailsender.get_sender(smtp, spool)
 
     def alert(self, msgs, pre=None):
+        """
+        msgs: List of logevent.LogEvent
+        """
         headers = '\n'.join(['From: %s' % self.fromaddr,
                              'To: %s' % ', '.join(self.toaddrs),
                              'Subject: %s' % self.subject])
         preamble = 'Alert created: %s' % time.strftime(
             '%Y-%m-%dT%H:%M:%SZ', time.gmtime())
-        formatted = '\n'.join('%s: %s:\n%s' % m for m in msgs)
+        formatted = '\n'.join(m.format() for m in msgs)
         if pre:
             formatted = pre + '\n\n' + formatted
 
@@ -123,18 +308,4 @@ class EmailAlerter(object):
         self.send(email)
 
     def send(self, email):
-        for a in range(self.max_attempts):
-            try:
-                s = smtplib.SMTP(self.smtp)
-                logging.debug('Sending email to %s', self.toaddrs)
-                s.sendmail(self.fromaddr, self.toaddrs, email)
-                s.quit()
-                return
-            except Exception as e:
-                logging.error(
-                    'Failed to send email on attempt %d: %s', a + 1, e)
-                if a < self.max_attempts - 1:
-                    time.sleep(10)
-
-        logging.error(
-            'Failed to send email after %d attempts', self.max_attempts)
+        self.sender.submit(self.fromaddr, self.toaddrs, email)
@@ -0,0 +1,195 @@
+import asyncio
+import concurrent.futures
+import logging
+import signal
+import threading
+import time
+
+
+class AsyncAlertScheduler(object):
+
+    def __init__(self):
+        """
+        Runs AggregateAlerter deadlines as timers on the asyncio event loop,
+        see aggregator.AlertScheduler
+        """
+        self.loop = None
+        # Scheduled before the loop started: (aggregator, deadline)
+        self.pending = []
+        # aggregator: asyncio.TimerHandle
+        self.timers = {}
+        self.lock = threading.Lock()
+        self._alive = True
+
+    def attach(self, loop):
+        with self.lock:
+            self.loop = loop
+            pending = self.pending
+            self.pending = []
+        for aggregator, deadline in pending:
+            self.schedule(aggregator, deadline)
+
+    def schedule(self, aggregator, deadline):
+        with self.lock:
+            if not self._alive:
+                return
+            if self.loop is None:
+                self.pending.append((aggregator, deadline))
+                return
+        # May be called from a thread other than the loop's
+        self.loop.call_soon_threadsafe(self._schedule, aggregator, deadline)
+
+    def _schedule(self, aggregator, deadline):
+        if self._alive:
+            self.timers[aggregator] = self.loop.call_later(
+                max(deadline - time.time(), 0), self.alert, aggregator)
+
+    def alert(self, aggregator):
+        self.timers.pop(aggregator, None)
+        try:
+            aggregator.alert()
+        except Exception:
+            logging.exception('Failed to send alert')
+
+    def stop(self, flush=True):
+        with self.lock:
+            self._alive = False
+            pending = [a for (a, d) in self.pending]
+            self.pending = []
+        for aggregator, timer in list(self.timers.items()):
+            timer.cancel()
+            pending.append(aggregator)
+        self.timers.clear()
+        if flush:
+            for aggregator in pending:
+                aggregator.alert()
+
+
+class AsyncRuntime(object):
+
+    def __init__(self, bot, max_workers=4):
+        """
+        Runs OmeroFenton on a single asyncio event loop instead of a thread
+        per component. Log files are tailed by bot.tailwatcher, which must
+        be set. Slack output, disk space checks, checkpoint saving and RTM
+        messages are tasks on the loop, blocking calls are run in a small
+        thread pool.
+
+        max_workers: Size of the thread pool for blocking calls
+        """
+        self.bot = bot
+        self.max_workers = max_workers
+        self.scheduler = AsyncAlertScheduler()
+        self.tasks = []
+        self.loop = None
+        # Added before the loop started, see start_component
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(
+            self.max_workers, thread_name_prefix='fenton')
+        loop.set_default_executor(executor)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        self.scheduler.attach(loop)
+
+        self.tasks.append(asyncio.ensure_future(
+            self.bot.tailwatcher.run_async()))
+        self.tasks.append(asyncio.ensure_future(self.output()))
+        if self.bot.rtm_connected:
+            self.tasks.append(asyncio.ensure_future(self.rtm()))
+        if self.bot.checkpoints:
+            self.tasks.append(asyncio.ensure_future(self.checkpoints()))
+        with self.lock:
+            self.loop = loop
+            pending = self.pending
+            self.pending = []
+        for r in pending:
+            self._start_component(r)
+
+        try:
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            executor.shutdown(wait=False)
+
+    def start_component(self, component):
+        """
+        Run a reporter which isn't tailed by the tailwatcher. Components
+        added before the loop starts are started with it, others (e.g. by
+        a configuration reload) as soon as possible, this may be called
+        from any thread.
+        """
+        with self.lock:
+            if self.loop is None:
+                self.pending.append(component)
+                return
+        self.loop.call_soon_threadsafe(self._start_component, component)
+
+    def _start_component(self, r):
+        if hasattr(r, 'monitors'):
+            self.tasks.append(asyncio.ensure_future(self.disks(r)))
+        else:
+            # Nothing to await, e.g. a blocking plugin
+            t = threading.Thread(target=r.start)
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        logging.info('Shut-down signal received')
+        self.bot.close(1)
+        for t in self.tasks:
+            t.cancel()
+
+    async def output(self):
+        loop = asyncio.get_running_loop()
+        while self.bot.output._alive:
+            await loop.run_in_executor(None, self.bot.output.run_once)
+
+    async def rtm(self):
+        """
+        Read RTM messages when the websocket is readable, and ping every
+        3 seconds
+        """
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        try:
+            sock = self.bot.slack_client.server.websocket.sock
+            loop.add_reader(sock, ready.set)
+        except (AttributeError, ValueError) as e:
+            logging.debug('Polling for RTM messages: %s', e)
+            sock = None
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(ready.wait(), 1 if sock else 0.2)
+                except asyncio.TimeoutError:
+                    pass
+                ready.clear()
+                msgs = await loop.run_in_executor(
+                    None, self.bot.slack_client.rtm_read)
+                for msg in msgs:
+                    await loop.run_in_executor(None, self.bot.message, msg)
+                await loop.run_in_executor(None, self.bot.autoping)
+        finally:
+            if sock:
+                loop.remove_reader(sock)
+
+    async def checkpoints(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.bot.checkpoints.interval)
+            await loop.run_in_executor(None, self.bot.checkpoints.flush)
+
+    async def disks(self, sampler):
+        loop = asyncio.get_running_loop()
+        while sampler._alive:
+            # Waits for statvfs calls in the sampler's own thread pool
+            await loop.run_in_executor(None, sampler.sample)
+            await asyncio.sleep(sampler.interval)
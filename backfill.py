@@ -0,0 +1,228 @@
+import collections
+import concurrent.futures
+import glob
+import gzip
+import logging
+import multiprocessing
+import os
+
+import aggregator
+import dedup
+import discovery
+
+
+def find_files(filename):
+    """
+    Returns the rotated log files (e.g. Blitz-0.log.1, Blitz-0.log.2.gz)
+    oldest first, followed by the current file if it exists
+    """
+    rotated = []
+    for path in glob.glob(glob.escape(filename) + '.*'):
+        try:
+            rotated.append((os.stat(path).st_mtime, path))
+        except OSError:
+            pass
+    files = [path for (mtime, path) in sorted(rotated)]
+    if os.path.exists(filename):
+        files.append(filename)
+    return files
+
+
+def open_log(path):
+    """
+    Open a log file for streaming, decompressing .gz files
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', errors='replace')
+    return open(path, errors='replace')
+
+
+class ScanSink(aggregator.AggregateAlerter):
+    """
+    Records events matching an email alert's conditions instead of
+    emailing them
+    """
+
+    def __init__(self, index, conditions, bot):
+        super(ScanSink, self).__init__(conditions, 0, 0)
+        self.index = index
+        self.bot = bot
+
+    def log_received(self, event):
+        if self.reportable(event):
+            self.bot.matched(self.index, event.level, event.source,
+                             event.body)
+
+
+class ScanBot(object):
+    """
+    Stands in for OmeroFenton when scanning a file, collects counts,
+    fingerprints and matching messages
+    """
+
+    def __init__(self, max_messages, max_length):
+        self.max_messages = max_messages
+        self.max_length = max_length
+        # fingerprint: [count, first message]
+        self.fingerprints = {}
+        self.matches = []
+        self.n_matches = 0
+        self.rate_limit_groups = {}
+        self.global_rate_limiter = None
+        self.reporters = []
+
+    def add_reporter(self, reporter):
+        self.reporters.append(reporter)
+
+    def log_message(self, logmsg, level=None, name=None, fp=None):
+        logmsg = str(logmsg)
+        f = dedup.fingerprint(logmsg)
+        try:
+            self.fingerprints[f][0] += 1
+        except KeyError:
+            self.fingerprints[f] = [1, logmsg]
+
+    def update_message(self, fp):
+        pass
+
+    def matched(self, index, level, name, msg):
+        self.n_matches += 1
+        if len(self.matches) < self.max_messages:
+            if len(msg) > self.max_length:
+                msg = msg[:self.max_length] + '...'
+            self.matches.append((index, level, name, msg))
+
+
+def scan_file(task):
+    """
+    Scan a single log file in a worker process.
+    The current log file is read with the reporter's own tail so its final
+    position can be used as a checkpoint to continue tailing from.
+    """
+    (logtype, cfg, maincfg, conditions, add_log_reporter, path, live,
+     max_messages) = task
+    bot = ScanBot(max_messages, 1024)
+    add_log_reporter(logtype, bot, cfg, maincfg)
+    r = bot.reporters[0]
+    # Report everything, rate limits and anomalous bursts (which use the
+    # time messages are read) only make sense for live alerts
+    r.rate_limiters = []
+    r.anomalies = {}
+    for i, c in enumerate(conditions):
+        r.add_sink(ScanSink(i, c, bot))
+
+    state = None
+    parser = r.get_parser()
+    if live:
+        st = os.stat(path)
+        parser.tail.resume({'inode': st.st_ino, 'device': st.st_dev,
+                            'offset': 0})
+        while parser.poll():
+            pass
+        state = parser.tail.checkpoint()
+        nlines = parser.tail.count
+    else:
+        nlines = 0
+        with open_log(path) as f:
+            for line in f:
+                parser.process_line(line)
+                nlines += 1
+        parser.process(None)
+
+    return {
+        'name': r.name,
+        'path': path,
+        'lines': nlines,
+        'counts': r.counts,
+        'fingerprints': bot.fingerprints,
+        'matches': bot.matches,
+        'n_matches': bot.n_matches,
+        'state': state,
+    }
+
+
+class Summary(object):
+
+    def __init__(self):
+        self.files = 0
+        self.lines = 0
+        # name: {level: count}
+        self.counts = collections.OrderedDict()
+        # fingerprint: [count, first message, set(names)]
+        self.fingerprints = {}
+        self.matches = []
+        self.n_matches = 0
+        # name: checkpoint of the current log file
+        self.states = {}
+
+    def add(self, result):
+        name = result['name']
+        logging.info('Scanned %s: %d lines', result['path'], result['lines'])
+        self.files += 1
+        self.lines += result['lines']
+        counts = self.counts.setdefault(name, collections.Counter())
+        counts.update(result['counts'])
+        for fp, (n, msg) in result['fingerprints'].items():
+            entry = self.fingerprints.setdefault(fp, [0, msg, set()])
+            entry[0] += n
+            entry[2].add(name)
+        self.matches.extend(result['matches'])
+        self.n_matches += result['n_matches']
+        if result['state']:
+            self.states[name] = result['state']
+
+    def format(self, top=10, alert_names=None):
+        lines = ['Scanned %d files, %d lines' % (self.files, self.lines), '']
+        for name, counts in self.counts.items():
+            lines.append('%s:    %s' % (name, '  '.join(
+                '%s: %d' % c for c in sorted(counts.items()))))
+
+        lines.extend(['', 'Top %d messages:' % top])
+        for fp, (n, msg, names) in sorted(
+                self.fingerprints.items(), key=lambda e: -e[1][0])[:top]:
+            lines.append('%6d  %s  %s' % (n, ','.join(sorted(names)), ' '.join(
+                msg.splitlines()[1:2])))
+
+        lines.extend(['', 'Email alert matches: %d' % self.n_matches])
+        for index, level, name, msg in self.matches:
+            alert = alert_names[index] if alert_names else index
+            lines.append('[%s] %s: %s:\n%s' % (alert, level, name, msg))
+        return '\n'.join(lines)
+
+
+def backfill(sections, maincfg, conditions, add_log_reporter,
+             processes=None, max_messages=100):
+    """
+    Scan existing log files, including rotated and compressed files, in a
+    process pool. Files are streamed, not read into memory.
+
+    sections: List of (logtype, cfg) log sections
+    conditions: List of AggregateAlerter conditions, events matching these
+      are included in the summary
+    add_log_reporter: Function (logtype, bot, cfg, maincfg) which creates
+      a log reporter
+    max_messages: Maximum number of matching messages per file
+
+    Returns a Summary, Summary.states can be used to resume tailing from
+    the end of the scan
+    """
+    tasks = []
+    for logtype, section in sections:
+        if discovery.is_pattern(section['file']):
+            cfgs = discovery.expand(section)
+        else:
+            cfgs = [section]
+        for cfg in cfgs:
+            for path in find_files(cfg['file']):
+                live = path == cfg['file']
+                tasks.append((logtype, cfg, maincfg, conditions,
+                              add_log_reporter, path, live, max_messages))
+
+    summary = Summary()
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=context) as executor:
+        # Results are returned in order so matches are chronological
+        for result in executor.map(scan_file, tasks):
+            summary.add(result)
+    return summary
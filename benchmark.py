@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the log processing pipeline and its hot paths
+
+    python benchmark.py [--json results.json] [benchmark ...]
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import aggregator
+import emailsender
+import outputqueue
+import pytail
+import slackoutput
+import taillog
+import tailwatcher
+from logevent import LogEvent
+
+
+class NullReporter(object):
+    """
+    Stands in for OmeroFenton, discards all messages
+    """
+
+    def __init__(self):
+        self.n = 0
+
+    def log_message(self, logmsg, level=None, name=None, fp=None):
+        self.n += 1
+
+    def update_message(self, fp):
+        pass
+
+
+def timeit(f, n):
+    start = time.perf_counter()
+    f(n)
+    return time.perf_counter() - start
+
+
+def bench_ratelimit(args):
+    """
+    Per-message cost of LimitLogReporter.log_or_limit as rate_limit_n
+    grows, when messages are being suppressed and when all are allowed
+    """
+    n = args.n
+    rows = []
+    print('%-14s %14s %14s' % ('rate_limit_n', 'suppress ns', 'allow ns'))
+    for limitn in (1, 10, 100, 1000, 10000, 100000):
+        results = []
+        # A long window suppresses, a tiny one allows everything
+        for limitt in (3600, 1e-9):
+            r = taillog.LimitLogReporter(
+                'bench.log', 'bench', NullReporter(), ['ERROR'],
+                limitn, limitt)
+
+            def run(n):
+                for i in range(n):
+                    r.log_or_limit('msg', 'ERROR')
+
+            # Fill the window first
+            run(limitn)
+            results.append(timeit(run, n) * 1e9 / n)
+        print('%-14d %14.0f %14.0f' % ((limitn,) + tuple(results)))
+        rows.append(dict(rate_limit_n=limitn, suppress_ns=results[0],
+                         allow_ns=results[1]))
+    return rows
+
+
+def java_trace(nlines):
+    lines = ['2020-01-31 12:34:56,789 ERROR [ome.services.util.ServiceHandler]'
+             ' (l.Server-7) Method interface threw exception\n',
+             'java.lang.RuntimeException: Synthetic failure\n']
+    lines.extend('\tat ome.example.Class%d.method(Class%d.java:%d)\n' % (
+        i, i, i) for i in range(nlines - 2))
+    return lines
+
+
+def concat_message(lines):
+    # The previous implementation, for comparison
+    class Parser(object):
+        pass
+    p = Parser()
+    p.current = lines[0]
+    for line in lines[1:]:
+        p.current += line
+    return p.current
+
+
+def bench_multiline(args):
+    """
+    Assembling synthetic Java stack traces into messages with LogParser
+    """
+    start = 'START 2020-01-31 12:34:56,789 INFO next message\n'
+
+    def log_start(line):
+        return (not line.startswith('\t') and
+                not line.startswith('java.'), None)
+
+    rows = []
+    print('%-10s %14s %14s %14s %12s' % (
+        'lines', 'concat ms', 'unlimited ms', 'capped ms', 'msg length'))
+    for nlines in (100, 1000, 10000, 100000):
+        lines = java_trace(nlines) + [start]
+        # Quadratic, too slow to run on the largest trace
+        results = [timeit(lambda n: concat_message(lines), 1) * 1e3
+                   if nlines <= 10000 else float('nan')]
+        for max_length in (None, 65536):
+            msgs = []
+            p = pytail.LogParser(
+                'bench.log', lambda e: msgs.append(e.body), log_start,
+                max_length=max_length)
+            results.append(timeit(
+                lambda n: [p.process(line) for line in lines], 1) * 1e3)
+        print('%-10d %14.1f %14.1f %14.1f %12d' % (
+            (nlines,) + tuple(results) + (len(msgs[0]),)))
+        rows.append(dict(lines=nlines, concat_ms=results[0],
+                         unlimited_ms=results[1], capped_ms=results[2],
+                         msg_length=len(msgs[0])))
+    return rows
+
+
+def write_log(f, nlines, error_every=1000, trace_lines=20):
+    """
+    Write a Blitz style log, mostly INFO with an occasional ERROR and trace
+    """
+    info = ('%s INFO  [ome.services.util.ServiceHandler] (l.Server-%d) '
+            'Meth:\tinterface ome.api.IQuery.findAllByQuery\n')
+    error = ('%s ERROR [ome.services.util.ServiceHandler] (l.Server-%d) '
+             'Method interface threw exception\n')
+    trace = java_trace(trace_lines)[1:]
+    ts = '2020-01-31 12:34:56,789'
+    n = 0
+    while n < nlines:
+        if n % error_every == 0:
+            f.write(error % (ts, n % 10))
+            f.writelines(trace)
+            n += len(trace) + 1
+        else:
+            f.write(info % (ts, n % 10))
+            n += 1
+
+
+def bench_read(args):
+    """
+    Catching up on a large log file with each PyTail read mode
+    """
+    rows = []
+    with tempfile.NamedTemporaryFile('w', suffix='.log') as f:
+        write_log(f, args.n * 10)
+        f.flush()
+        size = os.path.getsize(f.name)
+        print('%d lines, %.1f MiB' % (args.n * 10, size / 1024.0 / 1024))
+        print('%-8s %10s %10s %12s' % ('mode', 'seconds', 'MiB/s', 'lines/s'))
+        for mode in ('text', 'binary', 'mmap'):
+            r = taillog.LimitLogReporter(
+                f.name, 'bench', NullReporter(), ['ERROR'], 0, 0)
+            r.read_mode = mode
+            # Start from the beginning of the file
+            r.resume({'inode': os.stat(f.name).st_ino,
+                      'device': os.stat(f.name).st_dev, 'offset': 0})
+
+            def run(n):
+                while r.poll():
+                    pass
+
+            t = timeit(run, 1)
+            print('%-8s %10.2f %10.1f %12.0f' % (
+                mode, t, size / 1024.0 / 1024 / t, args.n * 10 / t))
+            rows.append(dict(mode=mode, seconds=t, bytes=size,
+                             lines_per_s=args.n * 10 / t))
+    return rows
+
+
+def bench_prefilter(args):
+    """
+    LogParser throughput on an in-memory Blitz style log with and without
+    LogReporter's prefilter, as text and undecoded lines
+    """
+    class Lines(object):
+        def write(self, s):
+            self.lines.extend(s.splitlines(True))
+
+        def writelines(self, lines):
+            self.lines.extend(lines)
+    f = Lines()
+    f.lines = []
+    write_log(f, args.n)
+    text = f.lines
+    binary = [line.encode() for line in text]
+
+    rows = []
+    print('%-8s %-6s %16s %16s' % (
+        'lines', 'sinks', 'before lines/s', 'after lines/s'))
+    for name, lines in (('text', text), ('binary', binary)):
+        for sinks in (False, True):
+            results = []
+            for prefilter in (False, True):
+                r = taillog.LimitLogReporter(
+                    'bench.log', 'bench', NullReporter(), ['ERROR'], 0, 0)
+                if sinks:
+                    r.add_sink(aggregator.AggregateAlerter(
+                        [('FATAL', '', '')], 0, 0))
+                p = r.get_parser()
+                if not prefilter:
+                    p.prefilter_f = None
+
+                def run(n):
+                    for line in lines:
+                        p.process_line(line)
+
+                results.append(len(lines) / timeit(run, 1))
+            print('%-8s %-6s %16.0f %16.0f' % (
+                (name, sinks) + tuple(results)))
+            rows.append(dict(lines=name, sinks=sinks,
+                             before_lines_per_s=results[0],
+                             after_lines_per_s=results[1]))
+    return rows
+
+
+def reportable_uncompiled(conditions, level, name, msg):
+    # The previous implementation, for comparison
+    for (l, n, m) in conditions:
+        if l and not re.search(l, level, re.I):
+            continue
+        if n and not re.search(n, name, re.I):
+            continue
+        if m and not re.search(m, msg, re.I):
+            continue
+        return True
+
+
+def bench_conditions(args):
+    """
+    AggregateAlerter.reportable with many email alert conditions
+    """
+    msg = ''.join(java_trace(50))
+    names = ['Blitz-0', 'Indexer-0', 'PixelData-0', 'Processor-0']
+    rows = []
+    print('%-12s %16s %16s' % ('conditions', 'uncompiled ns', 'compiled ns'))
+    for nconditions in (1, 10, 50):
+        conditions = [('ERROR|FATAL', 'Blitz', 'out\\s*of\\s*memory%d' % i)
+                      for i in range(nconditions)]
+        conditions.append(('FATAL', '', ''))
+        a = aggregator.AggregateAlerter(conditions, 0, 0)
+        events = [LogEvent(msg, source=name, level=level)
+                  for level in ('INFO', 'WARN', 'ERROR') for name in names]
+
+        def uncompiled(n):
+            for i in range(n):
+                e = events[i % len(events)]
+                reportable_uncompiled(conditions, e.level, e.source, msg)
+
+        def compiled(n):
+            for i in range(n):
+                a.reportable(events[i % len(events)])
+
+        n = args.n // 10
+        results = [timeit(uncompiled, n) * 1e9 / n,
+                   timeit(compiled, n) * 1e9 / n]
+        print('%-12d %16.0f %16.0f' % ((nconditions,) + tuple(results)))
+        rows.append(dict(conditions=nconditions, uncompiled_ns=results[0],
+                         compiled_ns=results[1]))
+    return rows
+
+
+def write_jenkins_log(f, nlines, error_every=1000, trace_lines=20):
+    """
+    Write a Jenkins (logdatelevel) style log, the level is at the start of
+    the second line of each message
+    """
+    header = 'Jan 31, 2020 1:23:45 PM hudson.model.Run execute\n'
+    info = 'INFO: Build step completed %d\n'
+    severe = 'SEVERE: Build step failed %d\n'
+    trace = java_trace(trace_lines)[1:]
+    n = 0
+    next_error = 0
+    while n < nlines:
+        f.write(header)
+        if n >= next_error:
+            f.write(severe % n)
+            f.writelines(trace)
+            n += len(trace) + 2
+            next_error += error_every
+        else:
+            f.write(info % n)
+            n += 2
+
+
+LOG_FORMATS = {
+    'logdefault': (taillog.LimitLogReporter, write_log, 'ERROR'),
+    'logall': (taillog.LimitLogAllReporter, write_log, '*'),
+    'logdatelevel': (taillog.LimitLogDateLevelReporter, write_jenkins_log,
+                     'SEVERE'),
+}
+
+
+class StubSlackClient(object):
+    """
+    Stands in for SlackClient, records when alerts are posted
+    """
+
+    def __init__(self):
+        # (time, attachments)
+        self.posted = []
+
+    def api_call(self, method, **kwargs):
+        if method == 'chat.postMessage':
+            self.posted.append((time.time(), kwargs['attachments']))
+        return {'ok': True, 'channel': 'C0', 'ts': '%f' % time.time()}
+
+
+class StubSMTP(object):
+    """
+    Stands in for smtplib.SMTP, records when emails are sent
+    """
+
+    def __init__(self):
+        # (time, email)
+        self.sent = []
+
+    def noop(self):
+        return (250, b'OK')
+
+    def sendmail(self, fromaddr, toaddrs, email):
+        self.sent.append((time.time(), email))
+
+    def quit(self):
+        pass
+
+
+class StubEmailSender(emailsender.EmailSender):
+
+    def __init__(self):
+        super(StubEmailSender, self).__init__('stub')
+        self.stub = StubSMTP()
+
+    def connect(self):
+        return self.stub
+
+
+class StubBot(object):
+    """
+    Stands in for OmeroFenton with the real output queue and SlackOutput,
+    and an AggregateAlerter emailing every reportable event immediately
+    """
+
+    def __init__(self, level):
+        self.log_output = outputqueue.OutputQueue(capacity=10 ** 7)
+        self.slack = StubSlackClient()
+        self.output = slackoutput.SlackOutput(
+            self.slack, '#bench', 'bench', self.log_output)
+        self.sender = StubEmailSender()
+        email = aggregator.EmailAlerter(
+            'bench', 'stub', 'from@example.org', ['to@example.org'], 'bench')
+        email.sender = self.sender
+        self.aggregator = aggregator.AggregateAlerter(
+            [(re.escape(level), '', '')], 0, 0)
+        self.aggregator.add_alerter(email)
+
+    def log_message(self, logmsg, level=None, name=None, fp=None):
+        self.log_output.put(logmsg, level, name, fp)
+
+    def update_message(self, fp):
+        self.output.update(fp)
+
+    def reporter(self, logtype, filename, level):
+        cls = LOG_FORMATS[logtype][0]
+        r = cls(filename, logtype, self, [level], 0, 0)
+        r.read_mode = 'binary'
+        r.add_sink(self.aggregator)
+        return r
+
+    def start(self):
+        t = threading.Thread(target=self.output.start)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.output.stop()
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes
+    """
+    # KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def percentiles(values, ps=(50, 90, 99, 100)):
+    values = sorted(values)
+    if not values:
+        return dict(('p%d' % p, float('nan')) for p in ps)
+    return dict(('p%d' % p, values[int(round(p / 100.0 * (len(values) - 1)))])
+                for p in ps)
+
+
+def bench_pipeline(args):
+    """
+    Throughput of the whole pipeline for each log format: a log file with
+    occasional errors and Java traces is rotated half way through and read
+    by a LimitLog*Reporter, errors are posted to a stub Slack client and
+    emailed through a stub SMTP server by an AggregateAlerter
+    """
+    rows = []
+    print('%-14s %10s %12s %12s %10s %10s' % (
+        'format', 'seconds', 'lines/s', 'MiB/s', 'alerts', 'emails'))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for logtype in sorted(LOG_FORMATS):
+            cls, writer, level = LOG_FORMATS[logtype]
+            path = os.path.join(tmpdir, '%s.log' % logtype)
+            nlines = args.n * 10
+            with open(path, 'w') as f:
+                writer(f, nlines // 2)
+            bot = StubBot(level)
+            r = bot.reporter(logtype, path, level)
+            r.resume({'inode': os.stat(path).st_ino,
+                      'device': os.stat(path).st_dev, 'offset': 0})
+            bot.start()
+
+            def run(n):
+                while r.poll():
+                    pass
+                os.rename(path, path + '.1')
+                with open(path, 'w') as f:
+                    writer(f, nlines // 2)
+                while r.poll():
+                    pass
+                # Flush the last message
+                with open(path, 'a') as f:
+                    writer(f, 1)
+                while r.poll():
+                    pass
+
+            t = timeit(run, 1)
+            size = os.path.getsize(path) + os.path.getsize(path + '.1')
+            # Wait for the output to drain
+            while bot.log_output.qsize() or bot.sender.queue.unfinished_tasks:
+                time.sleep(0.01)
+            bot.stop()
+            nalerts = bot.output.n_alerts
+            print('%-14s %10.2f %12.0f %12.1f %10d %10d' % (
+                logtype, t, r.parser.tail.count / t,
+                size / 1024.0 / 1024 / t, nalerts, len(bot.sender.stub.sent)))
+            rows.append(dict(format=logtype, seconds=t,
+                             lines=r.parser.tail.count,
+                             lines_per_s=r.parser.tail.count / t,
+                             bytes=size, alerts=nalerts,
+                             emails=len(bot.sender.stub.sent),
+                             peak_rss=peak_rss()))
+    finally:
+        shutil.rmtree(tmpdir)
+    return rows
+
+
+def bench_latency(args):
+    """
+    End-to-end latency from an error being written to a log file until it's
+    posted to a stub Slack client and emailed through a stub SMTP server,
+    with the log tailed by a tailwatcher. The log is rotated half way.
+
+    Each error is only written once the previous one has been posted and
+    emailed: the aggregator's interval is 0, so an event arriving before
+    the pending alert is sent would discard it (see
+    AggregateAlerter.clear_old).
+    """
+    ids = re.compile(r'latency-id=(\d+)')
+    rows = []
+    print('%-8s %-6s %9s %10s %10s %10s %10s' % (
+        'tail', 'output', 'received', 'p50 ms', 'p90 ms', 'p99 ms',
+        'max ms'))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for mode in ('inotify', 'poll'):
+            if mode == 'inotify' and not tailwatcher.inotify_available():
+                continue
+            path = os.path.join(tmpdir, '%s.log' % mode)
+            open(path, 'w').close()
+            bot = StubBot('ERROR')
+            r = bot.reporter('logdefault', path, 'ERROR')
+            watcher = tailwatcher.get_tailwatcher(mode, 0.1)
+            watcher.add(r)
+            t = threading.Thread(target=watcher.start)
+            t.daemon = True
+            t.start()
+            bot.start()
+            # Wait for the file to be opened
+            while r.parser is None or r.parser.tail.f is None:
+                time.sleep(0.01)
+
+            written = {}
+            n = max(args.n // 1000, 10)
+            for i in range(n):
+                if i == n // 2:
+                    os.rename(path, path + '.1')
+                with open(path, 'a') as f:
+                    written[i] = time.time()
+                    # The following line completes the message
+                    f.write('2020-01-31 12:34:56,789 ERROR latency-id=%d\n'
+                            '2020-01-31 12:34:56,789 INFO x\n' % i)
+                # Wait for delivery, alerts which take longer are missing
+                # from the results
+                end = time.time() + 5
+                while time.time() < end and (
+                        len(bot.slack.posted) <= i or
+                        len(bot.sender.stub.sent) <= i):
+                    time.sleep(0.001)
+            watcher.stop()
+            bot.stop()
+
+            for output, sent in (('slack', bot.slack.posted),
+                                 ('email', bot.sender.stub.sent)):
+                latency = [(ts - written[int(i)]) * 1000
+                           for (ts, text) in sent for i in ids.findall(text)]
+                p = percentiles(latency)
+                print('%-8s %-6s %9d %10.1f %10.1f %10.1f %10.1f' % (
+                    mode, output, len(latency), p['p50'], p['p90'],
+                    p['p99'], p['p100']))
+                row = dict(tail=mode, output=output, alerts=n,
+                           received=len(latency), peak_rss=peak_rss())
+                row.update(p)
+                rows.append(row)
+    finally:
+        shutil.rmtree(tmpdir)
+    return rows
+
+
+BENCHMARKS = {
+    'conditions': bench_conditions,
+    'latency': bench_latency,
+    'multiline': bench_multiline,
+    'pipeline': bench_pipeline,
+    'prefilter': bench_prefilter,
+    'read': bench_read,
+    'ratelimit': bench_ratelimit,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser('Omero-Fenton benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run',
+                        default=sorted(BENCHMARKS.keys()))
+    parser.add_argument('-n', type=int, default=100000,
+                        help='Number of iterations')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    # Benchmark the code, not the debug logging
+    logging.basicConfig(level=logging.ERROR)
+    results = {}
+    for b in args.benchmarks:
+        print('# %s' % b)
+        results[b] = BENCHMARKS[b](args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'version': git_version(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'n': args.n,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'peak_rss': peak_rss(),
+                'results': results,
+            }, f, indent=1, sort_keys=True)
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    main()
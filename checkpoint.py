@@ -0,0 +1,79 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+class CheckpointStore(object):
+
+    def __init__(self, filename, interval=10):
+        """
+        filename: JSON file used to store the read position of each log
+        interval: Save checkpoints at this interval in seconds
+
+        Checkpoints are keyed by reporter name, and only used if the
+        reporter is still tailing the same path
+        """
+        self.filename = filename
+        self.interval = interval
+        self.reporters = []
+        self.states = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                self.states = json.load(f)
+        except IOError:
+            logging.info('No checkpoints found: %s', self.filename)
+        except ValueError as e:
+            logging.error('Ignoring invalid checkpoints %s: %s',
+                          self.filename, e)
+        self.saved = dict(self.states)
+
+    def add(self, reporter):
+        """
+        Register a reporter, resuming it from its checkpoint if there is one.
+        Must be called before the reporter starts tailing.
+        """
+        state = self.states.get(reporter.name)
+        if state and state.get('path') == reporter.file:
+            logging.debug('Resuming %s: %s', reporter.name, state)
+            reporter.resume(state)
+        with self.lock:
+            self.reporters.append(reporter)
+
+    def remove(self, reporter):
+        """
+        Unregister a reporter and forget its checkpoint
+        """
+        with self.lock:
+            if reporter in self.reporters:
+                self.reporters.remove(reporter)
+            self.states.pop(reporter.name, None)
+
+    def flush(self):
+        with self.lock:
+            for r in self.reporters:
+                state = r.checkpoint()
+                if state:
+                    self.states[r.name] = state
+            if self.states == self.saved:
+                return
+            tmp = self.filename + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(self.states, f, indent=1, sort_keys=True)
+                os.replace(tmp, self.filename)
+                self.saved = dict(self.states)
+                logging.debug('Saved checkpoints: %s', self.filename)
+            except (IOError, OSError) as e:
+                logging.error('Failed to save checkpoints %s: %s',
+                              self.filename, e)
+
+    def start(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
@@ -0,0 +1,765 @@
+import bisect
+import hmac
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import stat
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+import workers
+from configurator import getcfgkey
+from logevent import LogEvent
+
+
+# Agents and the collector exchange frames of (type, offset, payload
+# length) followed by the payload:
+#   HELLO agent -> collector, zlib compressed JSON {agent, spool, token}
+#   CONFIG collector -> agent, offset is the last acknowledged offset of
+#     the agent's spool, zlib compressed JSON {conditions}
+#   BATCH agent -> collector, offset of the batch in the agent's spool,
+#     zlib compressed JSON list of events
+#   ACK collector -> agent, all batches before offset have been handled
+FRAME = struct.Struct('!BQI')
+HELLO = 1
+CONFIG = 2
+BATCH = 3
+ACK = 4
+MAX_PAYLOAD = 64 * 1024 * 1024
+
+# Spool records are a payload length followed by a BATCH payload
+RECORD = struct.Struct('!I')
+
+
+def parse_address(address):
+    """
+    A Unix socket path (containing /) or host:port, returns
+    (socket family, address)
+    """
+    if '/' in address:
+        return socket.AF_UNIX, address
+    host, port = address.rsplit(':', 1)
+    host = host.strip('[]')
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return family, (host, int(port))
+
+
+def connect(address, timeout=10):
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(addr)
+        if family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def listen(address):
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        # Left behind if the collector wasn't stopped cleanly
+        try:
+            if stat.S_ISSOCK(os.stat(addr).st_mode):
+                os.remove(addr)
+        except OSError:
+            pass
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(addr)
+    sock.listen(16)
+    return sock
+
+
+def encode(obj):
+    return zlib.compress(json.dumps(obj).encode('utf-8'))
+
+
+def decode(payload):
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+def send_frame(sock, kind, offset, payload=b''):
+    sock.sendall(FRAME.pack(kind, offset, len(payload)) + payload)
+
+
+def recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        b = sock.recv(n - len(buf))
+        if not b:
+            raise ConnectionError('Connection closed')
+        buf += b
+    return bytes(buf)
+
+
+def read_frame(sock):
+    """
+    Returns (type, offset, payload)
+    """
+    kind, offset, n = FRAME.unpack(recv_exact(sock, FRAME.size))
+    if n > MAX_PAYLOAD:
+        raise ValueError('Frame too large: %d bytes' % n)
+    return kind, offset, recv_exact(sock, n)
+
+
+def condition_key(conditions):
+    """
+    Conditions are lists after a JSON round trip, aggregators' are tuples
+    """
+    return tuple(tuple(c) for c in conditions)
+
+
+class Spool(object):
+
+    def __init__(self, directory, max_mb=256, segment_mb=4):
+        """
+        Batches of events waiting to be acknowledged by the collector,
+        stored in append-only segment files. A batch is identified by its
+        offset in the stream of all batches ever spooled, segments are
+        named after the offset of their first batch and deleted once all
+        their batches have been acknowledged. The acknowledged offset is
+        saved so unacknowledged batches are sent again after a restart.
+
+        max_mb: New batches are dropped while the spool is larger than this
+        segment_mb: Start a new segment when the current one is this large
+        """
+        self.directory = directory
+        self.max_size = max_mb * 1024 * 1024
+        self.segment_size = segment_mb * 1024 * 1024
+        self.statefile = os.path.join(directory, 'state.json')
+        self.lock = threading.Lock()
+        # [offset, size, fd] of each segment
+        self.segments = []
+        self.n_dropped = 0
+        self.dirty = False
+        os.makedirs(directory, exist_ok=True)
+
+        state = {}
+        try:
+            with open(self.statefile) as f:
+                state = json.load(f)
+        except IOError:
+            pass
+        except ValueError as e:
+            logging.error('Ignoring invalid spool state %s: %s',
+                          self.statefile, e)
+        # Identifies this spool's offsets to the collector
+        self.id = state.get('id') or uuid.uuid4().hex
+        self.acked = state.get('acked', 0)
+        # Most recent conditions from the collector
+        self.conditions = state.get('conditions')
+
+        for name in sorted(os.listdir(directory), key=lambda n: (
+                len(n), n)):
+            if name.endswith('.spool'):
+                path = os.path.join(directory, name)
+                fd = os.open(path, os.O_RDWR | os.O_APPEND)
+                self.segments.append(
+                    [int(name[:-6]), os.fstat(fd).st_size, fd])
+        if self.segments:
+            self.truncate_partial(self.segments[-1])
+            self.acked = max(self.acked, self.segments[0][0])
+        self.remove_acked()
+        self.save()
+
+    def truncate_partial(self, segment):
+        """
+        Remove a partly written batch left by a crash
+        """
+        offset, size, fd = segment
+        pos = 0
+        while pos + RECORD.size <= size:
+            (n,) = RECORD.unpack(os.pread(fd, RECORD.size, pos))
+            if pos + RECORD.size + n > size:
+                break
+            pos += RECORD.size + n
+        if pos != size:
+            logging.warning('Discarding %d bytes of a partial batch in %s',
+                            size - pos, self.directory)
+            os.ftruncate(fd, pos)
+            segment[1] = pos
+
+    def end(self):
+        if self.segments:
+            offset, size, fd = self.segments[-1]
+            return offset + size
+        return self.acked
+
+    def size(self):
+        return sum(s[1] for s in self.segments)
+
+    def append(self, payload):
+        """
+        Add a batch, returns False if it was dropped because the spool is
+        full
+        """
+        record = RECORD.pack(len(payload)) + payload
+        with self.lock:
+            if self.size() + len(record) > self.max_size:
+                if not self.n_dropped:
+                    logging.error('Agent spool %s is full, dropping events',
+                                  self.directory)
+                self.n_dropped += 1
+                return False
+            if not self.segments or self.segments[-1][1] >= (
+                    self.segment_size):
+                offset = self.end()
+                fd = os.open(self.segment_path(offset),
+                             os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+                self.segments.append([offset, 0, fd])
+            segment = self.segments[-1]
+            os.write(segment[2], record)
+            segment[1] += len(record)
+        return True
+
+    def segment_path(self, offset):
+        return os.path.join(self.directory, '%d.spool' % offset)
+
+    def read(self, offset):
+        """
+        Returns the payload of the batch at offset
+        """
+        with self.lock:
+            i = bisect.bisect_right([s[0] for s in self.segments], offset) - 1
+            start, size, fd = self.segments[i]
+            (n,) = RECORD.unpack(os.pread(fd, RECORD.size, offset - start))
+            return os.pread(fd, n, offset - start + RECORD.size)
+
+    def next_offset(self, offset, payload):
+        return offset + RECORD.size + len(payload)
+
+    def ack(self, offset):
+        with self.lock:
+            if offset <= self.acked:
+                return
+            self.acked = min(offset, self.end())
+            self.dirty = True
+            self.remove_acked()
+
+    def remove_acked(self):
+        # The current segment is kept for appending
+        while len(self.segments) > 1 and (
+                self.segments[1][0] <= self.acked):
+            offset, size, fd = self.segments.pop(0)
+            os.close(fd)
+            os.remove(self.segment_path(offset))
+
+    def set_conditions(self, conditions):
+        with self.lock:
+            self.conditions = conditions
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            state = {'id': self.id, 'acked': self.acked,
+                     'conditions': self.conditions}
+            self.dirty = False
+        tmp = self.statefile + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.statefile)
+
+    def status(self):
+        return 'spool %.1f MiB unacknowledged  dropped batches %d' % (
+            (self.end() - self.acked) / 1024.0 / 1024, self.n_dropped)
+
+
+class AgentChannel(workers.EventChannel):
+
+    def __init__(self, address, name, spool, token=None, max_batch=100,
+                 interval=0.1, max_inflight=4 * 1024 * 1024):
+        """
+        Sends events from an agent to the collector. Batches are written to
+        the spool first and sent from there, so events are kept while the
+        collector can't be reached and sent again if they weren't
+        acknowledged.
+
+        address: host:port or Unix socket path of the collector
+        name: Identifies the agent to the collector
+        token: Optional shared secret, must match the collector's
+        max_inflight: Maximum bytes of unacknowledged batches sent
+        """
+        super(AgentChannel, self).__init__(None, max_batch, interval)
+        self.address = address
+        self.name = name
+        self.spool = spool
+        self.token = token
+        self.max_inflight = max_inflight
+        self.save_interval = 1
+        # Called with the collector's aggregator conditions
+        self.config_cb = None
+        self.connected = None
+        self.n_connects = 0
+        self.min_backoff = 1
+        self.max_backoff = 60
+
+    def _flush(self):
+        if self.events:
+            self.spool.append(encode(self.events))
+            self.events = []
+
+    def start(self):
+        """
+        Write queued events to the spool and periodically save the
+        acknowledged offset
+        """
+        last_save = time.time()
+        while self._alive:
+            time.sleep(self.interval)
+            self.flush()
+            if self.spool.dirty and time.time() - last_save >= (
+                    self.save_interval):
+                self.spool.save()
+                last_save = time.time()
+
+    def run(self):
+        """
+        Connect to the collector and send spooled batches, reconnecting
+        with increasing delays if the connection fails
+        """
+        backoff = self.min_backoff
+        while self._alive:
+            try:
+                sock = connect(self.address)
+            except OSError as e:
+                if backoff == self.min_backoff:
+                    logging.error('Failed to connect to collector %s: %s',
+                                  self.address, e)
+            else:
+                try:
+                    self.session(sock)
+                except (OSError, ValueError, zlib.error) as e:
+                    logging.error('Lost connection to collector %s: %s',
+                                  self.address, e)
+                finally:
+                    self.connected = None
+                    sock.close()
+                backoff = self.min_backoff
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def session(self, sock):
+        send_frame(sock, HELLO, self.spool.acked, encode({
+            'agent': self.name, 'spool': self.spool.id,
+            'token': self.token}))
+        kind, offset, payload = read_frame(sock)
+        if kind != CONFIG:
+            raise ValueError('Expected configuration, got frame type %d' % (
+                kind))
+        # The collector may have handled batches whose acknowledgement
+        # was lost
+        self.spool.ack(offset)
+        self.configure(decode(payload))
+        sock.settimeout(None)
+        self.connected = time.time()
+        self.n_connects += 1
+        logging.info('Connected to collector %s, %d bytes to send',
+                     self.address, self.spool.end() - self.spool.acked)
+
+        sent = self.spool.acked
+        while self._alive:
+            sent = max(sent, self.spool.acked)
+            while (sent < self.spool.end() and
+                   sent - self.spool.acked < self.max_inflight):
+                payload = self.spool.read(sent)
+                send_frame(sock, BATCH, sent, payload)
+                sent = self.spool.next_offset(sent, payload)
+            r, w, x = select.select([sock], [], [], self.interval)
+            if not r:
+                continue
+            kind, offset, payload = read_frame(sock)
+            if kind == ACK:
+                self.spool.ack(offset)
+            elif kind == CONFIG:
+                self.configure(decode(payload))
+            else:
+                raise ValueError('Unexpected frame type %d' % kind)
+
+    def configure(self, config):
+        conditions = config['conditions']
+        if conditions != self.spool.conditions:
+            self.spool.set_conditions(conditions)
+        if self.config_cb:
+            self.config_cb(conditions)
+
+    def stop(self):
+        self._alive = False
+        self.flush()
+        self.spool.save()
+
+    def status(self):
+        if self.connected:
+            m = 'connected to %s for %ds' % (
+                self.address, time.time() - self.connected)
+        else:
+            m = 'not connected to %s' % self.address
+        return 'Agent %s: %s  %s' % (self.name, m, self.spool.status())
+
+
+class AgentSink(workers.RemoteSink):
+    """
+    Stands in for a collector's AggregateAlerter in an agent. Reportable
+    events are sent with the aggregator's conditions instead of an index,
+    since batches may be spooled across changes to the collector's
+    configuration.
+    """
+
+    def log_received(self, event):
+        if self.reportable(event):
+            self.channel.send(('match', self.conditions, event.level,
+                               event.source, event.body, event.timestamp))
+
+
+class AgentBot(workers.WorkerBot):
+    """
+    Stands in for OmeroFenton in an agent, messages are forwarded to the
+    collector
+    """
+
+    def __init__(self, channel):
+        super(AgentBot, self).__init__(channel, [])
+        self.disks = None
+        self.conditions = None
+        self.lock = threading.Lock()
+
+    def add_reporter(self, reporter):
+        with self.lock:
+            super(AgentBot, self).add_reporter(reporter)
+
+    def remove_reporter(self, reporter):
+        with self.lock:
+            super(AgentBot, self).remove_reporter(reporter)
+
+    def set_conditions(self, conditions):
+        """
+        Replace the sinks when the collector's email alert conditions
+        change
+        """
+        with self.lock:
+            if conditions == self.conditions:
+                return
+            sinks = [AgentSink(i, c, self.channel)
+                     for (i, c) in enumerate(conditions)]
+            for r in self.reporters:
+                if hasattr(r, 'add_sink'):
+                    for s in self.sinks:
+                        r.remove_sink(s)
+                    for s in sinks:
+                        r.add_sink(s)
+            self.sinks = sinks
+            self.conditions = conditions
+
+    def status(self):
+        return [self.channel.status()] + [r.status() for r in self.reporters]
+
+
+def agent_main(maincfg, logcfgs, add_log_reporter, add_disk_reporter,
+               logtypes):
+    """
+    Run as an agent: tail the log files and check disk space, sending
+    messages and reportable events to the collector at collector_address
+
+    add_log_reporter, add_disk_reporter: Functions (logtype, bot, cfg,
+      maincfg) which create a reporter
+    logtypes: Log reporter section types
+    """
+    address = getcfgkey('collector_address', maincfg)
+    name = getcfgkey('agent_name', maincfg) or socket.gethostname()
+    spool = Spool(
+        getcfgkey('agent_spool', maincfg) or 'fenton-agent-spool',
+        getcfgkey('agent_spool_max_mb', maincfg, cast=float) or 256)
+    channel = AgentChannel(address, name, spool,
+                           getcfgkey('collector_token', maincfg))
+    bot = AgentBot(channel)
+    # Until the collector sends its current conditions
+    bot.set_conditions(spool.conditions or [])
+    channel.config_cb = bot.set_conditions
+    workers.setup_tailing(
+        bot, maincfg, getcfgkey('checkpoint_file', maincfg))
+
+    for logtype in logcfgs.keys():
+        for cfg in logcfgs[logtype]:
+            if logtype == 'diskmonitor':
+                add_disk_reporter(logtype, bot, cfg, maincfg)
+            elif logtype in logtypes:
+                add_log_reporter(logtype, bot, cfg, maincfg)
+            else:
+                logging.info('Ignoring [%s %s], handled by the collector',
+                             logtype, cfg['name'])
+
+    for target in (channel.start, channel.run):
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+
+    status_interval = 10
+
+    def send_status():
+        while True:
+            channel.send(('status', bot.status()))
+            time.sleep(status_interval)
+
+    t = threading.Thread(target=send_status)
+    t.daemon = True
+    t.start()
+
+    def shutdown_handler(signal=None, frame=None):
+        logging.info('Shut-down signal received')
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGINT, shutdown_handler)
+    signal.signal(signal.SIGTERM, shutdown_handler)
+
+    logging.info('Agent %s sending to collector %s', name, address)
+    try:
+        if bot.tailwatcher:
+            bot.tailwatcher.start()
+        else:
+            while True:
+                time.sleep(status_interval)
+    except SystemExit:
+        pass
+    finally:
+        if bot.tailwatcher:
+            bot.tailwatcher.stop()
+        if bot.disks:
+            bot.disks.stop()
+        if bot.checkpoints:
+            bot.checkpoints.flush()
+        channel.stop()
+
+
+class Agent(object):
+
+    __slots__ = ('name', 'spool', 'acked', 'address', 'connected',
+                 'disconnected', 'n_batches', 'n_events', 'status',
+                 'status_ts', 'lock')
+
+    def __init__(self, name, spool):
+        self.name = name
+        self.spool = spool
+        # Batches before this offset in the agent's spool have been handled
+        self.acked = 0
+        self.address = None
+        self.connected = None
+        self.disconnected = None
+        self.n_batches = 0
+        self.n_events = 0
+        self.status = []
+        self.status_ts = None
+        self.lock = threading.Lock()
+
+
+class Collector(workers.EventDispatcher):
+
+    def __init__(self, bot, address, token=None):
+        """
+        Receives messages and reportable events from agents on other hosts
+        and handles them as if they came from a worker process: Slack
+        output, deduplication, the global rate limit and aggregators all
+        run here. Batches are acknowledged by their offset in the agent's
+        spool, batches which are sent again after a lost acknowledgement
+        are ignored.
+
+        bot: The collecting OmeroFenton
+        address: host:port or Unix socket path to listen on
+        token: Optional shared secret, agents must send the same token
+        """
+        super(Collector, self).__init__(bot)
+        self.address = address
+        self.token = token
+        # name: Agent
+        self.agents = {}
+        self.lock = threading.Lock()
+        self.sock = None
+        # Sockets of connected agents
+        self.connections = set()
+        self.n_duplicates = 0
+        self._alive = True
+
+    def conditions(self):
+        """
+        The distinct conditions of the aggregators
+        """
+        conditions = []
+        for a in self.bot.aggregators:
+            c = [list(t) for t in a.conditions]
+            if c not in conditions:
+                conditions.append(c)
+        return conditions
+
+    def dispatch(self, event):
+        if event[0] != 'match':
+            super(Collector, self).dispatch(event)
+            return
+        self.n_events += 1
+        conditions, level, name, msg, timestamp = event[1:]
+        key = condition_key(conditions)
+        e = None
+        for a in self.bot.aggregators:
+            if condition_key(a.conditions) == key:
+                if e is None:
+                    e = LogEvent(msg, source=name, level=level,
+                                 timestamp=timestamp)
+                a.add_event(e)
+
+    def get_agent(self, name, spool, acked, address):
+        with self.lock:
+            agent = self.agents.get(name)
+            if agent is None or agent.spool != spool:
+                # New, or its spool was deleted so offsets start again
+                agent = Agent(name, spool)
+                agent.acked = acked
+                self.agents[name] = agent
+            agent.address = address
+            agent.connected = time.time()
+        return agent
+
+    def receive(self, agent, offset, payload):
+        with agent.lock:
+            if offset < agent.acked:
+                # Sent again after a lost acknowledgement
+                self.n_duplicates += 1
+                return
+            events = decode(payload)
+            for event in events:
+                if event[0] == 'status':
+                    agent.status = ['%s/%s' % (agent.name, s)
+                                    for s in event[1]]
+                    agent.status_ts = time.time()
+                else:
+                    if event[0] in ('log', 'match'):
+                        # Sections on different agents may have the same
+                        # name
+                        event = list(event)
+                        event[3] = '%s/%s' % (agent.name, event[3])
+                    self.dispatch(event)
+            agent.acked = offset + RECORD.size + len(payload)
+            agent.n_batches += 1
+            agent.n_events += len(events)
+
+    def handle(self, sock, peer):
+        agent = None
+        with self.lock:
+            self.connections.add(sock)
+        try:
+            sock.settimeout(30)
+            kind, offset, payload = read_frame(sock)
+            if kind != HELLO:
+                raise ValueError('Expected hello, got frame type %d' % kind)
+            hello = decode(payload)
+            if self.token and not hmac.compare_digest(
+                    str(hello.get('token', '')).encode(),
+                    self.token.encode()):
+                raise ValueError('Invalid token from agent %s' % (
+                    hello.get('agent')))
+            agent = self.get_agent(
+                hello['agent'], hello['spool'], offset, peer)
+            logging.info('Agent %s connected from %s', agent.name, peer)
+            conditions = self.conditions()
+            send_frame(sock, CONFIG, agent.acked,
+                       encode({'conditions': conditions}))
+            sock.settimeout(None)
+            checked = time.time()
+            while self._alive:
+                r, w, x = select.select([sock], [], [], 1)
+                if r:
+                    kind, offset, payload = read_frame(sock)
+                    if kind != BATCH:
+                        raise ValueError('Unexpected frame type %d' % kind)
+                    self.receive(agent, offset, payload)
+                    send_frame(sock, ACK, agent.acked)
+                if time.time() - checked >= 1:
+                    # The configuration has been reloaded
+                    checked = time.time()
+                    new = self.conditions()
+                    if new != conditions:
+                        conditions = new
+                        send_frame(sock, CONFIG, agent.acked,
+                                   encode({'conditions': conditions}))
+        except (OSError, ValueError, KeyError, zlib.error) as e:
+            if self._alive:
+                logging.error('Agent %s: %s', agent.name if agent else peer,
+                              e)
+        finally:
+            with self.lock:
+                self.connections.discard(sock)
+            sock.close()
+            if agent:
+                agent.connected = None
+                agent.disconnected = time.time()
+
+    def start(self):
+        self.sock = listen(self.address)
+        logging.info('Collector listening on %s', self.address)
+        while self._alive:
+            try:
+                sock, peer = self.sock.accept()
+            except OSError as e:
+                if self._alive:
+                    logging.error('Collector failed to accept: %s', e)
+                    time.sleep(1)
+                continue
+            if isinstance(peer, tuple):
+                peer = '%s:%d' % peer[:2]
+            t = threading.Thread(target=self.handle,
+                                 args=(sock, peer or self.address))
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        self._alive = False
+        with self.lock:
+            connections = list(self.connections)
+        for sock in connections:
+            # Handled batches which haven't been acknowledged are resent
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.sock:
+            # Closing alone doesn't interrupt accept() in another thread,
+            # which would keep listening
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            family, addr = parse_address(self.address)
+            if family == socket.AF_UNIX:
+                try:
+                    os.remove(addr)
+                except OSError:
+                    pass
+
+    def status(self):
+        lines = []
+        now = time.time()
+        for agent in sorted(self.agents.values(), key=lambda a: a.name):
+            if agent.connected:
+                state = 'connected from %s for %ds' % (
+                    agent.address, now - agent.connected)
+            else:
+                state = 'disconnected for %ds' % (now - agent.disconnected)
+            lines.append('Agent %s: %s  batches %d  events %d' % (
+                agent.name, state, agent.n_batches, agent.n_events))
+            lines.extend(agent.status)
+        m = ('Collector %s: agents %d  events %d  duplicates %d  '
+             'suppressed %d') % (
+            self.address, len(self.agents), self.n_events, self.n_duplicates,
+            self.n_suppressed)
+        if lines:
+            m += '\n' + '\n'.join(lines)
+        logging.debug('status: %s', m)
+        return m
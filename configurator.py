@@ -4,6 +4,8 @@
 import logging
 import argparse
 import configparser
+import os
+import threading
 
 
 maincfgname = 'main'
@@ -30,15 +32,38 @@ def configure():
         '--emailtest', help='Send a test email alert and exit',
         default=False, action='store_true')
 
+    # Scan existing log files
+    parser.add_argument(
+        '--backfill', help='Scan existing and rotated log files, print a '
+        'summary and exit', default=False, action='store_true')
+    parser.add_argument(
+        '--backfill-processes', type=int, default=None,
+        help='Number of processes used to scan files (default: CPU count)')
+    parser.add_argument(
+        '--follow', help='After --backfill continue tailing the log files '
+        'from where the scan finished', default=False, action='store_true')
+
     args = parser.parse_args()
+    maincfg, logcfgs = read_config(args.config)
+    return args, maincfg, logcfgs
+
 
+def read_config(filename):
+    """
+    Returns (maincfg, logcfgs), logcfgs is a dict of logtype: list of
+    section dicts
+    """
     config = configparser.SafeConfigParser()
     config.optionxform = str
-    if not config.read(args.config):
-        raise Exception('Invalid configuration file: %s' % args.config)
+    if not config.read(filename):
+        raise Exception('Invalid configuration file: %s' % filename)
 
-    mainreq = ['botname', 'token', 'channel', 'levels']
     maincfg = dict(config.items(maincfgname))
+    if 'collector_address' in maincfg:
+        # An agent, the collector posts to Slack
+        mainreq = ['levels']
+    else:
+        mainreq = ['botname', 'token', 'channel', 'levels']
     if any(k not in maincfg for k in mainreq):
         raise Exception('[%s] must contain keys: %s' % (maincfgname, mainreq))
 
@@ -58,7 +83,87 @@ def configure():
         d['name'] = logname
         logcfgs[logtype].append(d)
 
-    return args, maincfg, logcfgs
+    return maincfg, logcfgs
+
+
+def diff_config(old, new):
+    """
+    Compare two logcfgs, returns (added, removed, changed) lists of
+    (logtype, name) sections
+    """
+    def sections(logcfgs):
+        return dict(((logtype, cfg['name']), cfg)
+                    for logtype in logcfgs for cfg in logcfgs[logtype])
+
+    olds = sections(old)
+    news = sections(new)
+    added = [k for k in sorted(news) if k not in olds]
+    removed = [k for k in sorted(olds) if k not in news]
+    changed = [k for k in sorted(news) if k in olds and news[k] != olds[k]]
+    return added, removed, changed
+
+
+class ConfigWatcher(object):
+
+    def __init__(self, filename, reload_cb, interval=None):
+        """
+        Calls reload_cb(maincfg, logcfgs) with the new configuration when
+        request() is called (e.g. from a SIGHUP handler), or if interval is
+        set when the file's modification time changes. If the file can't
+        be parsed the current configuration is kept.
+        """
+        self.filename = filename
+        self.reload_cb = reload_cb
+        self.interval = interval
+        self._event = threading.Event()
+        self._alive = True
+        self.mtime = self.get_mtime()
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return None
+
+    def request(self):
+        """
+        Request a reload, safe to call from a signal handler
+        """
+        self._event.set()
+
+    def start(self):
+        while True:
+            requested = self._event.wait(self.interval)
+            self._event.clear()
+            if not self._alive:
+                break
+            mtime = self.get_mtime()
+            if not requested and mtime == self.mtime:
+                continue
+            self.mtime = mtime
+            logging.info('Reloading configuration: %s', self.filename)
+            try:
+                maincfg, logcfgs = read_config(self.filename)
+                self.reload_cb(maincfg, logcfgs)
+            except Exception:
+                logging.exception('Failed to reload configuration %s',
+                                  self.filename)
+
+    def stop(self):
+        self._alive = False
+        self._event.set()
+
+
+def parse_bool(value):
+    """
+    Parse a boolean option: true/false, yes/no, on/off or 1/0
+    """
+    v = value.strip().lower()
+    if v in ('true', 'yes', 'on', '1'):
+        return True
+    if v in ('false', 'no', 'off', '0'):
+        return False
+    raise Exception('Invalid boolean: %s' % value)
 
 
 def getcfgkey(key, *cfgs, **kwargs):
@@ -0,0 +1,124 @@
+import collections
+import hashlib
+import logging
+import re
+import threading
+import time
+
+
+NORMALISE_RES = [
+    # Timestamps: 2020-01-31 12:34:56,789 and Jan 31, 2020 1:23:45 PM
+    re.compile(r'\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:[,.]\d+)?'),
+    re.compile(r'[A-Z][a-z][a-z] \d\d?, \d{4} \d?\d:\d\d:\d\d(?: [AP]M)?'),
+    # UUIDs
+    re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+               r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'),
+    # Hex IDs and addresses
+    re.compile(r'0x[0-9a-fA-F]+'),
+    # Numeric IDs, including thread numbers such as Server-12
+    re.compile(r'\d+'),
+]
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalise(msg, maxlen=4096):
+    """
+    Remove the parts of a log message that vary between repeats of the
+    same error. Only the first maxlen characters are used.
+    """
+    msg = msg[:maxlen]
+    for r in NORMALISE_RES:
+        msg = r.sub('#', msg)
+    return WHITESPACE_RE.sub(' ', msg).strip()
+
+
+def fingerprint(msg):
+    b = normalise(msg).encode('utf-8', 'replace')
+    return hashlib.blake2b(b, digest_size=8).hexdigest()
+
+
+class Fingerprint(object):
+
+    __slots__ = ('fp', 'count', 'names', 'first', 'last', 'posted')
+
+    def __init__(self, fp, name, now):
+        self.fp = fp
+        self.count = 1
+        self.names = set([name])
+        self.first = now
+        self.last = now
+        # Set by the output once the alert has been sent
+        self.posted = None
+
+    def summary(self):
+        return 'Seen %d times in %d file%s, last at %s' % (
+            self.count, len(self.names), '' if len(self.names) == 1 else 's',
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.last)))
+
+
+class Deduplicator(object):
+
+    def __init__(self, ttl=3600, max_size=10000):
+        """
+        A table of recently shown message fingerprints shared between
+        log reporters
+
+        ttl: A message is a duplicate if the same fingerprint was shown
+          within this many seconds, repeats don't extend this
+        max_size: Maximum number of fingerprints, the oldest are discarded
+          first
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.table = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.n_duplicates = 0
+
+    def seen(self, msg, name):
+        """
+        Returns (duplicate, Fingerprint). A message which isn't a duplicate
+        is only recorded when add() is called once it has been queued, so
+        repeats of a message which was rate limited or dropped are shown.
+        """
+        fp = fingerprint(msg)
+        now = time.time()
+        with self.lock:
+            self.expire(now)
+            entry = self.table.get(fp)
+            if entry:
+                entry.count += 1
+                entry.names.add(name)
+                entry.last = now
+                self.n_duplicates += 1
+                return True, entry
+        return False, Fingerprint(fp, name, now)
+
+    def add(self, entry):
+        """
+        Record a Fingerprint returned by seen() after its message has been
+        queued for output
+        """
+        now = time.time()
+        with self.lock:
+            if entry.fp in self.table:
+                # Another copy was queued first
+                return
+            entry.first = now
+            self.table[entry.fp] = entry
+            if len(self.table) > self.max_size:
+                self.table.popitem(last=False)
+
+    def expire(self, now):
+        # Ordered by when they were added so only the oldest need to be
+        # checked
+        while self.table:
+            fp, entry = next(iter(self.table.items()))
+            if now - entry.first < self.ttl:
+                break
+            del self.table[fp]
+
+    def status(self):
+        m = 'Duplicates: %d  fingerprints %d' % (
+            self.n_duplicates, len(self.table))
+        logging.debug('status: %s', m)
+        return m
@@ -0,0 +1,148 @@
+import glob
+import logging
+import os
+import re
+import threading
+import time
+
+
+# Rotated or compressed files, e.g. Blitz-0.log.1, Blitz-0.log.2.gz
+ROTATED_RE = re.compile(r'\.(\d+|gz|bz2|xz|\d{4}-\d\d-\d\d)$')
+
+
+def is_pattern(filename):
+    """
+    True if a log section's file is a glob or a directory
+    """
+    return glob.has_magic(filename) or filename.endswith(os.sep) or (
+        os.path.isdir(filename))
+
+
+def get_pattern(filename):
+    """
+    A directory matches all files in it
+    """
+    if not glob.has_magic(filename) and (
+            filename.endswith(os.sep) or os.path.isdir(filename)):
+        return os.path.join(filename, '*')
+    return filename
+
+
+def expand(logcfg):
+    """
+    Returns a log section for each file matching logcfg['file'], rotated
+    files are excluded. Each is named after the section and the file,
+    e.g. "example-server Blitz-0.log".
+    """
+    cfgs = []
+    for path in sorted(glob.glob(get_pattern(logcfg['file']))):
+        if ROTATED_RE.search(path) or not os.path.isfile(path):
+            continue
+        cfg = dict(logcfg)
+        cfg['file'] = path
+        cfg['name'] = '%s %s' % (logcfg['name'], os.path.basename(path))
+        cfgs.append(cfg)
+    return cfgs
+
+
+class LogDiscovery(object):
+
+    def __init__(self, logtype, logcfg, maincfg, bot, add_log_reporter,
+                 rescan_interval=60):
+        """
+        Tails all files matching a glob or in a directory, adding a log
+        reporter for each new file. New files are found by watching the
+        directory if the bot's tailwatcher supports it, and by rescanning
+        every rescan_interval seconds. Reporters of files which have been
+        missing for rescan_interval seconds are removed.
+
+        add_log_reporter: Function (logtype, bot, cfg, maincfg) which
+          creates a log reporter
+        """
+        self.logtype = logtype
+        self.logcfg = logcfg
+        self.maincfg = maincfg
+        self.bot = bot
+        self.add_log_reporter = add_log_reporter
+        self.rescan_interval = rescan_interval
+        self.name = logcfg['name']
+        self.pattern = get_pattern(logcfg['file'])
+        # path: reporter
+        self.reporters = {}
+        # path: time.time() when a tailed file was first found missing
+        self.missing = {}
+        self.lock = threading.Lock()
+        self._rescan = threading.Event()
+        self._alive = True
+
+    def rescan(self, name=None):
+        """
+        Called when a file is created in the directory
+        """
+        self._rescan.set()
+
+    def scan(self):
+        now = time.time()
+        with self.lock:
+            cfgs = expand(self.logcfg)
+            for cfg in cfgs:
+                self.missing.pop(cfg['file'], None)
+                if cfg['file'] in self.reporters or not self._alive:
+                    continue
+                logging.info('Found %s: %s', self.name, cfg['file'])
+                try:
+                    self.reporters[cfg['file']] = self.add_log_reporter(
+                        self.logtype, self.bot, cfg, self.maincfg)
+                except Exception:
+                    logging.exception('Failed to tail %s', cfg['file'])
+            # A file which is being rotated may briefly be missing, and the
+            # reporter reads the rest of the rotated file
+            found = set(cfg['file'] for cfg in cfgs)
+            removed = []
+            for path in list(self.reporters):
+                if path in found:
+                    continue
+                since = self.missing.setdefault(path, now)
+                if now - since >= self.rescan_interval:
+                    logging.info('Removed %s: %s', self.name, path)
+                    removed.append(self.reporters.pop(path))
+                    del self.missing[path]
+        for r in removed:
+            self.bot.remove_reporter(r)
+
+    def child_config(self, reporter):
+        """
+        The configuration of a reporter created by this
+        """
+        cfg = dict(self.logcfg)
+        cfg['file'] = reporter.file
+        cfg['name'] = reporter.name
+        return cfg
+
+    def start(self):
+        watcher = getattr(self.bot, 'tailwatcher', None)
+        dirname = os.path.dirname(self.pattern) or '.'
+        if watcher and not glob.has_magic(dirname):
+            watcher.watch_directory(dirname, self.rescan)
+        while self._alive:
+            self.scan()
+            self._rescan.wait(self.rescan_interval)
+            self._rescan.clear()
+
+    def stop(self):
+        """
+        Stop discovering files and remove the reporters
+        """
+        with self.lock:
+            self._alive = False
+            reporters = list(self.reporters.values())
+            self.reporters = {}
+        self._rescan.set()
+        for r in reporters:
+            self.bot.remove_reporter(r)
+
+    def status(self):
+        m = '%s: %d files matching %s' % (
+            self.name, len(self.reporters), self.pattern)
+        logging.debug('status: %s', m)
+        return m
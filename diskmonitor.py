@@ -1,35 +1,118 @@
+import collections
+import concurrent.futures
 import os
+import threading
 import time
 import logging
 
 
+def get_disk_space(path, superuser=False):
+    """
+    Returns (device, free_mb, total_mb) for the filesystem containing path
+    """
+    def block2mb(b):
+        return float(b) * s.f_bsize / 1024 / 1024
+
+    dev = os.stat(path).st_dev
+    s = os.statvfs(path)
+    total_mb = block2mb(s.f_blocks)
+    if superuser:
+        free_mb = block2mb(s.f_bfree)
+    else:
+        free_mb = block2mb(s.f_bavail)
+
+    logging.debug('%s dev:%d free_mb:%f total_mb:%f', path, dev, free_mb,
+                  total_mb)
+    return dev, free_mb, total_mb
+
+
+def format_mb(n):
+    if n > 1024:
+        return '%.1f GiB' % (n / 1024.0)
+    return '%.1f MiB' % n
+
+
+def fill_rate(samples):
+    """
+    Least squares fit of free space against time, returns the rate space is
+    being used in MiB per second (negative if it's being freed)
+    """
+    n = len(samples)
+    mt = sum(t for (t, f) in samples) / n
+    mf = sum(f for (t, f) in samples) / n
+    var = sum((t - mt) ** 2 for (t, f) in samples)
+    if not var:
+        return 0.0
+    return -sum((t - mt) * (f - mf) for (t, f) in samples) / var
+
+
 class DiskMonitor(object):
 
-    def __init__(self, path, rep, warnlevels, hys=512, delay=60):
+    def __init__(self, path, rep, warnlevels, hys=512, full_warn_hours=None,
+                 window=1800):
+        """
+        Warns when free space falls below each of warnlevels (MiB), or is
+        predicted to run out within full_warn_hours. Free space is sampled
+        by a DiskSampler.
+
+        window: Seconds of samples used to calculate the fill rate
+        """
         self.path = path
         self.rep = rep
         self.warnlevels = sorted(warnlevels, reverse=True)
         self.hysteresis = hys
-        self.delay = delay
+        self.full_warn_hours = full_warn_hours
+        self.window = window
         self.state = 0
+        self.full_warned = False
+        # Device of the filesystem, paths on the same device are only
+        # sampled once
+        self.dev = None
+        # From the last check
+        self.free_mb = None
+        self.total_mb = None
+        self.sampled = None
+        # (time, free_mb)
+        self.samples = collections.deque()
+        # MiB/s, None until there are enough samples
+        self.rate = None
+        self.not_responding = None
 
-    def get_disk_space(self, superuser=False):
-        def block2mb(b):
-            return float(b) * s.f_bsize / 1024 / 1024
-
-        s = os.statvfs(self.path)
-        total_mb = block2mb(s.f_blocks)
-        if superuser:
-            free_mb = block2mb(s.f_bfree)
-        else:
-            free_mb = block2mb(s.f_bavail)
+    def update(self, now, free_mb, total_mb):
+        if self.not_responding:
+            self.rep.log_message('Disk space: %s is responding again' % (
+                self.path), name=self.path)
+            self.not_responding = None
+        self.free_mb = free_mb
+        self.total_mb = total_mb
+        self.sampled = now
+        self.samples.append((now, free_mb))
+        while self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+        # Require samples from at least a sixth of the window
+        if now - self.samples[0][0] >= self.window / 6.0:
+            self.rate = fill_rate(self.samples)
+        self.check_space(free_mb, total_mb)
+        self.check_fill_rate(free_mb, total_mb)
 
-        logging.debug('free_mb:%f total_mb:%f', free_mb, total_mb)
-        return free_mb, total_mb
+    def timed_out(self, started):
+        """
+        Called when sampling has not completed after the timeout
+        """
+        if not self.not_responding:
+            self.not_responding = started
+            self.rep.log_message(
+                'DISK SPACE WARNING: %s not responding, check started %s' % (
+                    self.path, time.strftime(
+                        '%H:%M:%S', time.localtime(started))),
+                name=self.path)
 
-    def check_space(self):
-        free_mb, total_mb = self.get_disk_space()
+    def hours_to_full(self):
+        if self.rate is None or self.rate <= 0:
+            return None
+        return self.free_mb / self.rate / 3600
 
+    def check_space(self, free_mb, total_mb):
         newstate = self.state
         for n in range(len(self.warnlevels) - 1, -1, -1):
             wl = self.warnlevels[n]
@@ -50,31 +133,149 @@ class DiskMonitor(object):
             self.notify(newstate, free_mb, total_mb)
         self.state = newstate
 
-    def format_free_space(self, free_mb, total_mb):
-        def fmt(n):
-            if n > 1024:
-                return '%.1f GiB' % (n / 1024.0)
-            return '%.1f MiB' % n
+    def check_fill_rate(self, free_mb, total_mb):
+        if not self.full_warn_hours:
+            return
+        hours = self.hours_to_full()
+        if hours is not None and hours < self.full_warn_hours:
+            if not self.full_warned:
+                self.full_warned = True
+                self.notify(1, free_mb, total_mb)
+        elif hours is None or hours > 2 * self.full_warn_hours:
+            # Hysteresis
+            self.full_warned = False
 
+    def format_free_space(self, free_mb, total_mb):
         m = '%s: %s of %s (%.1f%%) free' % (
-            self.path, fmt(free_mb), fmt(total_mb), free_mb * 100 / total_mb)
+            self.path, format_mb(free_mb), format_mb(total_mb),
+            free_mb * 100 / total_mb)
         return m
 
+    def format_fill_rate(self):
+        hours = self.hours_to_full()
+        if hours is None:
+            return ''
+        return ', filling at %s/min, full in %.1f hours' % (
+            format_mb(self.rate * 60), hours)
+
     def notify(self, state, free_mb, total_mb):
         emph = ''
         if state > 0:
             emph = ('*' * 50 + '\n') * state
         mfree = self.format_free_space(free_mb, total_mb)
-        m = '%sDISK SPACE WARNING: %s\n%s' % (emph, mfree, emph)
-        self.rep.log_message(m)
+        m = '%sDISK SPACE WARNING: %s%s\n%s' % (
+            emph, mfree, self.format_fill_rate(), emph)
+        self.rep.log_message(m, name=self.path)
+
+    def status(self):
+        if self.sampled is None:
+            m = '%s: not checked yet' % self.path
+        else:
+            m = self.format_free_space(self.free_mb, self.total_mb)
+            m += self.format_fill_rate()
+            m += ' (%ds ago)' % (time.time() - self.sampled)
+        if self.not_responding:
+            m += ' NOT RESPONDING for %ds' % (
+                time.time() - self.not_responding)
+        return m
+
+
+class DiskSampler(object):
+
+    def __init__(self, interval=5, timeout=10, max_workers=4):
+        """
+        Samples free space for all DiskMonitors. Paths on the same
+        filesystem are only sampled once. statvfs is run in a thread pool
+        since it can hang on an unresponsive network filesystem, status()
+        only uses the last sample.
+
+        interval: Seconds between samples
+        timeout: Monitors are warned if sampling takes longer than this
+        max_workers: Maximum number of concurrent samples, including any
+          which are hanging
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix='diskmonitor')
+        self.monitors = []
+        # key: (future, start time, monitors)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._alive = True
+
+    def add(self, monitor):
+        self.monitors.append(monitor)
+
+    def remove(self, monitor):
+        # Replaced rather than modified as it may be in use by sample()
+        self.monitors = [m for m in self.monitors if m is not monitor]
+
+    def groups(self):
+        """
+        Group monitors by device, monitors which haven't been sampled yet
+        are grouped by path
+        """
+        groups = collections.OrderedDict()
+        for m in self.monitors:
+            key = m.path if m.dev is None else m.dev
+            groups.setdefault(key, []).append(m)
+        return groups
+
+    def sample(self):
+        """
+        Sample all filesystems which aren't already being sampled, wait up
+        to timeout seconds and update their monitors
+        """
+        now = time.time()
+        submitted = []
+        with self.lock:
+            if not self._alive:
+                return
+            for key, monitors in self.groups().items():
+                if key not in self.pending:
+                    future = self.executor.submit(
+                        get_disk_space, monitors[0].path)
+                    self.pending[key] = (future, now, monitors)
+                    submitted.append(future)
+
+        # Don't wait again for samples which have already timed out
+        concurrent.futures.wait(submitted, self.timeout)
+        now = time.time()
+        for key, (future, started, monitors) in list(self.pending.items()):
+            if not future.done():
+                if now - started >= self.timeout:
+                    for m in monitors:
+                        m.timed_out(started)
+                continue
+            del self.pending[key]
+            try:
+                dev, free_mb, total_mb = future.result()
+            except OSError as e:
+                logging.error('Failed to check disk space %s: %s',
+                              monitors[0].path, e)
+                continue
+            for m in monitors:
+                if m.dev is None:
+                    m.dev = dev
+                m.update(now, free_mb, total_mb)
 
     def start(self):
-        while True:
-            self.check_space()
-            time.sleep(self.delay)
+        while self._alive:
+            self.sample()
+            self._wakeup.wait(self.interval)
+
+    def stop(self):
+        """
+        Stop sampling, samples which are hanging are abandoned
+        """
+        with self.lock:
+            self._alive = False
+            self.executor.shutdown(wait=False)
+        self._wakeup.set()
 
     def status(self):
-        m = self.format_free_space(*self.get_disk_space())
+        m = '\n'.join('Disk space: ' + d.status() for d in self.monitors)
         logging.debug('status: %s', m)
-        m = 'Disk space: ' + m
         return m
@@ -0,0 +1,231 @@
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import smtplib
+import threading
+import time
+import uuid
+
+
+class EmailSender(object):
+
+    def __init__(self, smtp, spool=None):
+        """
+        Delivers emails through an SMTP server from a background thread,
+        retrying with exponential backoff so callers never block.
+        A single connection is kept open and shared by all alerters using
+        this server.
+
+        smtp: SMTP server, host or host:port
+        spool: Optional directory, undelivered emails are saved here and
+          resent after a restart
+        """
+        self.smtp = smtp
+        self.spool = spool
+        self.queue = queue.Queue()
+        self.conn = None
+        self.last_used = 0
+
+        # Check an idle connection is still alive before using it, and
+        # close it after idle_timeout seconds
+        self.health_check_interval = 30
+        self.idle_timeout = 300
+        # Seconds to wait for the SMTP server, so a hung server is retried
+        self.timeout = 60
+        self.min_backoff = 10
+        self.max_backoff = 600
+        # Discard undelivered emails older than this many seconds
+        self.max_age = 86400
+
+        # Keeps spooled emails in order when created in the same millisecond
+        self.seq = itertools.count()
+        self.n_sent = 0
+        self.n_failures = 0
+        self.n_discarded = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self._alive = True
+
+        if self.spool:
+            os.makedirs(self.spool, exist_ok=True)
+            self.load_spool()
+            if not self.queue.empty():
+                self.start()
+
+    def load_spool(self):
+        for f in sorted(os.listdir(self.spool)):
+            if not f.endswith('.json'):
+                continue
+            path = os.path.join(self.spool, f)
+            try:
+                with open(path) as fh:
+                    item = json.load(fh)
+                item['spool'] = path
+                self.queue.put(item)
+                logging.info('Loaded undelivered email: %s', path)
+            except (IOError, ValueError) as e:
+                logging.error('Invalid spooled email %s: %s', path, e)
+
+    def save_spool(self, item):
+        name = '%d-%06d-%s.json' % (
+            time.time() * 1000, next(self.seq), uuid.uuid4().hex)
+        path = os.path.join(self.spool, name)
+        try:
+            with open(path + '.tmp', 'w') as fh:
+                json.dump(item, fh)
+            os.replace(path + '.tmp', path)
+            item['spool'] = path
+        except (IOError, OSError) as e:
+            logging.error('Failed to spool email %s: %s', path, e)
+
+    def submit(self, fromaddr, toaddrs, email):
+        """
+        Queue an email for delivery, returns immediately
+        """
+        item = {
+            'fromaddr': fromaddr,
+            'toaddrs': toaddrs,
+            'email': email,
+            'created': time.time(),
+        }
+        if self.spool:
+            self.save_spool(item)
+        self.queue.put(item)
+        self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self):
+        self._alive = False
+
+    def connect(self):
+        now = time.time()
+        if self.conn and now - self.last_used > self.health_check_interval:
+            try:
+                ok = self.conn.noop()[0] == 250
+            except (smtplib.SMTPException, OSError):
+                ok = False
+            if not ok:
+                logging.info('SMTP connection to %s lost', self.smtp)
+                self.disconnect()
+        if not self.conn:
+            logging.debug('Connecting to %s', self.smtp)
+            self.conn = smtplib.SMTP(self.smtp, timeout=self.timeout)
+        self.last_used = now
+        return self.conn
+
+    def disconnect(self):
+        if self.conn:
+            try:
+                self.conn.quit()
+            except Exception:
+                pass
+            self.conn = None
+
+    def send(self, fromaddr, toaddrs, email):
+        """
+        Send an email immediately, raises an exception on failure
+        """
+        try:
+            conn = self.connect()
+            logging.debug('Sending email to %s', toaddrs)
+            conn.sendmail(fromaddr, toaddrs, email)
+        except Exception:
+            self.disconnect()
+            raise
+
+    def deliver(self, item):
+        """
+        Try to deliver an email until it succeeds, it's too old, or the
+        sender is stopped
+        """
+        backoff = self.min_backoff
+        while self._alive:
+            if time.time() - item['created'] > self.max_age:
+                logging.error('Discarding undelivered email to %s from %s',
+                              item['toaddrs'], time.ctime(item['created']))
+                self.n_discarded += 1
+                break
+            try:
+                self.send(item['fromaddr'], item['toaddrs'], item['email'])
+                self.n_sent += 1
+                break
+            except Exception as e:
+                self.n_failures += 1
+                logging.error('Failed to send email via %s, retrying in %ds: '
+                              '%s', self.smtp, backoff, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        else:
+            # Stopped, leave it in the spool
+            return
+
+        if item.get('spool'):
+            try:
+                os.remove(item['spool'])
+            except OSError as e:
+                logging.error('Failed to remove %s: %s', item['spool'], e)
+
+    def run(self):
+        while self._alive:
+            try:
+                item = self.queue.get(timeout=self.health_check_interval)
+            except queue.Empty:
+                if self.conn and (
+                        time.time() - self.last_used > self.idle_timeout):
+                    logging.debug('Closing idle connection to %s', self.smtp)
+                    self.disconnect()
+                continue
+            try:
+                self.deliver(item)
+            finally:
+                self.queue.task_done()
+
+    def join(self, timeout):
+        """
+        Wait up to timeout seconds for all queued emails to be sent,
+        returns True if the queue is empty
+        """
+        end = time.time() + timeout
+        while time.time() < end:
+            if self.queue.unfinished_tasks == 0:
+                return True
+            time.sleep(0.1)
+        return False
+
+    def status(self):
+        m = 'Email %s: queue %d  sent %d  failures %d  discarded %d' % (
+            self.smtp, self.queue.qsize(), self.n_sent, self.n_failures,
+            self.n_discarded)
+        logging.debug('status: %s', m)
+        return m
+
+
+_senders = {}
+_senders_lock = threading.Lock()
+
+
+def get_sender(smtp, spool=None):
+    """
+    Returns the shared EmailSender for an SMTP server and spool directory
+    """
+    with _senders_lock:
+        key = (smtp, spool)
+        if key not in _senders:
+            if spool:
+                spool = os.path.join(spool, re.sub(r'[^\w.-]', '_', smtp))
+            _senders[key] = EmailSender(smtp, spool)
+        return _senders[key]
+
+
+def get_senders():
+    with _senders_lock:
+        return list(_senders.values())
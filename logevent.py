@@ -0,0 +1,136 @@
+import time
+
+
+class TimestampParser(object):
+
+    def __init__(self, fmt):
+        """
+        Converts the date and time groups of a log start match to a Unix
+        time, in local time. Consecutive messages are usually logged in the
+        same second so the conversion of the last second is cached, only
+        the fraction (e.g. ,789) is parsed for each message.
+
+        fmt: time.strptime format of the date and time without the
+          fraction, separated by a space
+        """
+        self.fmt = fmt
+        # ((date, time), Unix time), replaced rather than modified
+        self.cached = (None, None)
+
+    def __call__(self, match):
+        """
+        Returns None if match has no date and time or they can't be parsed
+        """
+        try:
+            date, t = match.group('date', 'time')
+        except IndexError:
+            return None
+        second, sep, frac = t.partition(',')
+        key = (date, second)
+        cached_key, value = self.cached
+        if key != cached_key:
+            try:
+                value = time.mktime(time.strptime('%s %s' % key, self.fmt))
+            except (ValueError, OverflowError):
+                return None
+            self.cached = (key, value)
+        if frac.isdigit():
+            return value + int(frac) / 10.0 ** len(frac)
+        return value
+
+
+class LogEvent(object):
+    """
+    A log message, passed unchanged from pytail.LogParser through the log
+    reporters, rate limiters and sinks to the output queue. The body is
+    only joined from its lines when it's first used, and the alert text is
+    formatted once when it's delivered, so suppressed messages are never
+    formatted.
+    """
+
+    __slots__ = ('source', 'level', 'ts', 'offset', 'nlines', 'match',
+                 'truncate', 'timeparser', '_buffer', '_body', '_text',
+                 '_timestamp')
+
+    def __init__(self, body, match=None, offset=None, nlines=None,
+                 source=None, level=None, ts=None, timestamp=None):
+        """
+        body: The message, or a pytail.MessageBuffer of its lines
+        match: Match of the log start regular expression against the first
+          line, if any
+        offset: Position of the first line in the file, None if unknown
+        nlines: Number of lines in the message
+        source: Name of the log file
+        ts: Time the message was received, default now
+        timestamp: Time the message was logged if it's already known
+        """
+        if isinstance(body, str):
+            self._buffer = None
+            self._body = body
+            if nlines is None:
+                nlines = body.count('\n') or 1
+        else:
+            self._buffer = body
+            self._body = None
+            if nlines is None:
+                nlines = body.nlines
+        self._text = None
+        self.match = match
+        self.offset = offset
+        self.nlines = nlines
+        self.source = source
+        self.level = level
+        self.ts = time.time() if ts is None else ts
+        # Maximum length of the body in the alert text
+        self.truncate = None
+        # A TimestampParser, called with match the first time timestamp is
+        # used
+        self.timeparser = None
+        self._timestamp = timestamp
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = self._buffer.getvalue()
+            self._buffer = None
+        return self._body
+
+    @property
+    def timestamp(self):
+        """
+        Time the message was logged, None if it has no timestamp
+        """
+        if self.timeparser is not None:
+            if self.match is not None:
+                self._timestamp = self.timeparser(self.match)
+            self.timeparser = None
+        return self._timestamp
+
+    def get_time(self, event_time=True):
+        """
+        The time the message was logged if event_time is True and it has a
+        timestamp, otherwise the time it was received
+        """
+        if event_time:
+            t = self.timestamp
+            if t is not None:
+                return t
+        return self.ts
+
+    def format(self, truncate=None):
+        body = self.body
+        if truncate and len(body) > truncate:
+            body = body[:truncate] + '...'
+        return '%s: %s:\n%s' % (self.level, self.source, body)
+
+    @property
+    def text(self):
+        """
+        The alert text, formatted the first time it's used
+        """
+        if self._text is None:
+            self._text = self.format(self.truncate)
+        return self._text
+
+    def __str__(self):
+        return self.text
@@ -0,0 +1,242 @@
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+import dedup
+
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS messages ('
+    'id INTEGER PRIMARY KEY, ts REAL, name TEXT, level TEXT, fp TEXT, '
+    'msg TEXT)',
+    'CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts)',
+    'CREATE INDEX IF NOT EXISTS messages_fp ON messages (fp, ts)',
+]
+
+# Full-text index of messages, trigrams allow substring searches such as
+# OutOfMemory in java.lang.OutOfMemoryError
+FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "msg, content='messages', content_rowid='id', tokenize='trigram')",
+    'CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN '
+    'INSERT INTO messages_fts(rowid, msg) VALUES (new.id, new.msg); END',
+    'CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN '
+    "INSERT INTO messages_fts(messages_fts, rowid, msg) "
+    "VALUES ('delete', old.id, old.msg); END",
+]
+
+DURATION_RE = re.compile(r'^(\d+(?:\.\d+)?)([smhdw]?)$')
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400,
+                  'w': 604800}
+
+
+def parse_duration(value):
+    """
+    Parse a duration such as 30m, 24h or 7d, returns seconds
+    """
+    m = DURATION_RE.match(value.strip().lower())
+    if not m:
+        raise ValueError('Invalid duration: %s' % value)
+    return float(m.group(1)) * DURATION_UNITS[m.group(2)]
+
+
+class MessageIndex(object):
+
+    def __init__(self, filename, retention=7 * 86400, max_size_mb=512,
+                 max_length=16384):
+        """
+        A searchable SQLite store of reportable log messages.
+        Messages are written from a background thread in batches so adding
+        a message only queues it.
+
+        retention: Delete messages older than this many seconds
+        max_size_mb: Delete the oldest messages when the database is larger
+        max_length: Truncate messages to this length
+        """
+        self.filename = filename
+        self.retention = retention
+        self.max_size_mb = max_size_mb
+        self.max_length = max_length
+        self.queue = queue.Queue(maxsize=10000)
+        self.expire_interval = 300
+        self.n_added = 0
+        self.n_dropped = 0
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        self.db = self.connect()
+        self.fts = True
+        with self.db:
+            for s in SCHEMA:
+                self.db.execute(s)
+            try:
+                for s in FTS_SCHEMA:
+                    self.db.execute(s)
+            except sqlite3.OperationalError as e:
+                logging.warning('SQLite full-text search unavailable, '
+                                'searches will be slower: %s', e)
+                self.fts = False
+
+    def connect(self):
+        db = sqlite3.connect(self.filename, check_same_thread=False)
+        # Only takes effect when the database is created
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        return db
+
+    def add(self, name, level, msg):
+        """
+        Queue a message to be indexed, never blocks
+        """
+        try:
+            self.queue.put_nowait((time.time(), name, level, msg))
+        except queue.Full:
+            self.n_dropped += 1
+
+    def write(self, items):
+        rows = [(ts, name, level, dedup.fingerprint(msg),
+                 msg[:self.max_length]) for (ts, name, level, msg) in items]
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT INTO messages (ts, name, level, fp, msg) '
+                'VALUES (?, ?, ?, ?, ?)', rows)
+        self.n_added += len(rows)
+
+    def size_mb(self):
+        """
+        Size of the used pages, excluding free pages
+        """
+        with self.lock:
+            used = (self.db.execute('PRAGMA page_count').fetchone()[0] -
+                    self.db.execute('PRAGMA freelist_count').fetchone()[0])
+            page_size = self.db.execute('PRAGMA page_size').fetchone()[0]
+        return used * page_size / 1024.0 / 1024
+
+    def expire(self):
+        with self.lock, self.db:
+            n = self.db.execute('DELETE FROM messages WHERE ts < ?', (
+                time.time() - self.retention,)).rowcount
+        while self.size_mb() > self.max_size_mb:
+            # Delete the oldest 10% until it fits
+            with self.lock, self.db:
+                total = self.db.execute(
+                    'SELECT COUNT(*) FROM messages').fetchone()[0]
+                if not total:
+                    break
+                n += self.db.execute(
+                    'DELETE FROM messages WHERE id IN (SELECT id FROM '
+                    'messages ORDER BY ts LIMIT ?)',
+                    (max(total // 10, 1),)).rowcount
+                if self.fts:
+                    # Merge the full-text index to drop deleted entries
+                    self.db.execute("INSERT INTO messages_fts(messages_fts) "
+                                    "VALUES ('optimize')")
+        if n:
+            logging.info('Deleted %d old messages from %s', n, self.filename)
+            with self.lock:
+                # execute() only runs a single step, freeing one page
+                self.db.executescript('PRAGMA incremental_vacuum;')
+                self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def start(self):
+        next_expire = 0
+        stopping = False
+        while not stopping:
+            items = [self.queue.get()]
+            try:
+                while len(items) < 1000:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            # None is queued by stop() after the remaining messages
+            stopping = None in items
+            items = [item for item in items if item is not None]
+            try:
+                if items:
+                    self.write(items)
+                if time.time() >= next_expire:
+                    self.expire()
+                    next_expire = time.time() + self.expire_interval
+            except sqlite3.Error as e:
+                logging.error('Failed to index messages: %s', e)
+        with self.lock:
+            self.db.close()
+        self._stopped.set()
+
+    def stop(self, timeout=5):
+        """
+        Write the queued messages and close the database, waits up to
+        timeout seconds
+        """
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._stopped.wait(timeout)
+
+    def search(self, terms, since=None, limit=10):
+        """
+        Find messages containing all terms (case insensitive), newest first.
+        Returns (number of matches, [(ts, name, level, msg)])
+        """
+        where = []
+        params = []
+        if since:
+            where.append('ts >= ?')
+            params.append(time.time() - since)
+        fts_terms = []
+        for t in terms.split():
+            if self.fts and len(t) >= 3:
+                fts_terms.append('"%s"' % t.replace('"', '""'))
+            else:
+                where.append("msg LIKE ? ESCAPE '\\'")
+                params.append('%%%s%%' % re.sub(r'([%_\\])', r'\\\1', t))
+        if fts_terms:
+            where.append(
+                'id IN (SELECT rowid FROM messages_fts WHERE messages_fts '
+                'MATCH ?)')
+            params.append(' AND '.join(fts_terms))
+        sql = 'FROM messages'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        with self.lock:
+            n = self.db.execute('SELECT COUNT(*) ' + sql, params).fetchone()[0]
+            rows = self.db.execute(
+                'SELECT ts, name, level, msg ' + sql +
+                ' ORDER BY ts DESC LIMIT ?', params + [limit]).fetchall()
+        return n, rows
+
+    def top(self, since=None, levels=None, limit=10):
+        """
+        The most frequent messages by fingerprint.
+        Returns [(count, last ts, names, level, msg)]
+        """
+        where = []
+        params = []
+        if since:
+            where.append('ts >= ?')
+            params.append(time.time() - since)
+        if levels:
+            where.append('level IN (%s)' % ','.join('?' * len(levels)))
+            params.extend(levels)
+        sql = ('SELECT COUNT(*) AS n, MAX(ts), GROUP_CONCAT(DISTINCT name), '
+               'level, msg FROM messages')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' GROUP BY fp ORDER BY n DESC LIMIT ?'
+        with self.lock:
+            return self.db.execute(sql, params + [limit]).fetchall()
+
+    def status(self):
+        with self.lock:
+            n = self.db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        m = 'Message index: %d messages  %.1f MiB  queued %d  dropped %d' % (
+            n, os.path.getsize(self.filename) / 1024.0 / 1024,
+            self.queue.qsize(), self.n_dropped)
+        logging.debug('status: %s', m)
+        return m
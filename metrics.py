@@ -0,0 +1,251 @@
+import bisect
+import http.server
+import logging
+import threading
+
+
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """
+    A Prometheus style histogram. Observations aren't locked, each
+    histogram is only updated by a single thread so the worst case is a
+    scrape seeing a partially recorded observation.
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for values greater than all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+class MetricsWriter(object):
+    """
+    Formats metrics in the OpenMetrics text format
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, mtype, help):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, mtype))
+
+    def sample(self, metric, value, **labels):
+        if labels:
+            metric += '{%s}' % ','.join(
+                '%s="%s"' % (k, escape(v)) for (k, v) in sorted(
+                    labels.items()))
+        self.lines.append('%s %s' % (metric, value))
+
+    def histogram(self, metric, h, **labels):
+        n = 0
+        for le, c in zip(h.buckets, h.counts):
+            n += c
+            self.sample(metric + '_bucket', n, le=le, **labels)
+        self.sample(metric + '_bucket', h.count, le='+Inf', **labels)
+        self.sample(metric + '_sum', h.sum, **labels)
+        self.sample(metric + '_count', h.count, **labels)
+
+    def text(self):
+        return '\n'.join(self.lines + ['# EOF', ''])
+
+
+def collect_reporters(w, reporters):
+    logs = [r for r in reporters if hasattr(r, 'counts')]
+    tails = [(r, r.parser.tail) for r in logs if r.parser]
+    w.metric('fenton_lines_read', 'counter', 'Lines read from the log file')
+    for r, t in tails:
+        w.sample('fenton_lines_read_total', t.count, name=r.name, file=r.file)
+    w.metric('fenton_read_bytes', 'counter',
+             'Bytes read from the log file, characters in text mode')
+    for r, t in tails:
+        w.sample('fenton_read_bytes_total', t.bytes_read, name=r.name,
+                 file=r.file)
+    w.metric('fenton_poll_seconds', 'histogram',
+             'Time to read and parse new lines from the log file')
+    for r in logs:
+        w.histogram('fenton_poll_seconds', r.poll_latency, name=r.name)
+    w.metric('fenton_messages', 'counter', 'Log messages matched per level')
+    for r in logs:
+        for level, n in r.counts.items():
+            w.sample('fenton_messages_total', n, name=r.name, level=level)
+    w.metric('fenton_rate_limited', 'counter',
+             'Log messages not shown due to rate limits')
+    for r in logs:
+        if hasattr(r, 'n_rate_limited'):
+            w.sample('fenton_rate_limited_total', r.n_rate_limited,
+                     name=r.name)
+    w.metric('fenton_suppressed', 'gauge',
+             'Log messages not shown since the last rate limit summary')
+    for r in logs:
+        if hasattr(r, 'n_suppressed'):
+            w.sample('fenton_suppressed', r.n_suppressed, name=r.name)
+
+    disks = [d for r in reporters for d in getattr(r, 'monitors', [])]
+    w.metric('fenton_disk_free_bytes', 'gauge',
+             'Free disk space at the last check')
+    for d in disks:
+        if d.free_mb is not None:
+            w.sample('fenton_disk_free_bytes', int(d.free_mb * 1024 * 1024),
+                     path=d.path)
+    w.metric('fenton_disk_size_bytes', 'gauge', 'Total disk space')
+    for d in disks:
+        if d.total_mb is not None:
+            w.sample('fenton_disk_size_bytes',
+                     int(d.total_mb * 1024 * 1024), path=d.path)
+
+
+def collect(bot):
+    """
+    Returns the metrics for an OmeroFenton in the OpenMetrics text format
+    """
+    w = MetricsWriter()
+    collect_reporters(w, bot.reporters)
+
+    q = bot._log_output
+    w.metric('fenton_output_queue_depth', 'gauge',
+             'Messages waiting to be posted to Slack')
+    for level, n in list(q.sizes.items()):
+        w.sample('fenton_output_queue_depth', n, level=level or '')
+    w.metric('fenton_output_queue_enqueued', 'counter',
+             'Messages added to the output queue')
+    w.sample('fenton_output_queue_enqueued_total', q.n_enqueued)
+    w.metric('fenton_output_queue_dropped', 'counter',
+             'Messages dropped because the output queue was full')
+    w.sample('fenton_output_queue_dropped_total', q.n_dropped)
+
+    o = bot.output
+    w.metric('fenton_slack_posts', 'counter', 'Slack messages posted')
+    w.sample('fenton_slack_posts_total', o.n_messages)
+    w.metric('fenton_slack_alerts', 'counter', 'Alerts posted to Slack')
+    w.sample('fenton_slack_alerts_total', o.n_alerts)
+    w.metric('fenton_slack_failures', 'counter', 'Failed Slack API calls')
+    w.sample('fenton_slack_failures_total', o.n_failures)
+    w.metric('fenton_slack_post_seconds', 'histogram',
+             'Slack chat.postMessage latency')
+    w.histogram('fenton_slack_post_seconds', o.post_latency_hist)
+
+    if bot.dedup:
+        w.metric('fenton_duplicates', 'counter',
+                 'Repeated messages which were not posted')
+        w.sample('fenton_duplicates_total', bot.dedup.n_duplicates)
+
+    w.metric('fenton_aggregator_events', 'gauge',
+             'Events held for the next email alert')
+    for i, a in enumerate(bot.aggregators):
+        w.sample('fenton_aggregator_events', len(a.events), aggregator=i)
+    w.metric('fenton_aggregator_discarded', 'gauge',
+             'Events discarded since the last email alert')
+    for i, a in enumerate(bot.aggregators):
+        w.sample('fenton_aggregator_discarded', a.n_discarded, aggregator=i)
+
+    if bot.workers:
+        w.metric('fenton_worker_events', 'counter',
+                 'Events received from worker processes')
+        w.sample('fenton_worker_events_total', bot.workers.n_events)
+        w.metric('fenton_worker_restarts', 'counter',
+                 'Worker processes restarted')
+        for wk in bot.workers.workers:
+            w.sample('fenton_worker_restarts_total', wk.restarts,
+                     worker=wk.index)
+
+    if bot.collector:
+        w.metric('fenton_collector_events', 'counter',
+                 'Events received from agents')
+        w.sample('fenton_collector_events_total', bot.collector.n_events)
+        w.metric('fenton_collector_duplicates', 'counter',
+                 'Batches sent again by agents which were ignored')
+        w.sample('fenton_collector_duplicates_total',
+                 bot.collector.n_duplicates)
+        w.metric('fenton_agent_connected', 'gauge',
+                 'Whether an agent is connected')
+        for a in list(bot.collector.agents.values()):
+            w.sample('fenton_agent_connected', int(bool(a.connected)),
+                     agent=a.name)
+
+    if bot.tailwatcher:
+        w.metric('fenton_files_suspended', 'counter',
+                 'Idle log files closed to limit open files')
+        w.sample('fenton_files_suspended_total',
+                 bot.tailwatcher.n_suspended)
+
+    w.metric('fenton_start_time_seconds', 'gauge', 'Start time of the bot')
+    w.sample('fenton_start_time_seconds', bot.start_time)
+    return w.text()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        try:
+            body = collect(self.server.bot).encode('utf-8')
+        except Exception as e:
+            logging.exception('Failed to collect metrics')
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header(
+            'Content-Type',
+            'application/openmetrics-text; version=1.0.0; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics: ' + format, *args)
+
+
+class MetricsServer(object):
+
+    def __init__(self, bot, address):
+        """
+        Serves metrics at http://address/metrics
+
+        address: host:port, use localhost to only allow local scrapes
+        """
+        host, port = address.rsplit(':', 1)
+        self.server = http.server.ThreadingHTTPServer(
+            (host, int(port)), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.bot = bot
+        self.lock = threading.Lock()
+        self.started = False
+        self._alive = True
+
+    def start(self):
+        with self.lock:
+            if not self._alive:
+                return
+            self.started = True
+        logging.info('Serving metrics on %s:%d', *self.server.server_address)
+        self.server.serve_forever()
+
+    def stop(self):
+        with self.lock:
+            self._alive = False
+        # shutdown() waits for serve_forever() so would block if it hasn't
+        # been called
+        if self.started:
+            self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+
+# Lower values are sent first
+LEVEL_PRIORITY = {
+    'FATAL': 0,
+    'SEVERE': 1,
+    'ERROR': 1,
+    None: 1,
+    'WARN': 2,
+    'WARNING': 2,
+}
+DEFAULT_PRIORITY = 2
+
+
+class Message(object):
+    """
+    A queued message, formatted when it's sent
+    """
+
+    __slots__ = ('msg', 'level', 'name', 'ts', 'dropped', 'fp', 'encoded')
+
+    def __init__(self, msg, level=None, name=None, dropped=0, fp=None):
+        # A string or logevent.LogEvent
+        self.msg = msg
+        self.level = level
+        self.name = name
+        self.ts = time.time()
+        self.dropped = dropped
+        # dedup.Fingerprint, counts repeats of this message
+        self.fp = fp
+        # (repeat count, serialised output), cached by the output
+        self.encoded = None
+
+    @property
+    def text(self):
+        if self.dropped:
+            return 'Output queue full: %d %smessages dropped from %s' % (
+                self.dropped, self.level + ' ' if self.level else '',
+                self.name)
+        if self.fp and self.fp.count > 1:
+            return '%s\n%s' % (self.msg, self.fp.summary())
+        return str(self.msg)
+
+
+class OutputQueue(object):
+
+    def __init__(self, capacity=1000, level_capacity=None):
+        """
+        A bounded priority queue of messages waiting to be sent
+
+        capacity: Maximum number of queued messages per level
+        level_capacity: Dict of level: capacity overriding capacity
+
+        Messages are ordered by level priority (FATAL first) then by
+        arrival. When a level is full further messages at that level are
+        counted instead, and a single "N messages dropped" summary per
+        source is queued in their place.
+        """
+        self.capacity = capacity
+        self.level_capacity = level_capacity or {}
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        # level: number of queued messages
+        self.sizes = {}
+        # (name, level): queued summary message
+        self.summaries = {}
+        self.n_enqueued = 0
+        self.n_dropped = 0
+
+    def put(self, msg, level=None, name=None, fp=None):
+        """
+        Returns False if the message was dropped because the queue is full
+        """
+        with self.cond:
+            size = self.sizes.get(level, 0)
+            if size >= self.level_capacity.get(level, self.capacity):
+                self.drop(level, name)
+                return False
+            self.sizes[level] = size + 1
+            self.push(Message(msg, level, name, fp=fp))
+            self.n_enqueued += 1
+        return True
+
+    def drop(self, level, name):
+        self.n_dropped += 1
+        summary = self.summaries.get((name, level))
+        if summary:
+            summary.dropped += 1
+        else:
+            logging.warning('Output queue full, dropping %s messages', level)
+            summary = Message(None, level, name, dropped=1)
+            self.summaries[(name, level)] = summary
+            self.push(summary)
+
+    def push(self, m):
+        p = LEVEL_PRIORITY.get(m.level, DEFAULT_PRIORITY)
+        heapq.heappush(self.heap, (p, next(self.seq), m))
+        self.cond.notify()
+
+    def pop(self):
+        p, seq, m = heapq.heappop(self.heap)
+        if m.dropped:
+            del self.summaries[(m.name, m.level)]
+        else:
+            self.sizes[m.level] -= 1
+        return m
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.heap:
+                self.cond.wait(timeout)
+            if not self.heap:
+                raise queue.Empty()
+            return self.pop()
+
+    def get_nowait(self):
+        with self.cond:
+            if not self.heap:
+                raise queue.Empty()
+            return self.pop()
+
+    def qsize(self):
+        return len(self.heap)
+
+    def status(self):
+        with self.cond:
+            queued = '  '.join('%s: %d' % (level or '-', n)
+                               for level, n in sorted(
+                                   self.sizes.items(), key=str) if n)
+        m = 'Output queue: %d  enqueued %d  dropped %d  %s' % (
+            self.qsize(), self.n_enqueued, self.n_dropped, queued)
+        logging.debug('status: %s', m)
+        return m
@@ -1,4 +1,9 @@
+import collections
 import errno
+import glob
+import hashlib
+import locale
+import mmap
 import os
 import stat
 import time
@@ -6,73 +11,437 @@ import logging
 # Handles pipes properly
 from io import open
 
+from logevent import LogEvent
+
 
 class PyTail(object):
     """
     A polling version of the unix 'tail -F' command
+
+    mode: text: return lines as strings
+      binary: read regular files in large blocks, returning each line as
+        bytes without decoding it. Incomplete lines are only returned once
+        the newline is written.
+      mmap: as binary but memory map the file instead of reading it
+      Pipes are always read in text mode.
     """
 
-    def __init__(self, filename, pollint=0.5, block=True):
+    def __init__(self, filename, pollint=0.5, block=True, mode='text'):
+        if mode not in ('text', 'binary', 'mmap'):
+            raise Exception('Invalid read mode: %s' % mode)
         self.filename = filename
         self.pollint = pollint
         self.block = block
+        self.mode = mode
+        self.encoding = locale.getpreferredencoding(False)
+        # True if the current file is being read in binary mode
+        self.binary = False
+        self.chunk_size = 1024 * 1024
         self.count = 0
+        # Bytes read, characters in text mode
+        self.bytes_read = 0
         self.current_inode = None
+        self.current_device = None
+        self.f = None
+        # Maximum number of characters (bytes in binary mode) returned by a
+        # single poll, so that catching up on a large file doesn't hold up
+        # other files
+        self.max_read = 1024 * 1024
+        # True if the last poll stopped at max_read
+        self.more = False
+        # (offset, last line) after the last read
+        self.position = (None, None)
+        # Offset of the start of the last line returned, in text mode this
+        # counts characters so may differ from the byte offset
+        self.line_offset = None
+        self.resume_state = None
+        # time.monotonic() when lines were last read or the file was opened
+        self.last_read = None
+        # True if the file was closed by suspend()
+        self.suspended = False
+        self._alive = True
+
+    def read_to_end(self, f, final=False):
+        """
+        final: The file has been rotated, so return an incomplete last line
+        """
+        if self.binary:
+            return self.read_to_end_binary(f, final)
+        return self.read_to_end_text(f)
+
+    def read_to_end_binary(self, f, final):
+        offset = self.position[0]
+        size = os.fstat(f.fileno()).st_size
+        if size < offset:
+            logging.warning('%s truncated, reading from start', self.filename)
+            offset = 0
+            self.position = (0, None)
+        mapped = None
+        if self.mode == 'mmap' and size > offset:
+            # Closed when the generator finishes, so a rotated or deleted
+            # file isn't kept mapped until it's garbage collected
+            mapped = buf = mmap.mmap(
+                f.fileno(), size, access=mmap.ACCESS_READ)
+            base = 0
+
+        n = 0
+        last = None
+        chunk = self.chunk_size
+        try:
+            while offset < size:
+                if self.max_read and n >= self.max_read:
+                    self.more = True
+                    break
+                end = min(size, offset + chunk)
+                if self.mode != 'mmap':
+                    f.seek(offset)
+                    buf = f.read(end - offset)
+                    base = offset
+                    end = base + len(buf)
+
+                pos = offset
+                nl = buf.rfind(b'\n', pos - base, end - base)
+                if nl >= 0:
+                    # Split all complete lines of the block at once, like text
+                    # mode this also splits at \r
+                    lines = buf[pos - base:nl + 1].splitlines(True)
+                    for line in lines:
+                        self.line_offset = pos
+                        yield line
+                        pos += len(line)
+                    self.count += len(lines)
+                    last = lines[-1]
+                else:
+                    if end < size:
+                        # Line is longer than the chunk
+                        chunk *= 2
+                        continue
+                    if not final:
+                        # Incomplete line, wait for the rest
+                        break
+                    # The file has been rotated so this line is complete
+                    last = buf[pos - base:end - base]
+                    self.line_offset = pos
+                    yield last
+                    self.count += 1
+                    pos = end
+                chunk = self.chunk_size
+                n += pos - offset
+                self.bytes_read += pos - offset
+                offset = pos
+                self.position = (offset, bytes(last))
+        finally:
+            if mapped is not None:
+                mapped.close()
 
-    def read_to_end(self, f):
-        for line in f:
+    def read_to_end_text(self, f):
+        n = 0
+        last = None
+        offset = self.position[0]
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            self.line_offset = offset
             yield line
+            if offset is not None:
+                offset += len(line)
+            last = line
             self.count += 1
+            n += len(line)
+            self.bytes_read += len(line)
+            if self.max_read and n >= self.max_read:
+                self.more = True
+                break
 
-        if not self.block:
-            yield None
+        if last is not None:
+            try:
+                offset = f.tell()
+            except (IOError, OSError):
+                # Pipe
+                offset = None
+            self.position = (offset, last)
 
     def has_changed(self):
-        return os.stat(self.filename).st_ino != self.current_inode
-
-    def tail1(self):
         try:
-            with open(self.filename, errors='replace') as f:
-                inode = os.fstat(f.fileno()).st_ino
-                if self.current_inode is None:
-                    try:
-                        f.seek(0, 2)
-                    except IOError:
-                        # Could be a unix named pipe
-                        try:
-                            ispipe = stat.S_ISFIFO(
-                                os.fstat(f.fileno()).st_mode)
-                        except Exception:
-                            ispipe = False
-                        if not ispipe:
-                            raise
-
-                self.current_inode = inode
-
-                while True:
-                    changed = self.has_changed()
-                    for line in self.read_to_end(f):
-                        logging.debug('Got line: %s', line)
-                        yield line
-                    if changed:
-                        break
-                    time.sleep(self.pollint)
+            return os.stat(self.filename).st_ino != self.current_inode
         except (IOError, OSError) as e:
             if e.errno != errno.ENOENT:
                 raise
+            return True
+
+    def checkpoint(self):
+        """
+        Returns a dict describing the current read position which can be
+        passed to resume(), or None if there's nothing to checkpoint
+        """
+        if self.suspended:
+            return self.resume_state
+        offset, line = self.position
+        if offset is None or self.f is None:
+            return None
+        if isinstance(line, bytes):
+            b = line
+        else:
+            b = line.encode(self.encoding, 'replace') if line else b''
+        return {
+            'path': self.filename,
+            'inode': self.current_inode,
+            'device': self.current_device,
+            'offset': offset,
+            'hash': hashlib.sha1(b).hexdigest(),
+            'hashlen': len(b),
+        }
+
+    def resume(self, state):
+        """
+        Resume from a checkpoint the first time the file is opened instead
+        of seeking to the end. If the file has since been rotated the
+        rotated file (e.g. file.log.1) is read first.
+        """
+        self.resume_state = state
+
+    def open_checkpoint(self, state):
+        candidates = [self.filename] + sorted(
+            glob.glob(glob.escape(self.filename) + '.*'))
+        for path in candidates:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if (st.st_ino != state['inode'] or
+                    st.st_dev != state['device']):
+                continue
+            offset = state['offset']
+            hashlen = state.get('hashlen', 0)
+            if st.st_size < offset:
+                logging.warning('Not resuming %s: truncated', path)
+                return None
+            f = self.open_file(path)
+            if hashlen:
+                b = os.pread(f.fileno(), hashlen, offset - hashlen)
+                # Text mode checkpoints are of the decoded line
+                b2 = b.decode(self.encoding, 'replace').encode(
+                    self.encoding, 'replace')
+                if state['hash'] not in (hashlib.sha1(b).hexdigest(),
+                                         hashlib.sha1(b2).hexdigest()):
+                    logging.warning('Not resuming %s: checksum mismatch', path)
+                    f.close()
+                    return None
+            f.seek(offset)
+            # Reopening a suspended file is routine
+            log = logging.debug if self.suspended else logging.info
+            log('Resuming %s from %s:%d (%d bytes behind)',
+                self.filename, path, offset, st.st_size - offset)
+            return f
+        logging.info('Not resuming %s: file not found', self.filename)
+        return None
+
+    def open_file(self, path):
+        """
+        Open a regular file in binary mode if requested, otherwise (e.g.
+        pipes) in text mode
+        """
+        self.binary = (self.mode != 'text' and
+                       stat.S_ISREG(os.stat(path).st_mode))
+        if self.binary:
+            return open(path, 'rb', buffering=0)
+        return open(path, errors='replace')
+
+    def open(self):
+        """
+        Open the file, returns False if it doesn't exist.
+        The first time a file is opened seek to the end or the resume
+        checkpoint, after that (i.e. following a rotation) read from the
+        beginning
+        """
+        f = None
+        if self.current_inode is None and self.resume_state:
+            f = self.open_checkpoint(self.resume_state)
+            self.resume_state = None
+
+        if f is None:
+            try:
+                f = self.open_file(self.filename)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return False
+
+            # A suspended file which has been replaced is read from the start
+            if self.current_inode is None and not self.suspended:
+                try:
+                    f.seek(0, 2)
+                except IOError:
+                    # Could be a unix named pipe
+                    try:
+                        ispipe = stat.S_ISFIFO(os.fstat(f.fileno()).st_mode)
+                    except Exception:
+                        ispipe = False
+                    if not ispipe:
+                        f.close()
+                        raise
+
+        st = os.fstat(f.fileno())
+        self.current_inode = st.st_ino
+        self.current_device = st.st_dev
+        try:
+            self.position = (f.tell(), None)
+        except (IOError, OSError):
+            self.position = (None, None)
+        self.f = f
+        return True
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def suspend(self):
+        """
+        Close the file to free its descriptor, it's reopened at the same
+        position by poll() once it has changed. Returns False if the
+        position isn't known, e.g. a pipe.
+        """
+        state = self.checkpoint()
+        if not state:
+            return False
+        self.close()
+        self.current_inode = None
+        self.resume_state = state
+        self.suspended = True
+        return True
+
+    def unchanged_since_suspend(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        state = self.resume_state
+        return (st.st_ino == state['inode'] and
+                st.st_size == state['offset'])
+
+    def poll(self):
+        """
+        Return all lines which are currently available up to max_read,
+        reopening the file if it has been rotated. If more data is
+        available self.more will be True.
+        """
+        lines = []
+        self.more = False
+        if self.f is None:
+            if (self.suspended and self.resume_state and
+                    self.unchanged_since_suspend()):
+                return lines
+            if not self.open():
+                return lines
+            self.suspended = False
+            self.last_read = time.monotonic()
 
-    def tail(self):
         while True:
-            for line in self.tail1():
+            changed = self.has_changed()
+            n = len(lines)
+            lines.extend(self.read_to_end(self.f, changed))
+            if len(lines) > n:
+                self.last_read = time.monotonic()
+            if self.more or not changed:
+                return lines
+            # Rotated or deleted: the old file has been drained
+            self.close()
+            if not self.open():
+                return lines
+
+    def stop(self):
+        """
+        End tail() after the current poll
+        """
+        self._alive = False
+
+    def tail(self):
+        while self._alive:
+            for line in self.poll():
                 yield line
-            time.sleep(self.pollint)
+            if not self.block and not self.more:
+                # Caught up, so the pending message is complete
+                yield None
+            if not self.more:
+                time.sleep(self.pollint)
 
     def __iter__(self):
         return self.tail()
 
 
-def default_message_cb(msg, match):
-    print('MESSAGE: %s' % msg)
+class MessageBuffer(object):
+    """
+    Collects the lines of a multi-line message so they're only joined once.
+    If max_length is set only the first 3/4 and last 1/4 of max_length
+    characters are kept, the number of lines and characters skipped in the
+    middle are counted. Lines longer than the remaining space are cut
+    short.
+    """
+
+    __slots__ = ('head', 'headlen', 'tail', 'taillen', 'max_head', 'max_tail',
+                 'nlines', 'skipped_lines', 'skipped_len', 'offset')
+
+    def __init__(self, line, max_length=None, offset=None):
+        if max_length:
+            self.max_tail = max_length // 4
+            self.max_head = max_length - self.max_tail
+        else:
+            self.max_head = self.max_tail = None
+        self.nlines = 1
+        self.skipped_lines = 0
+        self.skipped_len = 0
+        # Position of the first line in the file
+        self.offset = offset
+        if self.max_head is not None:
+            line = self.clip(line, self.max_head)
+        self.head = [line]
+        self.headlen = len(line)
+        self.tail = collections.deque()
+        self.taillen = 0
+
+    def clip(self, line, n):
+        """
+        Cut line to n characters, the rest are counted as skipped
+        """
+        if len(line) <= n:
+            return line
+        self.skipped_len += len(line) - n
+        return line[:n] + '...\n'
+
+    def append(self, line):
+        self.nlines += 1
+        if self.max_head is None:
+            self.head.append(line)
+            self.headlen += len(line)
+            return
+        if self.headlen < self.max_head:
+            line = self.clip(line, self.max_head - self.headlen)
+            self.head.append(line)
+            self.headlen += len(line)
+            return
+        line = self.clip(line, self.max_tail)
+        self.tail.append(line)
+        self.taillen += len(line)
+        while self.taillen > self.max_tail and len(self.tail) > 1:
+            skipped = self.tail.popleft()
+            self.taillen -= len(skipped)
+            self.skipped_lines += 1
+            self.skipped_len += len(skipped)
+
+    def getvalue(self):
+        msg = ''.join(self.head)
+        if self.skipped_lines:
+            msg += '... [%d lines, %d characters skipped] ...\n' % (
+                self.skipped_lines, self.skipped_len)
+        elif self.skipped_len:
+            msg += '... [%d characters skipped] ...\n' % self.skipped_len
+        return msg + ''.join(self.tail)
+
+
+def default_message_cb(event):
+    print('MESSAGE: %s' % event.body)
 
 
 def default_log_start_f(line):
@@ -82,10 +451,23 @@ def default_log_start_f(line):
 class LogParser(object):
 
     def __init__(self, filename, message_cb=default_message_cb,
-                 log_start_f=default_log_start_f, pollint=2, block=True):
-        self.tail = PyTail(filename, pollint, block)
+                 log_start_f=default_log_start_f, pollint=2, block=True,
+                 max_length=None, mode='text', prefilter_f=None):
+        """
+        message_cb: Called with a logevent.LogEvent for each message
+        max_length: If set limit the length of each message, keeping the
+          start and end
+        mode: PyTail read mode
+        prefilter_f: Optional, called with each line (str, or undecoded in
+          binary mode) and returns (is_log_start, wanted). Only lines of
+          wanted messages are decoded and passed to log_start_f and
+          message_cb.
+        """
+        self.tail = PyTail(filename, pollint, block, mode)
         self.message_cb = message_cb
+        self.max_length = max_length
         self.log_start_f = log_start_f
+        self.prefilter_f = prefilter_f
         self.current = None
         self.next = None
         self.current_match = None
@@ -96,28 +478,69 @@ class LogParser(object):
         self.next = None
 
         for line in self.tail:
-            if self.got_line(line):
-                self.message_cb(self.current, self.current_match)
-                self.current = self.next
-                self.current_match = self.next_match
-                self.next = None
+            self.process_line(line)
+
+    def poll(self):
+        """
+        Process all lines which are currently available without waiting,
+        used when the file is being watched externally.
+        Returns True if there is more data to be read.
+        """
+        for line in self.tail.poll():
+            self.process_line(line)
+        if not self.tail.block and not self.tail.more:
+            # The read reached the end of the file, flush the pending
+            # message. If it stopped at max_read the rest of the message may
+            # follow so it's kept
+            self.process(None)
+        return self.tail.more
+
+    def process(self, line):
+        if self.got_line(line):
+            current = self.current
+            self.message_cb(LogEvent(current, self.current_match,
+                                     current.offset, current.nlines))
+            self.current = self.next
+            self.current_match = self.next_match
+            self.next = None
+
+    def decode(self, line):
+        if type(line) is str:
+            return line
+        return str(line, self.tail.encoding, 'replace')
+
+    def process_line(self, line):
+        if line is None or self.prefilter_f is None:
+            self.process(line if line is None else self.decode(line))
+            return
+
+        start, wanted = self.prefilter_f(line)
+        if start:
+            # End of the previous message
+            self.process(None)
+            if wanted:
+                self.process(self.decode(line))
+            # Otherwise current is None so the rest of the message is skipped
+        elif self.current is not None:
+            self.current.append(self.decode(line))
 
     def got_line(self, line):
-        if line is None and self.current is not None:
-            return True
+        if line is None:
+            return self.current is not None
 
         m, match = self.log_start_f(line)
         if m:
+            offset = self.tail.line_offset
             if self.current is None:
-                self.current = line
+                self.current = MessageBuffer(line, self.max_length, offset)
                 self.current_match = match
                 return False
             else:
-                self.next = line
+                self.next = MessageBuffer(line, self.max_length, offset)
                 self.next_match = match
                 return True
         else:
             if self.current is not None:
-                self.current += line
+                self.current.append(line)
             # Else we must have started in the middle of a message- ignore
             return False
@@ -0,0 +1,88 @@
+import collections
+import threading
+
+
+# Limiters may be shared between reporters running in different threads
+_lock = threading.Lock()
+
+
+class RateLimiter(object):
+
+    def __init__(self, n, t):
+        """
+        Allow at most n events in any sliding window of t seconds.
+        If n or t are 0 or None there is no limit.
+
+        Only the timestamps of the last n allowed events are kept: an event
+        is allowed if fewer than n have been allowed or the oldest of the
+        last n is outside the window, so checks are O(1) regardless of n.
+        """
+        self.n = n
+        self.t = t
+        self.ts = collections.deque(maxlen=n) if n and t else None
+
+    def check(self, now):
+        return (self.ts is None or len(self.ts) < self.n or
+                now - self.ts[0] >= self.t)
+
+    def record(self, now):
+        if self.ts is not None:
+            self.ts.append(now)
+
+    def __str__(self):
+        return '%d / %ds' % (self.n, self.t)
+
+
+class LevelRateLimiter(object):
+
+    def __init__(self, n, t, levels=None):
+        """
+        n, t: Default rate limit, shared by all levels not in levels
+        levels: Dict of level: (n, t), each level has its own limit
+        """
+        # Used to check whether a reloaded configuration has changed
+        self.config = (n, t, levels or {})
+        self.default = RateLimiter(n, t)
+        self.limiters = dict(
+            (level, RateLimiter(*nt)) for (level, nt) in (
+                levels or {}).items())
+
+    def get(self, level):
+        return self.limiters.get(level, self.default)
+
+
+def allow(limiters, level, now):
+    """
+    Check all LevelRateLimiters, recording the event only if all of them
+    allow it. Returns None if allowed, otherwise the RateLimiter which
+    denied it.
+    """
+    rls = [ls.get(level) for ls in limiters]
+    with _lock:
+        for rl in rls:
+            if not rl.check(now):
+                return rl
+        for rl in rls:
+            rl.record(now)
+    return None
+
+
+def parse_rate_limit(value):
+    """
+    Parse n/t, returns (n, t)
+    """
+    n, t = value.split('/')
+    return int(n), float(t)
+
+
+def parse_level_rate_limits(value):
+    """
+    Parse a comma separated list of level:n/t, returns a dict of
+    level: (n, t)
+    """
+    levels = {}
+    if value:
+        for c in value.split(','):
+            level, nt = c.split(':', 1)
+            levels[level.strip()] = parse_rate_limit(nt)
+    return levels
@@ -0,0 +1,215 @@
+import json
+import logging
+import metrics
+import queue
+import threading
+import time
+
+
+class PostedMessage(object):
+    """
+    A Slack message that may be updated after it was posted
+    """
+
+    __slots__ = ('channel', 'ts', 'batch', 'updated')
+
+    def __init__(self, channel, ts, batch):
+        self.channel = channel
+        self.ts = ts
+        self.batch = batch
+        self.updated = time.time()
+
+
+class SlackOutput(object):
+
+    def __init__(self, slack_client, channel, botname, log_output,
+                 max_attachments=20, max_chars=40000):
+        """
+        Posts queued log alerts to Slack from its own thread, packing as
+        many as possible into each message
+
+        log_output: outputqueue.OutputQueue
+        max_attachments: Maximum attachments per message (Slack allows 100)
+        max_chars: Maximum combined text length per message, Slack truncates
+          messages longer than 40000 characters
+        """
+        self.slack_client = slack_client
+        self.channel = channel
+        self.botname = botname
+        self.log_output = log_output
+        self.max_attachments = max_attachments
+        self.max_chars = max_chars
+        self.max_backoff = 300
+        # An alert that didn't fit in the previous message
+        self.held = None
+        # Posted messages with updated repeat counts, and the minimum
+        # interval in seconds between updates of a message
+        self.updates = set()
+        self.update_interval = 10
+        self.update_lock = threading.Lock()
+        self._alive = True
+
+        self.n_messages = 0
+        self.n_alerts = 0
+        self.n_failures = 0
+        self.post_latency = None
+        self.post_latency_max = 0
+        self.post_latency_total = 0
+        self.post_latency_hist = metrics.Histogram()
+        self.delivery_delay = None
+
+    def get_batch(self):
+        """
+        Wait for an alert then take as many others as fit in one message
+        """
+        if self.held:
+            batch = [self.held]
+            self.held = None
+        else:
+            try:
+                batch = [self.log_output.get(timeout=1)]
+            except queue.Empty:
+                return []
+        nchars = len(batch[0].text)
+        while len(batch) < self.max_attachments:
+            try:
+                att = self.log_output.get_nowait()
+            except queue.Empty:
+                break
+            n = len(att.text)
+            if nchars + n > self.max_chars:
+                # Doesn't fit, send in the next message
+                self.held = att
+                break
+            batch.append(att)
+            nchars += n
+        return batch
+
+    def format_attachment(self, m):
+        return {
+            "fallback": "Log monitor alert",
+            "color": "#ff0000",
+            # "pretext": "Pretext text",
+            "title": "Log monitor alert",
+            # "title_link": "https://api.slack.com/docs/attachments",
+            # "fields": [{
+            #     "title":"key", "value":"value"
+            #     }],
+            "ts": m.ts,
+            "mrkdwn_in": ["text"],
+            "text": "```\n%s\n```" % m.text,
+            }
+
+    def encode_attachments(self, batch):
+        """
+        Serialise the attachments of a batch. Each attachment is only
+        serialised once, or again if its repeat count has changed.
+        """
+        encoded = []
+        for m in batch:
+            count = m.fp.count if m.fp else 0
+            if m.encoded is None or m.encoded[0] != count:
+                m.encoded = (count, json.dumps(self.format_attachment(m)))
+            encoded.append(m.encoded[1])
+        return '[%s]' % ', '.join(encoded)
+
+    def post(self, batch):
+        """
+        Post a batch, retrying until it succeeds or output is stopped
+        """
+        backoff = 1
+        attachments = self.encode_attachments(batch)
+        while self._alive:
+            start = time.time()
+            try:
+                r = self.slack_client.api_call(
+                    'chat.postMessage', channel=self.channel,
+                    username=self.botname, attachments=attachments)
+            except Exception as e:
+                r = {'ok': False, 'error': repr(e)}
+            if r.get('ok'):
+                self.record(batch, time.time() - start)
+                posted = PostedMessage(r.get('channel'), r.get('ts'), batch)
+                for m in batch:
+                    if m.fp:
+                        m.fp.posted = posted
+                return
+
+            self.n_failures += 1
+            wait = backoff
+            if r.get('error') == 'ratelimited':
+                headers = r.get('headers', {})
+                wait = max(float(headers.get('Retry-After', 1)), backoff)
+            logging.error('Failed to post %d alerts, retrying in %ds: %s',
+                          len(batch), wait, r)
+            time.sleep(wait)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def record(self, batch, latency):
+        self.n_messages += 1
+        self.n_alerts += len(batch)
+        self.post_latency = latency
+        self.post_latency_max = max(self.post_latency_max, latency)
+        self.post_latency_total += latency
+        self.post_latency_hist.observe(latency)
+        self.delivery_delay = time.time() - min(m.ts for m in batch)
+        logging.debug('Posted %d alerts in %.3fs', len(batch), latency)
+
+    def update(self, fp):
+        """
+        Schedule an update of the posted message containing a repeated
+        alert so the repeat count is current
+        """
+        if fp.posted:
+            with self.update_lock:
+                self.updates.add(fp.posted)
+
+    def post_updates(self):
+        now = time.time()
+        with self.update_lock:
+            due = set(p for p in self.updates
+                      if now - p.updated >= self.update_interval)
+            self.updates -= due
+        for p in due:
+            p.updated = now
+            attachments = self.encode_attachments(p.batch)
+            try:
+                r = self.slack_client.api_call(
+                    'chat.update', channel=p.channel, ts=p.ts,
+                    attachments=attachments)
+            except Exception as e:
+                r = {'ok': False, 'error': repr(e)}
+            if not r.get('ok'):
+                self.n_failures += 1
+                logging.error('Failed to update message %s: %s', p.ts, r)
+
+    def run_once(self):
+        """
+        Wait up to a second for alerts, post them and any updates
+        """
+        batch = self.get_batch()
+        if batch:
+            self.post(batch)
+        self.post_updates()
+
+    def start(self):
+        while self._alive:
+            self.run_once()
+
+    def stop(self):
+        self._alive = False
+
+    def status(self):
+        def ms(t):
+            return '%dms' % (t * 1000) if t is not None else '-'
+
+        avg = None
+        if self.n_messages:
+            avg = self.post_latency_total / self.n_messages
+        m = ('Slack output: queue %d  messages %d  alerts %d  failures %d  '
+             'post latency last %s avg %s max %s  delivery delay %s') % (
+            self.log_output.qsize(), self.n_messages, self.n_alerts,
+            self.n_failures, ms(self.post_latency), ms(avg),
+            ms(self.post_latency_max), ms(self.delivery_delay))
+        logging.debug('status: %s', m)
+        return m
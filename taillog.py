@@ -1,7 +1,16 @@
+import logevent
+import metrics
 import pytail
+import ratelimit
 import re
 import logging
 import time
+import timeseries
+
+
+# The level must be at the end of LogReporter.log_re for the prefilter to
+# combine it with the configured levels
+LEVEL_PATTERN = r'(?P<level>\w+) '
 
 
 class LogReporter(object):
@@ -13,63 +22,348 @@ class LogReporter(object):
         self.levels = levels
 
         self.sinks = []
+        # Level: whether any sink wants messages with this level
+        self.level_cache = {}
 
         self.log_re = re.compile(r'^(?P<date>\d\d\d\d-\d\d-\d\d) '
                                  r'(?P<time>\d\d:\d\d:\d\d,\d\d\d) '
-                                 r'(?P<level>\w+) ')
+                                 + LEVEL_PATTERN)
+        # time.strptime format of the date and time groups of log_re, None
+        # if messages don't have timestamps
+        self.time_format = '%Y-%m-%d %H:%M:%S'
+        self.timestamps = None
         self.max_log_length = 1024
+        # Maximum length of messages passed to sinks, None for no limit
+        self.max_message_length = None
+        # pytail.PyTail read mode
+        self.read_mode = 'text'
         self.counts = dict.fromkeys(self.levels, 0)
+        self.pollint = 2
+        self.parser = None
+        # Optional dedup.Deduplicator shared between reporters
+        self.dedup = None
+        # Time taken by poll()
+        self.poll_latency = metrics.Histogram()
+        # Optional messageindex.MessageIndex of reportable messages
+        self.index = None
+        # Number of minutes of per-level message rates to keep
+        self.rate_minutes = 3 * 1440
+        # level: timeseries.RateSeries
+        self.rates = {}
+        # level: timeseries.AnomalyDetector
+        self.anomalies = {}
+        # Count rates, detect anomalies and rate limit on the time messages
+        # were logged instead of when they were read, so catching up on a
+        # backlog isn't a burst
+        self.event_time = False
+        # The time the last counted message was read minus the time used
+        # to count it, how far behind the log rates are
+        self.event_lag = 0
+        self._alive = True
 
     def add_sink(self, sink):
         logging.debug('Adding sink: %s', sink)
-        self.sinks.append(sink)
+        # Replaced rather than modified so sink() can run in another thread
+        self.sinks = self.sinks + [sink]
+        self.level_cache.clear()
+
+    def remove_sink(self, sink):
+        self.sinks = [s for s in self.sinks if s is not sink]
+        self.level_cache.clear()
+
+    def set_levels(self, levels):
+        """
+        Change the reported levels, counts of existing levels are kept
+        """
+        self.levels = levels
+        for level in levels:
+            self.counts.setdefault(level, 0)
+        self.level_cache.clear()
+        if self.parser:
+            self.parser.prefilter_f = self.get_prefilter()
 
-    def sink(self, level, name, msg):
+    def sink(self, event):
         for s in self.sinks:
-            s.log_received(level, name, msg)
+            s.log_received(event)
+
+    def label(self, event, level):
+        """
+        Set the source and level of an event before it's passed on
+        """
+        event.source = self.name
+        event.level = level
+        event.truncate = self.max_log_length
+        event.timeparser = self.timestamps
 
     def is_log_start(self, m):
         logging.debug('is_log_start: %s', m)
         match = self.log_re.match(m) if m else None
         return (match is not None, match)
 
+    def deduplicate(self, msg):
+        """
+        Returns (duplicate, fingerprint). If msg is a repeat of a recent
+        message the existing alert is updated instead.
+        """
+        if not self.dedup:
+            return False, None
+        dup, fp = self.dedup.seen(msg, self.name)
+        if dup:
+            logging.debug('Duplicate %s: %s', fp.fp, msg)
+            self.rep.update_message(fp)
+        return dup, fp
+
+    def get_prefilter(self):
+        """
+        Returns a function used by pytail.LogParser to check whether a line
+        (str or undecoded bytes) starts a message, and whether that message
+        is wanted by this reporter or its sinks, so that other lines can be
+        skipped without decoding or parsing them.
+
+        The configured levels are combined with log_re into a single
+        regular expression. Other levels are only looked up if there are
+        sinks, and the result is cached.
+        """
+        pattern = self.log_re.pattern
+        if not pattern.endswith(LEVEL_PATTERN):
+            # Level isn't at the end of the first line, assume all wanted
+            text_re = re.compile(pattern)
+            bytes_re = re.compile(pattern.encode())
+
+            def prefilter(line):
+                r = text_re if type(line) is str else bytes_re
+                m = r.match(line) is not None
+                return (m, m)
+            return prefilter
+
+        levels = '|'.join(re.escape(level) for level in sorted(
+            self.levels, key=len, reverse=True))
+        pattern = '%s(?:(?P<wanted>%s) |%s)' % (
+            pattern[:-len(LEVEL_PATTERN)], levels, LEVEL_PATTERN)
+        logging.debug('prefilter: %s', pattern)
+        text_re = re.compile(pattern)
+        bytes_re = re.compile(pattern.encode())
+        cache = self.level_cache
+
+        def prefilter(line):
+            match = (text_re if type(line) is str else bytes_re).match(line)
+            if match is None:
+                return (False, False)
+            if match.lastgroup == 'wanted':
+                return (True, True)
+            if not self.sinks:
+                return (True, False)
+            level = match.group('level')
+            try:
+                return (True, cache[level])
+            except KeyError:
+                if type(level) is not str:
+                    level = level.decode()
+                wanted = self.sink_wants(level)
+                cache[match.group('level')] = wanted
+                return (True, wanted)
+        return prefilter
+
+    def update_parser(self):
+        """
+        Apply changed settings to a running parser, a changed read mode
+        takes effect when the file is next opened
+        """
+        if self.parser:
+            self.parser.max_length = self.max_message_length
+            self.parser.tail.pollint = self.pollint
+            self.parser.tail.mode = self.read_mode
+
+    def sink_wants(self, level):
+        for s in self.sinks:
+            if not hasattr(s, 'wants') or s.wants(level, self.name):
+                return True
+        return False
+
+    def get_rates(self, level):
+        try:
+            return self.rates[level]
+        except KeyError:
+            series = timeseries.RateSeries(self.rate_minutes)
+            self.rates[level] = series
+            return series
+
+    def set_anomaly_detection(self, levels, threshold, min_count,
+                              baseline_minutes):
+        """
+        Instead of showing every message during a burst of messages with
+        one of these levels post a single alert when the rate becomes
+        anomalous, and a count when it returns to normal
+        """
+        anomalies = {}
+        for level in levels:
+            detector = self.anomalies.get(level)
+            if detector:
+                # Keep the baseline
+                detector.configure(threshold, min_count, baseline_minutes)
+            else:
+                detector = timeseries.AnomalyDetector(
+                    self.get_rates(level), threshold, min_count,
+                    baseline_minutes)
+            anomalies[level] = detector
+        self.anomalies = anomalies
+
+    def count(self, level, event):
+        """
+        Count a message, returns False if it's part of an anomalous burst
+        of messages and shouldn't be shown
+        """
+        now = event.get_time(self.event_time)
+        self.event_lag = event.ts - now
+        self.counts[level] += 1
+        self.get_rates(level).add(now)
+        detector = self.anomalies.get(level)
+        if detector is None:
+            return True
+        minute = int(now // 60)
+        self.anomaly_ended(level, detector.update(minute))
+        if detector.check(minute):
+            m = ('%s: %s rate anomaly: %d messages this minute, baseline '
+                 '%.1f per minute. Messages are not shown until the rate '
+                 'returns to normal') % (
+                     self.name, level, detector.series.get(minute),
+                     detector.mean)
+            self.rep.log_message(m, level, self.name)
+        if detector.active:
+            detector.n_suppressed += 1
+            return False
+        return True
+
+    def anomaly_ended(self, level, n_suppressed):
+        if n_suppressed is not None:
+            m = '%s: %s rate back to normal: %d messages not shown' % (
+                self.name, level, n_suppressed)
+            self.rep.log_message(m, level, self.name)
+
+    def check_anomalies(self, now):
+        """
+        End anomalies if the rate has dropped, even if there have been no
+        further messages
+        """
+        # While catching up on a backlog with event_time the minutes
+        # since the last message haven't passed yet
+        minute = int((now - self.event_lag) // 60)
+        for level, detector in self.anomalies.items():
+            if detector.active:
+                self.anomaly_ended(level, detector.update(minute))
+
     def truncate_msg(self, msg):
         if len(msg) > self.max_log_length:
             msg = msg[:self.max_log_length] + '...'
         return msg
 
-    def log_received(self, msg, match):
-        logging.debug('log_received: %s', msg)
-        level = match.groupdict()['level']
+    def log_received(self, event):
+        level = event.match.group('level')
+        self.label(event, level)
+        logging.debug('log_received: %s', event)
         if level in self.levels:
-            self.counts[level] += 1
-            m = '%s: %s:\n%s' % (level, self.name, self.truncate_msg(msg))
-            self.rep.log_message(m)
-        self.sink(level, self.name, msg)
+            show = self.count(level, event)
+            if self.index:
+                self.index.add(self.name, level, event.body)
+            dup, fp = self.deduplicate(event.body) if show else (True, None)
+            if not dup:
+                self.rep.log_message(event, level, self.name, fp)
+        self.sink(event)
 
     def parse_error(self, msg):
         m = 'Log parsing error: %s\n%s' % (self.name, self.truncate_msg(msg))
-        self.rep.log_message(m)
+        self.rep.log_message(m, name=self.name)
+
+    def get_parser(self):
+        if self.parser is None:
+            if self.time_format:
+                self.timestamps = logevent.TimestampParser(self.time_format)
+            block = False
+            self.parser = pytail.LogParser(
+                self.file, self.log_received, self.is_log_start,
+                self.pollint, block, self.max_message_length,
+                self.read_mode, self.get_prefilter())
+        return self.parser
 
     def taillog(self):
-        pollint = 2
-        block = False
-        log = pytail.LogParser(self.file, self.log_received, self.is_log_start,
-                               pollint, block)
-
-        while True:
+        log = self.get_parser()
+        while self._alive:
             try:
                 log.parse()
             except Exception as e:
                 self.parse_error(repr(e))
+        log.tail.close()
+
+    def poll(self):
+        """
+        Process any new lines without blocking, called by a
+        tailwatcher watcher instead of running a thread per file.
+        Returns True if there is more data to be read.
+        """
+        start = time.perf_counter()
+        if self.anomalies:
+            self.check_anomalies(time.time())
+        try:
+            return self.get_parser().poll()
+        except Exception as e:
+            self.parse_error(repr(e))
+        finally:
+            self.poll_latency.observe(time.perf_counter() - start)
+
+    def last_read(self):
+        """
+        time.monotonic() when the file was last read, None if it's not open
+        """
+        if self.parser is None or self.parser.tail.f is None:
+            return None
+        return self.parser.tail.last_read
+
+    def suspend(self):
+        """
+        Close the file until it changes, to limit open file descriptors
+        """
+        if self.parser:
+            self.parser.tail.suspend()
+
+    def checkpoint(self):
+        if self.parser is None:
+            return None
+        return self.parser.tail.checkpoint()
+
+    def resume(self, state):
+        self.get_parser().tail.resume(state)
 
     def start(self):
         self.taillog()
 
+    def stop(self):
+        """
+        Stop tailing, the file is closed by the thread tailing it
+        """
+        self._alive = False
+        if self.parser:
+            self.parser.tail.stop()
+
+    def close(self):
+        """
+        Stop tailing and close the file, called by the tailwatcher
+        """
+        self.stop()
+        if self.parser:
+            self.parser.tail.close()
+
     def status(self):
+        now = time.time()
         m = '%s:    %s' % (
             self.name, '  '.join(
                 '%s: %d' % c for c in self.counts.items()))
+        if self.rates:
+            m += '    per minute 1h/24h: %s' % '  '.join(
+                '%s: %.2f/%.2f%s' % (
+                    level, series.rate(now, 60), series.rate(now, 1440),
+                    ' (anomaly)' if level in self.anomalies and
+                    self.anomalies[level].active else '')
+                for (level, series) in sorted(self.rates.items()))
         logging.debug('status: %s', m)
         return m
 
@@ -80,54 +374,60 @@ class LimitLogReporter(LogReporter):
         super(LimitLogReporter, self).__init__(file, name, rep, levels)
         self.rate_limit_n = limitn
         self.rate_limit_t = limitt
-        self.ts = []
+        # Per-file limit, which may be replaced by one shared with a group
+        # of files, optionally followed by a global limit
+        self.rate_limiters = [ratelimit.LevelRateLimiter(limitn, limitt)]
         self.n_suppressed = 0
+        # Total, n_suppressed is reset when a message is shown
+        self.n_rate_limited = 0
 
         logging.debug('rate_limit_n:%d rate_limit_t:%d',
                       self.rate_limit_n, self.rate_limit_t)
 
-    def log_received(self, msg, match):
-        logging.debug('log_received: %s', msg)
-        level = match.groupdict()['level']
+    def log_received(self, event):
+        level = event.match.group('level')
+        self.label(event, level)
+        logging.debug('log_received: %s', event)
         if level in self.levels:
-            self.counts[level] += 1
-            m = '%s: %s:\n%s' % (level, self.name, self.truncate_msg(msg))
-            self.log_or_limit(m)
-        self.sink(level, self.name, msg)
-
-    def warn_suppress(self):
-        m = '%s: Rate limiting messages (%d / %ds)' % (
-            self.name, self.rate_limit_n, self.rate_limit_t)
-        self.rep.log_message(m)
-
-    def output(self, t, msg):
+            show = self.count(level, event)
+            if self.index:
+                self.index.add(self.name, level, event.body)
+            dup, fp = self.deduplicate(event.body) if show else (True, None)
+            if not dup:
+                self.log_or_limit(event, level, fp,
+                                  event.get_time(self.event_time))
+        self.sink(event)
+
+    def warn_suppress(self, level=None, limiter=None):
+        m = '%s: Rate limiting messages (%s)' % (self.name, limiter)
+        self.rep.log_message(m, level, self.name)
+
+    def output(self, t, msg, level=None, fp=None):
+        """
+        msg: A logevent.LogEvent or string, formatted by the output
+        """
         if self.n_suppressed > 0:
             s = '%s: Rate limit: %d messages not shown' % (
                 self.name, self.n_suppressed)
-            self.rep.log_message(s)
+            self.rep.log_message(s, level, self.name)
             self.n_suppressed = 0
 
-        self.rep.log_message(msg)
-        if self.rate_limit_n and self.rate_limit_t:
-            self.ts.append(t)
-
-    def log_or_limit(self, msg):
-        now = time.time()
-        logging.debug('now:%s ts:[%d]:%s n_suppressed:%d',
-                      now, len(self.ts), self.ts, self.n_suppressed)
-        if not self.ts:
-            self.output(now, msg)
-        elif now - self.ts[0] < self.rate_limit_t:
-            if len(self.ts) < self.rate_limit_n:
-                self.output(now, msg)
-            else:
-                if self.n_suppressed == 0:
-                    self.warn_suppress()
-                self.n_suppressed += 1
+        self.rep.log_message(msg, level, self.name, fp)
+
+    def log_or_limit(self, msg, level=None, fp=None, now=None):
+        """
+        now: Time of the message in the rate limit window, default now
+        """
+        if now is None:
+            now = time.time()
+        limiter = ratelimit.allow(self.rate_limiters, level, now)
+        if limiter is None:
+            self.output(now, msg, level, fp)
         else:
-            while self.ts and now - self.ts[0] >= self.rate_limit_t:
-                self.ts.pop()
-            self.output(now, msg)
+            if self.n_suppressed == 0:
+                self.warn_suppress(level, limiter)
+            self.n_suppressed += 1
+            self.n_rate_limited += 1
 
 
 class LimitLogAllReporter(LimitLogReporter):
@@ -140,15 +440,20 @@ class LimitLogAllReporter(LimitLogReporter):
         self.counts[self.level_wildcard] = 0
         # Override the log start regexp, logs all levels
         self.log_re = re.compile(r'^\S')
+        self.time_format = None
         logging.debug('log_re:%s', self.log_re.pattern)
 
-    def log_received(self, msg, match):
-        logging.debug('log_received: %s', msg)
-        self.counts[self.level_wildcard] += 1
-        m = '%s: %s:\n%s' % (
-            self.level_wildcard, self.name, self.truncate_msg(msg))
-        self.log_or_limit(m)
-        self.sink(self.level_wildcard, self.name, msg)
+    def log_received(self, event):
+        self.label(event, self.level_wildcard)
+        logging.debug('log_received: %s', event)
+        show = self.count(self.level_wildcard, event)
+        if self.index:
+            self.index.add(self.name, self.level_wildcard, event.body)
+        dup, fp = self.deduplicate(event.body) if show else (True, None)
+        if not dup:
+            self.log_or_limit(event, self.level_wildcard, fp,
+                              event.get_time(self.event_time))
+        self.sink(event)
 
 
 class LimitLogDateLevelReporter(LimitLogReporter):
@@ -158,18 +463,24 @@ class LimitLogDateLevelReporter(LimitLogReporter):
             file, name, rep, levels, limitn, limitt)
         self.log_re = re.compile(r'^(?P<date>[A-Z][a-z][a-z] \d\d, \d\d\d\d) '
                                  r'(?P<time>\d?\d:\d\d:\d\d [A-Z][A-Z]) ')
+        self.time_format = '%b %d, %Y %I:%M:%S %p'
         self.loglevel_re = re.compile('^(?P<level>[A-Z]+): ')
 
-    def log_received(self, msg, match):
-        logging.debug('log_received: %s', msg)
+    def log_received(self, event):
         # Level should be at the start of the 2nd line
         try:
-            lm = self.loglevel_re.match(msg.splitlines()[1])
+            lm = self.loglevel_re.match(event.body.splitlines()[1])
             level = lm.groupdict()['level']
         except Exception:
             level = None
+        self.label(event, level)
+        logging.debug('log_received: %s', event)
         if level in self.levels:
-            self.counts[level] += 1
-            m = '%s: %s:\n%s' % (level, self.name, self.truncate_msg(msg))
-            self.log_or_limit(m)
-            self.sink(level, self.name, msg)
+            show = self.count(level, event)
+            if self.index:
+                self.index.add(self.name, level, event.body)
+            dup, fp = self.deduplicate(event.body) if show else (True, None)
+            if not dup:
+                self.log_or_limit(event, level, fp,
+                                  event.get_time(self.event_time))
+            self.sink(event)
@@ -0,0 +1,512 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import resource
+import selectors
+import stat
+import struct
+import threading
+import time
+
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+FILE_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+DIR_MASK = IN_CREATE | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    Minimal ctypes wrapper around the Linux inotify API
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        Returns a list of (wd, mask, name) for all pending events
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, namelen = EVENT_HEADER.unpack_from(buf, pos)
+                pos += EVENT_HEADER.size
+                name = buf[pos:pos + namelen].rstrip(b'\0')
+                pos += namelen
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def inotify_available():
+    try:
+        Inotify().close()
+        return True
+    except Exception as e:
+        logging.debug('inotify unavailable: %s', e)
+        return False
+
+
+class PollingTailWatcher(object):
+    """
+    Tails multiple log sources from a single thread by polling them in turn.
+    A source must have a `file` attribute, a non-blocking `poll()` method
+    and `stop()` and `close()` methods, for example taillog.LogReporter
+
+    If there are more than max_open open files the least recently read are
+    closed until they change, sources must have `last_read()` and
+    `suspend()` methods
+    """
+
+    def __init__(self, pollint=2, max_open=None):
+        self.pollint = pollint
+        self.max_open = max_open
+        self.n_suspended = 0
+        self.sources = []
+        # Sources with more data to read, e.g. catching up from a checkpoint
+        self.busy = set()
+        # Sources to be removed by the watcher's thread
+        self.removed = []
+        self.lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._alive = True
+
+    def add(self, source):
+        try:
+            ispipe = stat.S_ISFIFO(os.stat(source.file).st_mode)
+        except OSError:
+            ispipe = False
+        if ispipe:
+            # Reading a named pipe blocks so it needs its own thread
+            logging.debug('Tailing pipe in a thread: %s', source.file)
+            t = threading.Thread(target=source.start)
+            t.daemon = True
+            t.start()
+            return
+        with self.lock:
+            self.sources.append(source)
+        self.wakeup()
+
+    def remove(self, source):
+        """
+        Stop tailing a source, it's closed by the watcher's thread so it
+        isn't closed during a poll
+        """
+        with self.lock:
+            self.removed.append(source)
+        self.wakeup()
+
+    def remove_pending(self):
+        with self.lock:
+            removed = self.removed
+            self.removed = []
+            watched = [s for s in removed if s in self.sources]
+            self.sources = [s for s in self.sources if s not in removed]
+        for source in removed:
+            self.busy.discard(source)
+            if source in watched:
+                self.unwatch_source(source)
+                source.close()
+            else:
+                # A pipe in its own thread
+                source.stop()
+
+    def unwatch_source(self, source):
+        pass
+
+    def watch_directory(self, path, callback):
+        """
+        Call callback(name) when a file is created in or moved to a
+        directory. Not supported when polling, callers must rescan the
+        directory.
+        """
+        pass
+
+    def close_idle(self):
+        """
+        Suspend the least recently read files if more than max_open are
+        open
+        """
+        if not self.max_open:
+            return
+        with self.lock:
+            sources = list(self.sources)
+        opened = []
+        for s in sources:
+            t = s.last_read()
+            if t is not None:
+                opened.append((t, s))
+        if len(opened) <= self.max_open:
+            return
+        opened.sort(key=lambda e: e[0])
+        for t, s in opened[:len(opened) - self.max_open]:
+            s.suspend()
+            self.n_suspended += 1
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def poll_source(self, source):
+        try:
+            more = source.poll()
+        except Exception as e:
+            logging.error('Failed to poll %s: %s', source.file, e)
+            more = False
+        if more:
+            self.busy.add(source)
+        else:
+            self.busy.discard(source)
+
+    def poll_all(self):
+        with self.lock:
+            sources = list(self.sources)
+        for s in sources:
+            self.poll_source(s)
+        self.close_idle()
+
+    def poll_busy(self):
+        for s in list(self.busy):
+            self.poll_source(s)
+
+    def start(self):
+        while self._alive:
+            self.remove_pending()
+            self.poll_all()
+            if not self.busy:
+                self._wakeup.wait(self.pollint)
+                self._wakeup.clear()
+
+    async def run_async(self):
+        """
+        As start() but as a task on the running asyncio event loop
+        """
+        while self._alive:
+            self.remove_pending()
+            self.poll_all()
+            # Let other tasks run between reads when catching up
+            await asyncio.sleep(0 if self.busy else self.pollint)
+
+    def stop(self):
+        self._alive = False
+        self.wakeup()
+
+
+class InotifyTailWatcher(PollingTailWatcher):
+    """
+    Tails multiple log sources from a single thread, waking up on inotify
+    events so new lines are dispatched almost immediately.
+
+    Each file is watched for modifications and rotations (IN_MOVE_SELF,
+    IN_DELETE_SELF), and its parent directory for a replacement file being
+    created (IN_CREATE, IN_MOVED_TO). All sources are also polled every
+    pollint seconds in case events are missed, e.g. on network filesystems.
+    """
+
+    def __init__(self, pollint=2, max_open=None):
+        super(InotifyTailWatcher, self).__init__(pollint, max_open)
+        self.inotify = Inotify()
+        # wd: set(sources)
+        self.file_watches = {}
+        # source: set(wd)
+        self.source_watches = {}
+        # wd: {basename: set(sources)}
+        self.dir_watches = {}
+        # wd: [callback], see watch_directory
+        self.dir_callbacks = {}
+        self.pending_dirs = []
+        self.pending = []
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        # A full pipe already has a wakeup pending
+        os.set_blocking(self._wakeup_w, False)
+        # start() or run_async() is running, it closes the file descriptors
+        # when it exits
+        self.running = False
+
+    def add(self, source):
+        with self.lock:
+            self.pending.append(source)
+        self.wakeup()
+
+    def wakeup(self):
+        with self.lock:
+            if self._wakeup_w is None:
+                return
+            try:
+                os.write(self._wakeup_w, b'\0')
+            except BlockingIOError:
+                pass
+
+    def close_fds(self):
+        """
+        Close the inotify and wakeup file descriptors, call with the lock
+        held
+        """
+        if self._wakeup_r is not None:
+            self.inotify.close()
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            self._wakeup_r = self._wakeup_w = None
+
+    def stop(self):
+        super(InotifyTailWatcher, self).stop()
+        with self.lock:
+            if not self.running:
+                self.close_fds()
+
+    def watch_file(self, source):
+        try:
+            wd = self.inotify.add_watch(source.file, FILE_MASK)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        old = self.source_watches.get(source, set())
+        for w in old - set([wd]):
+            self.unwatch(w, source)
+        self.file_watches.setdefault(wd, set()).add(source)
+        self.source_watches[source] = set([wd])
+
+    def unwatch(self, wd, source):
+        sources = self.file_watches.get(wd, set())
+        sources.discard(source)
+        if not sources:
+            self.file_watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def unwatch_source(self, source):
+        for wd in self.source_watches.pop(source, set()):
+            self.unwatch(wd, source)
+        for wd, names in list(self.dir_watches.items()):
+            for basename, sources in list(names.items()):
+                sources.discard(source)
+                if not sources:
+                    del names[basename]
+            if not names:
+                del self.dir_watches[wd]
+                if wd not in self.dir_callbacks:
+                    self.inotify.rm_watch(wd)
+
+    def watch_directory(self, path, callback):
+        with self.lock:
+            self.pending_dirs.append((path, callback))
+        self.wakeup()
+
+    def watch_dir(self, source):
+        path = os.path.abspath(source.file)
+        dirname, basename = os.path.split(path)
+        wd = self.inotify.add_watch(dirname, DIR_MASK)
+        names = self.dir_watches.setdefault(wd, {})
+        names.setdefault(basename, set()).add(source)
+
+    def add_pending(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            pending_dirs = self.pending_dirs
+            self.pending_dirs = []
+        for path, callback in pending_dirs:
+            try:
+                wd = self.inotify.add_watch(path, DIR_MASK)
+                self.dir_callbacks.setdefault(wd, []).append(callback)
+            except OSError as e:
+                logging.error('Failed to watch directory %s: %s', path, e)
+        for source in pending:
+            super(InotifyTailWatcher, self).add(source)
+            with self.lock:
+                if source not in self.sources:
+                    continue
+            try:
+                self.watch_dir(source)
+                self.watch_file(source)
+            except OSError as e:
+                logging.error('Failed to watch %s, polling only: %s',
+                              source.file, e)
+            self.poll_source(source)
+
+    def handle_events(self):
+        topoll = set()
+        rewatch = set()
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('inotify queue overflow, polling all files')
+                with self.lock:
+                    topoll.update(self.sources)
+                continue
+            for callback in self.dir_callbacks.get(wd, []):
+                callback(name)
+            if wd in self.dir_watches:
+                sources = self.dir_watches[wd].get(name)
+                if sources:
+                    # A new file has replaced a rotated one
+                    rewatch.update(sources)
+                continue
+            sources = self.file_watches.get(wd, set())
+            if mask & IN_IGNORED:
+                # Watch removed by the kernel, e.g. the file was deleted
+                self.file_watches.pop(wd, None)
+                for s in sources:
+                    self.source_watches.get(s, set()).discard(wd)
+                continue
+            topoll.update(sources)
+
+        # Poll before rewatching so the rotated file is drained first
+        for s in topoll | rewatch:
+            self.poll_source(s)
+        for s in rewatch:
+            try:
+                self.watch_file(s)
+            except OSError as e:
+                logging.error('Failed to watch %s: %s', s.file, e)
+        # Pick up anything written between the poll and the new watch
+        for s in rewatch:
+            self.poll_source(s)
+
+    def start(self):
+        with self.lock:
+            if self._wakeup_r is None:
+                # Already stopped
+                return
+            self.running = True
+        sel = selectors.DefaultSelector()
+        sel.register(self.inotify, selectors.EVENT_READ)
+        sel.register(self._wakeup_r, selectors.EVENT_READ)
+        next_poll = time.monotonic() + self.pollint
+        try:
+            while self._alive:
+                timeout = 0 if self.busy else max(
+                    next_poll - time.monotonic(), 0)
+                ready = sel.select(timeout)
+                if not self._alive:
+                    break
+                if time.monotonic() >= next_poll:
+                    self.poll_all()
+                    next_poll = time.monotonic() + self.pollint
+                for key, _ in ready:
+                    if key.fileobj == self._wakeup_r:
+                        self.drain_wakeup()
+                        self.add_pending()
+                        self.remove_pending()
+                    else:
+                        self.handle_events()
+                self.poll_busy()
+        finally:
+            sel.close()
+            with self.lock:
+                self.close_fds()
+
+    async def run_async(self):
+        """
+        As start() but as a task on the running asyncio event loop, the
+        inotify and wakeup file descriptors are watched by the loop
+        """
+        with self.lock:
+            if self._wakeup_r is None:
+                # Already stopped
+                return
+            self.running = True
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        loop.add_reader(self.inotify.fileno(), ready.set)
+        loop.add_reader(self._wakeup_r, ready.set)
+        next_poll = time.monotonic() + self.pollint
+        try:
+            while self._alive:
+                timeout = 0 if self.busy else max(
+                    next_poll - time.monotonic(), 0)
+                try:
+                    await asyncio.wait_for(ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                ready.clear()
+                if not self._alive:
+                    break
+                if time.monotonic() >= next_poll:
+                    self.poll_all()
+                    next_poll = time.monotonic() + self.pollint
+                self.drain_wakeup()
+                self.add_pending()
+                self.remove_pending()
+                self.handle_events()
+                self.poll_busy()
+                # Let other tasks run between reads when catching up
+                await asyncio.sleep(0)
+        finally:
+            loop.remove_reader(self.inotify.fileno())
+            loop.remove_reader(self._wakeup_r)
+            with self.lock:
+                self.close_fds()
+
+    def drain_wakeup(self):
+        while True:
+            try:
+                if not os.read(self._wakeup_r, 4096):
+                    break
+            except BlockingIOError:
+                break
+
+
+def default_max_open():
+    """
+    Half the file descriptor limit
+    """
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 2
+
+
+def get_tailwatcher(mode, pollint=2, max_open=None):
+    """
+    mode: inotify, poll, thread, or auto (inotify if available otherwise
+      poll). thread returns None to indicate each log file should be tailed
+      in its own thread
+    max_open: Maximum number of open files, see PollingTailWatcher
+    """
+    if mode == 'auto':
+        mode = 'inotify' if inotify_available() else 'poll'
+    if mode == 'inotify':
+        return InotifyTailWatcher(pollint, max_open)
+    if mode == 'poll':
+        return PollingTailWatcher(pollint, max_open)
+    if mode == 'thread':
+        return None
+    raise Exception('Invalid tail_mode: %s' % mode)
@@ -0,0 +1,89 @@
+import socketserver
+import threading
+import time
+
+import pytest
+
+
+def wait_for(f, timeout=10):
+    """
+    Wait until f() returns True, returns False after timeout seconds
+    """
+    end = time.time() + timeout
+    while time.time() < end:
+        if f():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP for smtplib.sendmail
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost test SMTP server')
+        mail = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('HELO', 'EHLO', 'NOOP', 'RSET'):
+                self.reply('250 OK')
+            elif verb == 'MAIL':
+                mail = {'from': command[10:], 'to': [], 'data': ''}
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                mail['to'].append(command[8:])
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b'.\r\n', b''):
+                        break
+                    lines.append(line.decode())
+                mail['data'] = ''.join(lines)
+                self.server.messages.append(mail)
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Not implemented')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('localhost', port), SMTPHandler)
+        self.messages = []
+        self.address = 'localhost:%d' % self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+@pytest.fixture
+def smtp_server():
+    server = SMTPServer().start()
+    yield server
+    server.stop()
@@ -0,0 +1,29 @@
+import string
+
+import backfill
+import taillog
+
+
+def add_log_reporter(logtype, bot, cfg, maincfg):
+    r = taillog.LimitLogReporter(cfg['file'], cfg['name'], bot, ['ERROR'],
+                                 10, 60)
+    r.set_anomaly_detection(['ERROR'], 4, 10, 60)
+    bot.add_reporter(r)
+    return r
+
+
+def word(i):
+    letters = string.ascii_lowercase
+    return letters[i // 26] + letters[i % 26]
+
+
+def test_scan_reports_everything(tmp_path):
+    path = tmp_path / 'a.log'
+    path.write_text(''.join(
+        '2020-01-01 00:00:00,000 ERROR failure %s\n' % word(i)
+        for i in range(200)))
+    cfg = {'name': 'a', 'file': str(path)}
+    result = backfill.scan_file(
+        ('logdefault', cfg, {}, [], add_log_reporter, str(path), True, 10))
+    assert result['counts']['ERROR'] == 200
+    assert len(result['fingerprints']) == 200
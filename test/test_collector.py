@@ -0,0 +1,214 @@
+import socket
+import threading
+
+import pytest
+
+from conftest import wait_for
+import collector
+from logevent import LogEvent
+
+
+CONDITIONS = [('ERROR', '', 'boom')]
+
+
+class Aggregator(object):
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+        self.events = []
+
+    def add_event(self, event):
+        self.events.append(event)
+
+
+class CollectorBot(object):
+    """
+    Stands in for the collecting OmeroFenton
+    """
+
+    def __init__(self):
+        self.aggregators = [Aggregator(CONDITIONS)]
+        self.global_rate_limiter = None
+        self.dedup = None
+        self.messages = []
+        self.names = []
+
+    def log_message(self, logmsg, level=None, name=None, fp=None):
+        self.messages.append(logmsg)
+        self.names.append(name)
+
+    def update_message(self, fp):
+        pass
+
+
+def start(target):
+    t = threading.Thread(target=target)
+    t.daemon = True
+    t.start()
+
+
+def start_collector(bot, address, token='secret'):
+    c = collector.Collector(bot, address, token)
+    start(c.start)
+    return c
+
+
+def start_agent(address, spool_dir, token='secret', name='host1'):
+    spool = collector.Spool(spool_dir)
+    channel = collector.AgentChannel(address, name, spool, token)
+    channel.min_backoff = 0.1
+    bot = collector.AgentBot(channel)
+    bot.set_conditions(spool.conditions or [])
+    channel.config_cb = bot.set_conditions
+    start(channel.start)
+    start(channel.run)
+    return bot
+
+
+def unused_address():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'localhost:%d' % port
+
+
+@pytest.fixture(params=['unix', 'tcp'])
+def address(request, tmp_path):
+    if request.param == 'unix':
+        return str(tmp_path / 'collector.sock')
+    return unused_address()
+
+
+def test_forwarding(address, tmp_path):
+    bot = CollectorBot()
+    c = start_collector(bot, address)
+    agent = start_agent(address, str(tmp_path / 'spool'))
+    spool = agent.channel.spool
+    try:
+        assert wait_for(lambda: agent.conditions == [
+            [list(t) for t in CONDITIONS]])
+        agent.channel.send(('log', 'hello', 'ERROR', 'a.log'))
+        for s in agent.sinks:
+            s.log_received(LogEvent('boom', source='a.log', level='ERROR'))
+            s.log_received(LogEvent('fine', source='a.log', level='ERROR'))
+        assert wait_for(lambda: bot.messages == ['hello'])
+        events = bot.aggregators[0].events
+        assert wait_for(lambda: len(events) == 1)
+        assert (events[0].source, events[0].level, events[0].body) == (
+            'host1/a.log', 'ERROR', 'boom')
+        assert wait_for(lambda: spool.acked == spool.end())
+        assert c.agents['host1'].n_events == 2
+    finally:
+        agent.channel.stop()
+        c.stop()
+
+
+def test_agents_with_same_sections(tmp_path):
+    address = str(tmp_path / 'collector.sock')
+    bot = CollectorBot()
+    c = start_collector(bot, address)
+    agents = [start_agent(address, str(tmp_path / name), name=name)
+              for name in ('host1', 'host2')]
+    try:
+        for agent in agents:
+            assert wait_for(lambda: agent.conditions)
+            agent.channel.send(('log', 'hello', 'ERROR', 'Blitz-0'))
+            agent.channel.send(('status', ['Blitz-0:    ERROR: 1']))
+            for s in agent.sinks:
+                s.log_received(
+                    LogEvent('boom', source='Blitz-0', level='ERROR'))
+        assert wait_for(lambda: len(bot.names) == 2)
+        assert sorted(bot.names) == ['host1/Blitz-0', 'host2/Blitz-0']
+        events = bot.aggregators[0].events
+        assert wait_for(lambda: len(events) == 2)
+        assert sorted(e.source for e in events) == [
+            'host1/Blitz-0', 'host2/Blitz-0']
+        assert wait_for(lambda: all(a.status for a in c.agents.values()))
+        assert c.agents['host1'].status == ['host1/Blitz-0:    ERROR: 1']
+        assert c.agents['host2'].status == ['host2/Blitz-0:    ERROR: 1']
+    finally:
+        for agent in agents:
+            agent.channel.stop()
+        c.stop()
+
+
+def test_invalid_token(tmp_path):
+    address = str(tmp_path / 'collector.sock')
+    bot = CollectorBot()
+    c = start_collector(bot, address)
+    agent = start_agent(address, str(tmp_path / 'spool'), 'wrong')
+    try:
+        agent.channel.send(('log', 'hello', 'ERROR', 'a.log'))
+        assert not wait_for(lambda: bot.messages, 1)
+        assert c.agents == {}
+    finally:
+        agent.channel.stop()
+        c.stop()
+
+
+def test_spool_replay(tmp_path):
+    address = unused_address()
+    spool_dir = str(tmp_path / 'spool')
+    bot = CollectorBot()
+    agent = start_agent(address, spool_dir)
+    spool = agent.channel.spool
+    try:
+        # Spooled while the collector isn't running
+        for i in range(3):
+            agent.channel.send(('log', 'first %d' % i, 'ERROR', 'a.log'))
+        assert wait_for(lambda: spool.end() > spool.acked)
+
+        c = start_collector(bot, address)
+        assert wait_for(lambda: len(bot.messages) == 3)
+        assert wait_for(lambda: spool.acked == spool.end())
+        c.stop()
+
+        # A restarted collector doesn't receive them again
+        for i in range(2):
+            agent.channel.send(('log', 'second %d' % i, 'ERROR', 'a.log'))
+        c = start_collector(bot, address)
+        assert wait_for(lambda: len(bot.messages) == 5)
+        assert wait_for(lambda: spool.acked == spool.end())
+        assert bot.messages == ['first 0', 'first 1', 'first 2',
+                                'second 0', 'second 1']
+        assert c.agents['host1'].n_events == 2
+        c.stop()
+    finally:
+        agent.channel.stop()
+
+    # Nothing is left to send after the agent restarts
+    spool = collector.Spool(spool_dir)
+    assert spool.acked == spool.end()
+
+
+def test_duplicate_batch_ignored(tmp_path):
+    spool = collector.Spool(str(tmp_path / 'spool'))
+    for i in range(2):
+        spool.append(collector.encode([('log', 'm%d' % i, 'ERROR', 'a')]))
+    bot = CollectorBot()
+    c = collector.Collector(bot, str(tmp_path / 'collector.sock'))
+    agent = c.get_agent('host1', spool.id, 0, 'test')
+    offset = 0
+    for i in range(2):
+        payload = spool.read(offset)
+        c.receive(agent, offset, payload)
+        # Resent after a lost acknowledgement
+        c.receive(agent, offset, payload)
+        offset = spool.next_offset(offset, payload)
+    assert bot.messages == ['m0', 'm1']
+    assert c.n_duplicates == 2
+    assert agent.acked == spool.end()
+
+
+def test_spool_partial_batch(tmp_path):
+    spool_dir = str(tmp_path / 'spool')
+    spool = collector.Spool(spool_dir)
+    spool.append(collector.encode([('log', 'complete', 'ERROR', 'a')]))
+    end = spool.end()
+    with open(str(tmp_path / 'spool' / '0.spool'), 'ab') as f:
+        f.write(collector.RECORD.pack(100) + b'partial')
+    spool = collector.Spool(spool_dir)
+    assert spool.end() == end
+    assert collector.decode(spool.read(0)) == [
+        ['log', 'complete', 'ERROR', 'a']]
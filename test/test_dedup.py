@@ -0,0 +1,91 @@
+import dedup
+import outputqueue
+import taillog
+from logevent import LogEvent
+
+
+class QueueBot(object):
+    """
+    Queues messages like OmeroFenton.log_message
+    """
+
+    def __init__(self, capacity=1000):
+        self.queue = outputqueue.OutputQueue(capacity)
+        self.dedup = dedup.Deduplicator(3600)
+        self.updated = []
+
+    def log_message(self, logmsg, level=None, name=None, fp=None):
+        if self.queue.put(logmsg, level, name, fp) and fp:
+            self.dedup.add(fp)
+
+    def update_message(self, fp):
+        self.updated.append(fp)
+
+    def messages(self):
+        return [str(m.msg) for (p, seq, m) in sorted(self.queue.heap)]
+
+
+def make_reporter(bot, limitn, limitt):
+    r = taillog.LimitLogReporter('test.log', 'test', bot, ['ERROR'],
+                                 limitn, limitt)
+    r.dedup = bot.dedup
+    return r
+
+
+def receive(r, msg, ts):
+    line = '2020-01-01 00:00:00,000 ERROR %s\n' % msg
+    r.log_received(LogEvent(line, match=r.log_re.match(line), ts=ts))
+
+
+def test_repeats_suppressed():
+    bot = QueueBot()
+    r = make_reporter(bot, 100, 60)
+    for i in range(5):
+        receive(r, 'boom %d' % i, i)
+    messages = bot.messages()
+    assert len(messages) == 1
+    assert len(bot.updated) == 4
+    assert bot.updated[-1].count == 5
+
+
+def test_rate_limited_first_occurrence():
+    bot = QueueBot()
+    r = make_reporter(bot, 1, 60)
+    receive(r, 'other', 0)
+    # Rate limited, so repeats must not be treated as duplicates
+    receive(r, 'boom 1', 1)
+    receive(r, 'boom 2', 2)
+    assert not any('boom' in m for m in bot.messages())
+    assert bot.updated == []
+
+    receive(r, 'boom 3', 100)
+    assert 'boom 3' in bot.messages()[-1]
+    receive(r, 'boom 4', 101)
+    assert len(bot.updated) == 1
+    assert bot.updated[0].count == 2
+
+
+def test_dropped_first_occurrence():
+    bot = QueueBot(capacity=1)
+    r = make_reporter(bot, 100, 60)
+    receive(r, 'other', 0)
+    # Dropped because the queue is full
+    receive(r, 'boom 1', 1)
+    assert bot.updated == []
+    bot.queue.get_nowait()
+    bot.queue.get_nowait()
+    receive(r, 'boom 2', 2)
+    assert 'boom 2' in bot.messages()[-1]
+
+
+def test_ttl_not_extended_by_repeats():
+    d = dedup.Deduplicator(ttl=10)
+    dup, fp = d.seen('boom 1', 'a')
+    assert not dup
+    d.add(fp)
+    fp.first -= 8
+    assert d.seen('boom 2', 'a')[0]
+    fp.first -= 3
+    dup, fp2 = d.seen('boom 3', 'a')
+    assert not dup
+    assert fp2 is not fp
@@ -0,0 +1,52 @@
+import discovery
+
+
+class DiscoveryBot(object):
+
+    def __init__(self):
+        self.reporters = []
+
+    def add_reporter(self, reporter):
+        self.reporters.append(reporter)
+
+    def remove_reporter(self, reporter):
+        self.reporters.remove(reporter)
+
+
+def add_log_reporter(logtype, bot, cfg, maincfg):
+    bot.add_reporter(cfg['file'])
+    return cfg['file']
+
+
+def test_new_and_deleted_files(tmp_path):
+    for name in ('a.log', 'b.log', 'b.log.1'):
+        (tmp_path / name).write_text('')
+    bot = DiscoveryBot()
+    d = discovery.LogDiscovery(
+        'logdefault', {'name': 'logs', 'file': str(tmp_path)}, {}, bot,
+        add_log_reporter, rescan_interval=0)
+    d.scan()
+    assert sorted(d.reporters) == [
+        str(tmp_path / 'a.log'), str(tmp_path / 'b.log')]
+
+    (tmp_path / 'c.log').write_text('')
+    (tmp_path / 'a.log').unlink()
+    d.scan()
+    assert sorted(bot.reporters) == [
+        str(tmp_path / 'b.log'), str(tmp_path / 'c.log')]
+
+
+def test_rotated_file_kept(tmp_path):
+    (tmp_path / 'a.log').write_text('')
+    bot = DiscoveryBot()
+    d = discovery.LogDiscovery(
+        'logdefault', {'name': 'logs', 'file': str(tmp_path / '*.log')}, {},
+        bot, add_log_reporter, rescan_interval=60)
+    d.scan()
+    # Briefly missing during a rotation
+    (tmp_path / 'a.log').rename(tmp_path / 'a.log.1')
+    d.scan()
+    (tmp_path / 'a.log').write_text('')
+    d.scan()
+    assert bot.reporters == [str(tmp_path / 'a.log')]
+    assert d.missing == {}
@@ -0,0 +1,113 @@
+import os
+import socket
+
+from conftest import SMTPServer, wait_for
+import emailsender
+
+
+EMAIL = 'Subject: test\r\n\r\nAlert\r\n'
+
+
+def unused_port():
+    server = SMTPServer()
+    port = server.server_address[1]
+    server.server_close()
+    return port
+
+
+def test_send(smtp_server):
+    sender = emailsender.EmailSender(smtp_server.address)
+    try:
+        sender.submit('from@example.org', ['to@example.org'], EMAIL)
+        assert sender.join(10)
+        assert sender.n_sent == 1
+        assert len(smtp_server.messages) == 1
+        assert smtp_server.messages[0]['to'] == ['<to@example.org>']
+        assert 'Alert' in smtp_server.messages[0]['data']
+    finally:
+        sender.stop()
+
+
+def test_reconnect_after_connection_reset(smtp_server):
+    sender = emailsender.EmailSender(smtp_server.address)
+    try:
+        sender.send('from@example.org', ['to@example.org'], EMAIL)
+
+        def reset():
+            raise ConnectionResetError('Connection reset by peer')
+
+        sender.conn.noop = reset
+        sender.last_used = 0
+        sender.send('from@example.org', ['to@example.org'], EMAIL)
+        assert len(smtp_server.messages) == 2
+    finally:
+        sender.stop()
+
+
+def test_hung_server_times_out():
+    # Connections are accepted by the kernel but never answered
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    s.listen(5)
+    sender = emailsender.EmailSender('localhost:%d' % s.getsockname()[1])
+    sender.timeout = 0.5
+    sender.min_backoff = 0.1
+    try:
+        sender.submit('from@example.org', ['to@example.org'], EMAIL)
+        assert wait_for(lambda: sender.n_failures >= 2)
+    finally:
+        sender.stop()
+        s.close()
+
+
+def test_retry_until_server_available():
+    port = unused_port()
+    sender = emailsender.EmailSender('localhost:%d' % port)
+    sender.min_backoff = 0.1
+    server = None
+    try:
+        sender.submit('from@example.org', ['to@example.org'], EMAIL)
+        assert wait_for(lambda: sender.n_failures >= 2)
+        assert sender.n_sent == 0
+        server = SMTPServer(port).start()
+        assert sender.join(10)
+        assert sender.n_sent == 1
+        assert len(server.messages) == 1
+    finally:
+        sender.stop()
+        if server:
+            server.stop()
+
+
+def test_spool_replayed_after_restart(tmp_path):
+    port = unused_port()
+    spool = str(tmp_path / 'spool')
+    sender = emailsender.EmailSender('localhost:%d' % port, spool)
+    sender.min_backoff = 0.1
+    sender.submit('from@example.org', ['to@example.org'], EMAIL)
+    assert wait_for(lambda: sender.n_failures >= 1)
+    sender.stop()
+    sender.thread.join(5)
+    assert len(os.listdir(spool)) == 1
+
+    server = SMTPServer(port).start()
+    try:
+        sender = emailsender.EmailSender('localhost:%d' % port, spool)
+        assert sender.join(10)
+        assert sender.n_sent == 1
+        assert len(server.messages) == 1
+        assert os.listdir(spool) == []
+    finally:
+        sender.stop()
+        server.stop()
+
+
+def test_senders_shared_by_spool(monkeypatch, tmp_path):
+    monkeypatch.setattr(emailsender, '_senders', {})
+    spool = str(tmp_path / 'spool')
+    a = emailsender.get_sender('localhost:25', spool)
+    assert emailsender.get_sender('localhost:25', spool) is a
+    b = emailsender.get_sender('localhost:25')
+    assert b is not a
+    assert a.spool == os.path.join(spool, 'localhost_25')
+    assert b.spool is None
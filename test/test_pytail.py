@@ -0,0 +1,59 @@
+import pytest
+
+import pytail
+
+
+def trace(i, nlines):
+    return 'ERROR message %d\n%s' % (i, ''.join(
+        '  at line %d\n' % j for j in range(nlines)))
+
+
+@pytest.mark.parametrize('mode', ['text', 'binary', 'mmap'])
+def test_messages_across_reads(tmp_path, mode):
+    path = tmp_path / 'test.log'
+    path.write_text('')
+    messages = []
+    parser = pytail.LogParser(
+        str(path), lambda e: messages.append(e.body), block=False, mode=mode)
+    parser.tail.max_read = 1000
+    parser.poll()
+
+    expected = [trace(i, 51) for i in range(50)]
+    with open(str(path), 'a') as f:
+        f.write(''.join(expected))
+    while parser.poll():
+        pass
+    assert messages == expected
+
+
+@pytest.mark.parametrize('lines', [
+    ['x' * 10 ** 6 + '\n'],
+    ['start\n', 'x' * 10 ** 6 + '\n', 'end\n'],
+    ['start\n'] + ['line %d\n' % i for i in range(1000)] + [
+        'y' * 10 ** 6 + '\n'],
+])
+def test_message_length_limit(lines):
+    buf = pytail.MessageBuffer(lines[0], 1000)
+    for line in lines[1:]:
+        buf.append(line)
+    msg = buf.getvalue()
+    assert len(msg) < 1100
+    assert msg.startswith(lines[0][:10])
+    assert buf.nlines == len(lines)
+
+
+def test_mmap_closed(tmp_path):
+    path = tmp_path / 'test.log'
+    path.write_text('')
+    messages = []
+    parser = pytail.LogParser(
+        str(path), lambda e: messages.append(e.body), block=False,
+        mode='mmap')
+    parser.poll()
+    with open(str(path), 'a') as f:
+        f.write(''.join(trace(i, 5) for i in range(10)))
+    while parser.poll():
+        pass
+    assert len(messages) == 10
+    with open('/proc/self/maps') as f:
+        assert str(path) not in f.read()
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+pytest.importorskip('slackclient')
+
+import aggregator  # noqa: E402
+from conftest import wait_for  # noqa: E402
+import asyncruntime  # noqa: E402
+import OmeroFenton  # noqa: E402
+import tailwatcher  # noqa: E402
+
+
+class FakeSlackClient(object):
+
+    def __init__(self, token):
+        self.posted = []
+
+    def api_call(self, method, **kwargs):
+        if method == 'chat.postMessage':
+            self.posted.append(kwargs)
+        return {'ok': True, 'channel': 'C1', 'ts': '1'}
+
+    def rtm_connect(self):
+        return False
+
+
+@pytest.fixture
+def asyncio_bot(monkeypatch):
+    monkeypatch.setattr(OmeroFenton, 'SlackClient', FakeSlackClient)
+    bot = OmeroFenton.OmeroFenton('bot', 'token', '#channel')
+    bot.runtime = asyncruntime.AsyncRuntime(bot)
+    scheduler = aggregator.get_scheduler()
+    aggregator.set_scheduler(bot.runtime.scheduler)
+    bot.set_tailwatcher(tailwatcher.PollingTailWatcher(0.1, 100))
+    bot.maincfg = {'levels': 'ERROR', 'poll_interval': '0.1'}
+    yield bot
+    aggregator.set_scheduler(scheduler)
+
+
+def run_until(bot, f):
+    """
+    Run the asyncio runtime in this thread until f(), called in another
+    thread, returns
+    """
+    errors = []
+
+    def target():
+        try:
+            wait_for(lambda: bot.runtime.scheduler.loop is not None)
+            f()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            bot.runtime.scheduler.loop.call_soon_threadsafe(
+                bot.runtime.stop)
+
+    t = threading.Thread(target=target)
+    t.start()
+    bot.runtime.run()
+    t.join()
+    if errors:
+        raise errors[0]
+
+
+def test_reload_starts_components_under_asyncio(asyncio_bot, tmp_path):
+    bot = asyncio_bot
+    (tmp_path / 'a.log').write_text('')
+    logcfgs = {
+        'logdefault': [{'name': 'logs', 'file': str(tmp_path / '*.log'),
+                        'rescan_interval': '0.1'}],
+        'diskmonitor': [{'name': 'tmp', 'path': str(tmp_path),
+                         'warn_mb': '0', 'hysteresis_mb': '1'}],
+    }
+
+    def reload():
+        OmeroFenton.reload_config(bot, dict(bot.maincfg), logcfgs)
+        found = bot.sections[('logdefault', 'logs')]
+        assert wait_for(lambda: len(found.reporters) == 1)
+        assert wait_for(lambda: bot.disks.groups() and all(
+            m.free_mb is not None for m in bot.disks.monitors))
+
+    run_until(bot, reload)
@@ -0,0 +1,92 @@
+import socket
+import sqlite3
+import threading
+
+import pytest
+
+pytest.importorskip('slackclient')
+
+import aggregator  # noqa: E402
+from configurator import ConfigWatcher  # noqa: E402
+import diskmonitor  # noqa: E402
+import emailsender  # noqa: E402
+from logevent import LogEvent  # noqa: E402
+import messageindex  # noqa: E402
+import metrics  # noqa: E402
+import OmeroFenton  # noqa: E402
+
+
+class FakeSlackClient(object):
+
+    def __init__(self, token):
+        pass
+
+    def api_call(self, method, **kwargs):
+        return {'ok': True, 'channel': 'C1', 'ts': '1'}
+
+    def rtm_connect(self):
+        return False
+
+
+def start(target):
+    t = threading.Thread(target=target)
+    t.daemon = True
+    t.start()
+    return t
+
+
+def test_close_stops_components(monkeypatch, tmp_path):
+    monkeypatch.setattr(OmeroFenton, 'SlackClient', FakeSlackClient)
+    scheduler = aggregator.get_scheduler()
+    aggregator.set_scheduler(aggregator.AlertScheduler())
+    try:
+        bot = OmeroFenton.OmeroFenton('bot', 'token', '#channel')
+        config = tmp_path / 'fenton.cfg'
+        config.write_text('[main]\n')
+        index_file = str(tmp_path / 'index.sqlite')
+        bot.index = messageindex.MessageIndex(index_file)
+        bot.disks = diskmonitor.DiskSampler(interval=60)
+        bot.disks.add(diskmonitor.DiskMonitor(str(tmp_path), bot, [0], 1))
+        bot.config_watcher = ConfigWatcher(
+            str(config), lambda maincfg, logcfgs: None, 60)
+        bot.metrics = metrics.MetricsServer(bot, 'localhost:0')
+        address = bot.metrics.server.server_address
+        threads = [start(c.start) for c in (
+            bot.index, bot.disks, bot.config_watcher, bot.metrics)]
+        bot.index.add('logs', 'ERROR', 'Queued before closing')
+
+        bot.close()
+        for t in threads:
+            t.join(5)
+            assert not t.is_alive()
+    finally:
+        aggregator.set_scheduler(scheduler)
+
+    db = sqlite3.connect(index_file)
+    assert db.execute('SELECT msg FROM messages').fetchall() == [
+        ('Queued before closing',)]
+    db.close()
+    with pytest.raises(ConnectionRefusedError):
+        socket.create_connection(address, 1)
+
+
+def test_close_sends_pending_alerts(monkeypatch, smtp_server):
+    monkeypatch.setattr(OmeroFenton, 'SlackClient', FakeSlackClient)
+    monkeypatch.setattr(emailsender, '_senders', {})
+    scheduler = aggregator.get_scheduler()
+    aggregator.set_scheduler(aggregator.AlertScheduler())
+    try:
+        bot = OmeroFenton.OmeroFenton('bot', 'token', '#channel')
+        a = aggregator.AggregateAlerter([('ERROR', '', '')], 3600, 3600)
+        a.add_alerter(aggregator.EmailAlerter(
+            'alerts', smtp_server.address, 'from@example.org',
+            ['to@example.org'], 'Alert'))
+        bot.add_aggregator(a)
+        a.add_event(LogEvent('Failed', source='a', level='ERROR'))
+
+        # The alert is waiting for its delay, there's no spool
+        bot.close()
+    finally:
+        aggregator.set_scheduler(scheduler)
+    assert len(smtp_server.messages) == 1
+    assert 'Failed' in smtp_server.messages[0]['data']
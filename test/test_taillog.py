@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+import logevent
+import taillog
+
+
+class Bot(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def log_message(self, logmsg, level=None, name=None, fp=None):
+        self.messages.append(str(logmsg))
+
+
+def get_reporter(event_time):
+    bot = Bot()
+    r = taillog.LimitLogReporter('a.log', 'a', bot, ['ERROR'], 100, 60)
+    r.event_time = event_time
+    r.set_anomaly_detection(['ERROR'], 4, 10, 60)
+    r.timestamps = logevent.TimestampParser(r.time_format)
+    return r, bot
+
+
+def receive(r, t, i):
+    line = '%s,000 ERROR failure %d\n' % (
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)), i)
+    r.log_received(logevent.LogEvent(line, match=r.log_re.match(line)))
+
+
+def anomalies(bot):
+    return [m for m in bot.messages if 'rate anomaly' in m]
+
+
+@pytest.mark.parametrize('event_time', [True, False])
+def test_backlog_anomalies(event_time):
+    r, bot = get_reporter(event_time)
+    # Two messages a minute for 3 hours, ending 3 hours ago, all read now
+    start = time.time() - 6 * 3600
+    for i in range(360):
+        receive(r, start + i * 30, i)
+        if i % 50 == 0:
+            r.check_anomalies(time.time())
+    if event_time:
+        assert anomalies(bot) == []
+        assert len(bot.messages) == 360
+    else:
+        assert anomalies(bot)
+
+    # A burst after catching up is still detected
+    bot.messages = []
+    now = time.time()
+    for i in range(20):
+        receive(r, now, i)
+    if event_time:
+        assert len(anomalies(bot)) == 1
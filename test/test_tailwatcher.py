@@ -0,0 +1,42 @@
+import os
+import threading
+
+import pytest
+
+import tailwatcher
+
+
+pytestmark = pytest.mark.skipif(
+    not tailwatcher.inotify_available(), reason='inotify unavailable')
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def test_stop_closes_fds():
+    n = open_fds()
+    tailwatcher.InotifyTailWatcher(0.1).stop()
+    assert open_fds() == n
+
+    watcher = tailwatcher.InotifyTailWatcher(0.1)
+    t = threading.Thread(target=watcher.start)
+    t.start()
+    watcher.stop()
+    t.join(5)
+    assert not t.is_alive()
+    assert open_fds() == n
+
+
+def test_wakeup_with_full_pipe():
+    watcher = tailwatcher.InotifyTailWatcher(0.1)
+    try:
+        # More than the pipe's capacity, nothing is reading it
+        t = threading.Thread(
+            target=lambda: [watcher.wakeup() for i in range(100000)])
+        t.daemon = True
+        t.start()
+        t.join(5)
+        assert not t.is_alive()
+    finally:
+        watcher.stop()
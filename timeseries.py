@@ -0,0 +1,132 @@
+import array
+import math
+
+
+class RateSeries(object):
+    """
+    Counts of events per minute for the last `minutes` minutes, stored in
+    a fixed size ring buffer
+    """
+
+    __slots__ = ('buckets', 'minute')
+
+    def __init__(self, minutes):
+        self.buckets = array.array('I', [0]) * minutes
+        # The most recent minute (time // 60) with a bucket
+        self.minute = None
+
+    def advance(self, minute):
+        """
+        Move the end of the series to minute, clearing the buckets of
+        minutes which have been skipped
+        """
+        size = len(self.buckets)
+        if self.minute is None or minute - self.minute >= size:
+            self.buckets = array.array('I', [0]) * size
+        else:
+            for m in range(self.minute + 1, minute + 1):
+                self.buckets[m % size] = 0
+        self.minute = minute
+
+    def add(self, now, n=1):
+        minute = int(now // 60)
+        if self.minute is None or minute > self.minute:
+            self.advance(minute)
+        elif minute <= self.minute - len(self.buckets):
+            return
+        self.buckets[minute % len(self.buckets)] += n
+
+    def get(self, minute):
+        """
+        The count for a minute, 0 if it's outside the series
+        """
+        if (self.minute is None or minute > self.minute or
+                minute <= self.minute - len(self.buckets)):
+            return 0
+        return self.buckets[minute % len(self.buckets)]
+
+    def total(self, now, minutes):
+        """
+        The number of events in the last `minutes` minutes, including the
+        current minute
+        """
+        end = int(now // 60)
+        return sum(self.get(m) for m in range(end - minutes + 1, end + 1))
+
+    def rate(self, now, minutes):
+        """
+        Average events per minute over the last `minutes` minutes
+        """
+        return self.total(now, minutes) / float(minutes)
+
+
+class AnomalyDetector(object):
+
+    def __init__(self, series, threshold=4, min_count=10,
+                 baseline_minutes=60):
+        """
+        Detects minutes in which the count in a RateSeries is anomalously
+        high compared with an exponentially weighted moving average and
+        variance of the previous minutes.
+
+        threshold: Number of standard deviations above the baseline
+        min_count: Minimum count in a minute to be an anomaly, so a quiet
+          log doesn't alert on a few messages
+        baseline_minutes: Span of the moving average
+        """
+        self.series = series
+        self.configure(threshold, min_count, baseline_minutes)
+        self.mean = 0.0
+        self.var = 0.0
+        # The first minute which hasn't been added to the baseline
+        self.minute = None
+        self.active = False
+        self.n_suppressed = 0
+        self.n_anomalies = 0
+
+    def configure(self, threshold, min_count, baseline_minutes):
+        self.threshold = threshold
+        self.min_count = min_count
+        self.alpha = 2.0 / (baseline_minutes + 1)
+
+    def limit(self):
+        # A standard deviation of at least 1 so a constant rate isn't
+        # infinitely sensitive
+        return self.mean + self.threshold * max(math.sqrt(self.var), 1)
+
+    def anomalous(self, count):
+        return count >= self.min_count and count > self.limit()
+
+    def update(self, minute):
+        """
+        Add the minutes which have completed before minute to the
+        baseline. If an active anomaly ends returns the number of events
+        suppressed during it, otherwise None.
+        """
+        ended = None
+        if self.minute is None:
+            self.minute = minute
+        first = max(self.minute, minute - len(self.series.buckets))
+        for m in range(first, minute):
+            x = self.series.get(m)
+            if self.active and not self.anomalous(x):
+                self.active = False
+                ended = self.n_suppressed
+                self.n_suppressed = 0
+            diff = x - self.mean
+            incr = self.alpha * diff
+            self.mean += incr
+            self.var = (1 - self.alpha) * (self.var + diff * incr)
+        self.minute = max(self.minute, minute)
+        return ended
+
+    def check(self, minute):
+        """
+        Call after an event has been added to the series, returns True if
+        this started an anomaly
+        """
+        if not self.active and self.anomalous(self.series.get(minute)):
+            self.active = True
+            self.n_anomalies += 1
+            return True
+        return False
@@ -0,0 +1,386 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+
+import aggregator
+import checkpoint
+import ratelimit
+import tailwatcher
+from configurator import getcfgkey
+from logevent import LogEvent
+
+
+def partition(sections, n):
+    """
+    Split log sections (logtype, cfg) into n lists. Sections in the same
+    rate_limit_group are kept together so they can share a limit.
+    """
+    groups = {}
+    for logtype, cfg in sections:
+        key = cfg.get('rate_limit_group') or (logtype, cfg['name'])
+        groups.setdefault(key, []).append((logtype, cfg))
+    parts = [[] for i in range(n)]
+    # Largest groups first, each to the least loaded worker
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(parts, key=len).extend(group)
+    return [p for p in parts if p]
+
+
+class EventChannel(object):
+
+    def __init__(self, conn, max_batch=100, interval=0.1):
+        """
+        Sends events from a worker to the coordinator in batches of up to
+        max_batch events, at most interval seconds after they were queued
+        """
+        self.conn = conn
+        self.max_batch = max_batch
+        self.interval = interval
+        self.events = []
+        self.lock = threading.Lock()
+        self._alive = True
+
+    def send(self, event):
+        with self.lock:
+            self.events.append(event)
+            if len(self.events) >= self.max_batch:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.events:
+            self.conn.send(self.events)
+            self.events = []
+
+    def start(self):
+        while self._alive:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except (OSError, ValueError) as e:
+                logging.error('Lost connection to coordinator: %s', e)
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+
+
+class RemoteSink(aggregator.AggregateAlerter):
+    """
+    Stands in for a coordinator's AggregateAlerter in a worker, reportable
+    events are forwarded to the coordinator
+    """
+
+    def __init__(self, index, conditions, channel):
+        super(RemoteSink, self).__init__(conditions, 0, 0)
+        self.index = index
+        self.channel = channel
+
+    def log_received(self, event):
+        if self.reportable(event):
+            self.channel.send(('sink', self.index, event.level, event.source,
+                               event.body, event.timestamp))
+
+
+class WorkerBot(object):
+    """
+    Stands in for OmeroFenton in a worker process, messages are forwarded
+    to the coordinator
+    """
+
+    def __init__(self, channel, sinks):
+        self.channel = channel
+        self.sinks = sinks
+        self.reporters = []
+        self.rate_limit_groups = {}
+        # Applied by the coordinator across all workers
+        self.global_rate_limiter = None
+        self.checkpoints = None
+        self.tailwatcher = None
+
+    def log_message(self, logmsg, level=None, name=None, fp=None):
+        self.channel.send(('log', str(logmsg), level, name))
+
+    def update_message(self, fp):
+        pass
+
+    def add_reporter(self, reporter):
+        if hasattr(reporter, 'add_sink'):
+            for s in self.sinks:
+                reporter.add_sink(s)
+        self.reporters.append(reporter)
+        if self.checkpoints and hasattr(reporter, 'checkpoint'):
+            self.checkpoints.add(reporter)
+        if self.tailwatcher and hasattr(reporter, 'poll'):
+            self.tailwatcher.add(reporter)
+            return
+        t = threading.Thread(target=reporter.start)
+        t.daemon = True
+        t.start()
+
+    def remove_reporter(self, reporter):
+        self.reporters = [r for r in self.reporters if r is not reporter]
+        if self.checkpoints and hasattr(reporter, 'checkpoint'):
+            self.checkpoints.remove(reporter)
+        if self.tailwatcher and hasattr(reporter, 'poll'):
+            self.tailwatcher.remove(reporter)
+        else:
+            reporter.stop()
+
+    def status(self):
+        return [r.status() for r in self.reporters]
+
+
+def setup_tailing(bot, maincfg, checkpoint_file):
+    """
+    Create the checkpoint store and tailwatcher of a WorkerBot, must be
+    called before any reporters are added
+    """
+    if checkpoint_file:
+        interval = getcfgkey(
+            'checkpoint_interval', maincfg, cast=float) or 10
+        bot.checkpoints = checkpoint.CheckpointStore(
+            checkpoint_file, interval)
+        t = threading.Thread(target=bot.checkpoints.start)
+        t.daemon = True
+        t.start()
+
+    tail_mode = getcfgkey('tail_mode', maincfg) or 'auto'
+    pollint = getcfgkey('poll_interval', maincfg, cast=float) or 2
+    max_open = getcfgkey('max_open_files', maincfg, cast=int)
+    if max_open is None:
+        max_open = tailwatcher.default_max_open()
+    bot.tailwatcher = tailwatcher.get_tailwatcher(
+        tail_mode, pollint, max_open)
+
+
+def worker_main(index, sections, maincfg, conditions, add_log_reporter,
+                conn, loglevel, status_interval):
+    """
+    Entry point of a worker process: tails the log sections, sending
+    messages, reportable events and status to the coordinator
+    """
+    logging.basicConfig(
+        level=loglevel,
+        format='%%(asctime)-15s %%(levelname)-8s worker-%d %%(message)s' % (
+            index))
+    # The coordinator handles Ctrl-C and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def shutdown_handler(signal=None, frame=None):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, shutdown_handler)
+
+    channel = EventChannel(conn)
+    sinks = [RemoteSink(i, c, channel) for (i, c) in enumerate(conditions)]
+    bot = WorkerBot(channel, sinks)
+    checkpoint_file = getcfgkey('checkpoint_file', maincfg)
+    if checkpoint_file:
+        checkpoint_file = '%s.worker%d' % (checkpoint_file, index)
+    setup_tailing(bot, maincfg, checkpoint_file)
+
+    for logtype, cfg in sections:
+        add_log_reporter(logtype, bot, cfg, maincfg)
+
+    t = threading.Thread(target=channel.start)
+    t.daemon = True
+    t.start()
+
+    def send_status():
+        while True:
+            channel.send(('status', bot.status()))
+            time.sleep(status_interval)
+
+    t = threading.Thread(target=send_status)
+    t.daemon = True
+    t.start()
+
+    try:
+        if bot.tailwatcher:
+            bot.tailwatcher.start()
+        else:
+            while True:
+                time.sleep(status_interval)
+    except (SystemExit, BrokenPipeError):
+        pass
+    finally:
+        if bot.checkpoints:
+            bot.checkpoints.flush()
+        try:
+            channel.flush()
+        except (OSError, ValueError):
+            pass
+
+
+class EventDispatcher(object):
+
+    def __init__(self, bot):
+        """
+        Handles events forwarded by a WorkerBot in another process or host:
+        messages are deduplicated and rate limited across all sources then
+        posted, reportable events are passed to the aggregators
+
+        bot: The coordinating OmeroFenton
+        """
+        self.bot = bot
+        self.n_events = 0
+        self.n_suppressed = 0
+
+    def dispatch(self, event):
+        self.n_events += 1
+        kind = event[0]
+        if kind == 'log':
+            logmsg, level, name = event[1:]
+            if self.bot.global_rate_limiter and ratelimit.allow(
+                    [self.bot.global_rate_limiter], level, time.time()):
+                self.n_suppressed += 1
+                return
+            if self.bot.dedup:
+                dup, fp = self.bot.dedup.seen(logmsg, name)
+                if dup:
+                    self.bot.update_message(fp)
+                    return
+            else:
+                fp = None
+            self.bot.log_message(logmsg, level, name, fp)
+        elif kind == 'sink':
+            index, level, name, msg, timestamp = event[1:]
+            self.bot.aggregators[index].add_event(
+                LogEvent(msg, source=name, level=level, timestamp=timestamp))
+
+
+class Worker(object):
+
+    __slots__ = ('index', 'sections', 'process', 'conn', 'started',
+                 'restarts', 'restart_at', 'status', 'status_ts')
+
+    def __init__(self, index, sections):
+        self.index = index
+        self.sections = sections
+        self.process = None
+        self.conn = None
+        self.started = None
+        self.restarts = 0
+        self.restart_at = None
+        self.status = []
+        self.status_ts = None
+
+
+class WorkerPool(EventDispatcher):
+
+    def __init__(self, bot, nworkers, sections, maincfg, add_log_reporter,
+                 loglevel=logging.INFO):
+        """
+        Tails log sections in nworkers processes. Messages and reportable
+        events are sent back and handled here, the coordinator: Slack
+        output, deduplication, the global rate limit and aggregators all
+        run in this process. Workers which exit are restarted, resuming
+        from their checkpoints if checkpoint_file is set.
+
+        bot: The coordinating OmeroFenton
+        sections: List of (logtype, cfg) log sections
+        add_log_reporter: Function (logtype, bot, cfg, maincfg) which
+          creates a log reporter in a worker
+        """
+        super(WorkerPool, self).__init__(bot)
+        self.maincfg = maincfg
+        self.add_log_reporter = add_log_reporter
+        self.loglevel = loglevel
+        self.workers = [Worker(i, s) for (i, s) in enumerate(
+            partition(sections, nworkers))]
+        self.context = multiprocessing.get_context('spawn')
+        self.restart_delay = 5
+        self.status_interval = 10
+        self._alive = True
+
+    def spawn(self, w):
+        conditions = [a.conditions for a in self.bot.aggregators]
+        r, s = self.context.Pipe(duplex=False)
+        w.process = self.context.Process(
+            target=worker_main, name='fenton-worker-%d' % w.index,
+            args=(w.index, w.sections, self.maincfg, conditions,
+                  self.add_log_reporter, s, self.loglevel,
+                  self.status_interval))
+        w.process.daemon = True
+        w.process.start()
+        # Only the worker should hold the sending end, so a crash closes it
+        s.close()
+        w.conn = r
+        w.started = time.time()
+        logging.info('Started worker %d (pid %d): %s', w.index,
+                     w.process.pid, ', '.join(c['name'] for (t, c) in
+                                              w.sections))
+
+    def receive(self, w):
+        try:
+            events = w.conn.recv()
+        except (EOFError, OSError):
+            return False
+        for event in events:
+            if event[0] == 'status':
+                w.status = event[1]
+                w.status_ts = time.time()
+            else:
+                self.dispatch(event)
+        return True
+
+    def restart(self, w):
+        """
+        Called when a worker's connection is closed, restart it after
+        restart_delay seconds
+        """
+        w.conn.close()
+        w.conn = None
+        if w.process.is_alive():
+            w.process.terminate()
+        w.process.join(1)
+        logging.error('Worker %d exited with code %s, restarting in %ds',
+                      w.index, w.process.exitcode, self.restart_delay)
+        w.restarts += 1
+        w.restart_at = time.time() + self.restart_delay
+
+    def start(self):
+        for w in self.workers:
+            self.spawn(w)
+        while self._alive:
+            conns = dict((w.conn, w) for w in self.workers if w.conn)
+            for c in multiprocessing.connection.wait(list(conns), 1):
+                w = conns[c]
+                if not self.receive(w) and self._alive:
+                    self.restart(w)
+            now = time.time()
+            for w in self.workers:
+                if w.restart_at and w.restart_at <= now and self._alive:
+                    w.restart_at = None
+                    self.spawn(w)
+
+    def stop(self):
+        self._alive = False
+        for w in self.workers:
+            if w.process and w.process.is_alive():
+                w.process.terminate()
+        for w in self.workers:
+            if w.process:
+                w.process.join(5)
+
+    def status(self):
+        lines = []
+        for w in self.workers:
+            age = '-'
+            if w.status_ts:
+                age = '%ds ago' % (time.time() - w.status_ts)
+            lines.append('Worker %d: pid %s  restarts %d  status %s' % (
+                w.index, w.process.pid if w.process else '-', w.restarts,
+                age))
+            lines.extend(w.status)
+        m = 'Workers: %d  events %d  suppressed %d\n%s' % (
+            len(self.workers), self.n_events, self.n_suppressed,
+            '\n'.join(lines))
+        logging.debug('status: %s', m)
+        return m